@@ -1,8 +1,26 @@
+from contextlib import contextmanager
+import hashlib
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.urlresolvers import get_script_prefix, get_urlconf, reverse
+from django.db.models.signals import post_delete, post_save
 from django.template.base import Template
 from django.template.context import Context
-from getpaid.utils import get_backend_settings
+from django.test.signals import setting_changed
+from django.utils.encoding import force_unicode
+from django.utils.safestring import mark_safe
+from getpaid.utils import BackendConfig, get_backend_settings
+
+_backend_configs = {}
+_status_transitions = {}
+_order_description = None
+
+_ORDER_DESCRIPTION_KEY = 'getpaid.order_description:%s:%s.%s:%s'
+
+_site_urls = {}
+_routes = {}
+_PK_PLACEHOLDER = '9876543210'
 
 class PaymentProcessorBase(object):
     """
@@ -32,6 +50,24 @@ class PaymentProcessorBase(object):
     """
     A path in static root where payment logo could be find.
     """
+    BACKEND_REQUIRED_SETTINGS = tuple()
+    """
+    Names of backend settings without which backend cannot work. They are checked once when backends are loaded,
+    so missing values raise ``ImproperlyConfigured`` before the first payment is made.
+    """
+    BACKEND_DEFAULT_SETTINGS = {}
+    """
+    Dict with default values of optional backend settings.
+    """
+    BACKEND_STATUS_TRANSITIONS = {}
+    """
+    Dict overriding ``getpaid.models.PAYMENT_STATUS_TRANSITIONS``: statuses that payments of this backend in given
+    status can be changed to, e.g. ``{'paid': ('failed', )}`` if paid payments can be refunded.
+    """
+    gateway_url_reusable = True
+    """
+    Set to ``False`` by ``get_gateway_url()`` if its redirect must not be reused (see ``getpaid.redirects``).
+    """
 
     def __init__(self, payment):
 
@@ -39,6 +75,17 @@ class PaymentProcessorBase(object):
             raise ValueError("Backend '%s' cannot process '%s' payments." % self.BACKEND, payment.currency)
         self.payment = payment
 
+    @classmethod
+    def get_status_transitions(cls):
+        """
+        Returns frozenset of allowed ``(old_status, new_status)`` pairs, compiled once per backend.
+        """
+        transitions = _status_transitions.get(cls.BACKEND)
+        if transitions is None:
+            from getpaid.models import compile_status_transitions
+            transitions = _status_transitions[cls.BACKEND] = compile_status_transitions(cls.BACKEND_STATUS_TRANSITIONS)
+        return transitions
+
     @classmethod
     def get_logo_url(cls):
         """
@@ -52,19 +99,34 @@ class PaymentProcessorBase(object):
         """
         Renders order description using django template provided in ``settings.GETPAID_ORDER_DESCRIPTION``
         or if not provided return unicode representation of ``Order object``.
+
+        The template is compiled once. With ``settings.GETPAID_ORDER_DESCRIPTION_CACHE`` set to a number of
+        seconds, rendered descriptions are kept in Django cache per order.
         """
-        template = getattr(settings, 'GETPAID_ORDER_DESCRIPTION', None)
-        if template:
-            return Template(template).render(Context({"payment": payment, "order": order}))
-        else:
+        template = get_order_description_template()
+        if template is None:
             return unicode(order)
+        if isinstance(template, basestring):
+            # plain text without template tags
+            return template
+        timeout = getattr(settings, 'GETPAID_ORDER_DESCRIPTION_CACHE', 0)
+        if timeout and order.pk is not None:
+            key = get_order_description_key(order)
+            description = cache.get(key)
+            if description is None:
+                description = template.render(Context({"payment": payment, "order": order}))
+                cache.set(key, description, timeout)
+            return description
+        return template.render(Context({"payment": payment, "order": order}))
 
 
     def get_gateway_url(self, request):
         """
         Should return a tuple with the first item being the URL that redirects to payment Gateway
         Second item should be if the request is made via GET or POST. Third item are the parameters
-        to be passed in case of a POST REQUEST. Request context need to be given because various
+        to be passed in case of a POST REQUEST. Set ``gateway_url_reusable`` to ``False`` if the redirect
+        must not be reused for another submission of the payment (e.g. it leads to a failure page because
+        the gateway refused the payment). Request context need to be given because various
         payment engines requires information about client (e.g. a client IP).
         """
         raise NotImplementedError('Must be implemented in PaymentProcessor')
@@ -77,19 +139,148 @@ class PaymentProcessorBase(object):
         from getpaid.forms import PaymentHiddenInputsPostForm
         return PaymentHiddenInputsPostForm(items=post_data)
 
+    @classmethod
+    def get_backend_config(cls):
+        """
+        Returns ``BackendConfig`` with backend settings. It is built once from
+        ``settings.GETPAID_BACKENDS_SETTINGS`` and backend defaults, so settings can be read as plain attributes.
+        """
+        try:
+            return _backend_configs[cls.BACKEND]
+        except KeyError:
+            config = BackendConfig(cls.BACKEND, get_backend_settings(cls.BACKEND),
+                                   cls.BACKEND_REQUIRED_SETTINGS, cls.BACKEND_DEFAULT_SETTINGS)
+            _backend_configs[cls.BACKEND] = config
+            return config
+
     @classmethod
     def get_backend_setting(cls, name, default=None):
         """
         Reads ``name`` setting from backend settings dictionary.
 
         If `default` value is omitted, raises ``ImproperlyConfigured`` when
-        setting ``name`` is not available.
+        setting ``name`` is not available. Given `default` takes precedence
+        over ``BACKEND_DEFAULT_SETTINGS``.
         """
-        backend_settings = get_backend_settings(cls.BACKEND)
+        config = cls.get_backend_config()
         if default is not None:
-            return backend_settings.get(name, default)
+            return config.get_provided(name, default)
         else:
-            try:
-                return backend_settings[name]
-            except KeyError:
-                raise ImproperlyConfigured("getpaid '%s' requires backend '%s' setting" % (cls.BACKEND, name))
\ No newline at end of file
+            return getattr(config, name)
+
+
+@contextmanager
+def override_backend_config(processor, **values):
+    """
+    Temporarily replaces configuration of given ``PaymentProcessor`` class, e.g. in tests. Values are applied on top
+    of current backend settings.
+    """
+    old_config = _backend_configs.get(processor.BACKEND)
+    values = dict(get_backend_settings(processor.BACKEND), **values)
+    _backend_configs[processor.BACKEND] = BackendConfig(processor.BACKEND, values,
+                                                        processor.BACKEND_REQUIRED_SETTINGS,
+                                                        processor.BACKEND_DEFAULT_SETTINGS)
+    try:
+        yield _backend_configs[processor.BACKEND]
+    finally:
+        if old_config is None:
+            _backend_configs.pop(processor.BACKEND, None)
+        else:
+            _backend_configs[processor.BACKEND] = old_config
+
+
+def reset_backend_configs(**kwargs):
+    if kwargs.get('setting', 'GETPAID_BACKENDS_SETTINGS') == 'GETPAID_BACKENDS_SETTINGS':
+        _backend_configs.clear()
+
+setting_changed.connect(reset_backend_configs)
+
+
+def get_order_description_template():
+    """
+    Returns ``settings.GETPAID_ORDER_DESCRIPTION`` compiled to ``Template`` once, the setting itself if it is plain
+    text without template tags, or ``None`` if it is not set.
+    """
+    global _order_description
+    if _order_description is None:
+        template = force_unicode(getattr(settings, 'GETPAID_ORDER_DESCRIPTION', None) or u'')
+        if not template:
+            compiled = None
+        elif u'{' in template:
+            compiled = Template(template)
+        else:
+            compiled = mark_safe(template)
+        _order_description = (compiled, hashlib.md5(template.encode('utf-8')).hexdigest()[:8])
+    return _order_description[0]
+
+
+def get_order_description_key(order):
+    """
+    Returns cache key of ``order`` description, which changes with ``settings.GETPAID_ORDER_DESCRIPTION``.
+    """
+    get_order_description_template()
+    return _ORDER_DESCRIPTION_KEY % (_order_description[1], order._meta.app_label, order._meta.object_name,
+                                     order.pk)
+
+
+def reset_order_description(**kwargs):
+    global _order_description
+    if kwargs.get('setting', 'GETPAID_ORDER_DESCRIPTION') == 'GETPAID_ORDER_DESCRIPTION':
+        _order_description = None
+
+setting_changed.connect(reset_order_description)
+
+
+def get_site_url(secure=False):
+    """
+    Returns scheme and domain of the current ``Site``, e.g. ``https://example.com``. Read once per scheme.
+    """
+    site_url = _site_urls.get(secure)
+    if site_url is None:
+        site_url = _site_urls[secure] = '%s://%s' % ('https' if secure else 'http', Site.objects.get_current().domain)
+    return site_url
+
+
+def get_route(view, pk=None):
+    """
+    Returns path of ``view``, with payment ``pk`` if given. Every view is reversed once, ``pk`` is substituted
+    into the reversed path.
+    """
+    key = (view, pk is not None, get_urlconf(), get_script_prefix())
+    route = _routes.get(key)
+    if route is None:
+        if pk is None:
+            route = (reverse(view), )
+        else:
+            route = tuple(reverse(view, kwargs={'pk': _PK_PLACEHOLDER}).split(_PK_PLACEHOLDER))
+            if len(route) != 2:
+                # placeholder is also a part of the path, do not cache
+                return reverse(view, kwargs={'pk': pk})
+        _routes[key] = route
+    if pk is None:
+        return route[0]
+    return '%s%s%s' % (route[0], pk, route[1])
+
+
+def build_absolute_url(view, secure=False, pk=None):
+    """
+    Returns absolute URL of ``view`` (with payment ``pk`` if given) at the current ``Site``, using https if
+    ``secure``, e.g. for links payment brokers call back or return clients to. No database query is made once
+    the site domain and the view path are cached.
+    """
+    return get_site_url(secure) + get_route(view, pk)
+
+
+def reset_site_urls(**kwargs):
+    if kwargs.get('setting', 'SITE_ID') == 'SITE_ID':
+        _site_urls.clear()
+
+
+def reset_routes(**kwargs):
+    if kwargs.get('setting', 'ROOT_URLCONF') == 'ROOT_URLCONF':
+        _routes.clear()
+
+setting_changed.connect(reset_site_urls)
+setting_changed.connect(reset_routes)
+post_save.connect(reset_site_urls, sender=Site)
+post_delete.connect(reset_site_urls, sender=Site)
@@ -1,15 +1,15 @@
 import datetime
 from decimal import Decimal
-import hashlib
 import logging
 import urllib
-from django.contrib.sites.models import Site
 from django.core.exceptions import ImproperlyConfigured
-from django.core.urlresolvers import reverse
 from django.utils.timezone import utc
 from django.utils.translation import ugettext_lazy as _
 from getpaid import signals
-from getpaid.backends import PaymentProcessorBase
+from getpaid.backends import PaymentProcessorBase, build_absolute_url
+from getpaid.backends.inbox import defer_notification
+from getpaid.backends.ledger import Notification
+from getpaid.backends.signing import Signature
 
 logger = logging.getLogger('getpaid.backends.dotpay')
 
@@ -32,24 +32,43 @@ class PaymentProcessor(PaymentProcessorBase):
     _ACCEPTED_LANGS = ('pl', 'en', 'de', 'it', 'fr', 'es', 'cz', 'ru', 'bg')
     _GATEWAY_URL = 'https://ssl.dotpay.eu/'
     _ONLINE_SIG_FIELDS = ('id', 'control', 't_id', 'amount', 'email', 'service', 'code', 'username', 'password', 't_status')
+    _ONLINE_SIG = Signature(_ONLINE_SIG_FIELDS, separator=':', key_first=True, name='dotpay.online')
+
+    BACKEND_REQUIRED_SETTINGS = ('id', )
+    BACKEND_DEFAULT_SETTINGS = {
+        'PIN': '',
+        'allowed_ip': _ALLOWED_IP,
+        'force_ssl': False,
+        'lang': None,
+        'onlinetransfer': False,
+        'p_email': None,
+        'p_info': None,
+        'tax': False,
+        'method': 'get',
+    }
+    # Refunded payments and reclamations are reported as failed
+    BACKEND_STATUS_TRANSITIONS = {
+        'paid': ('failed', ),
+    }
 
     @staticmethod
     def compute_sig(params, fields, PIN):
-        text = PIN + ":" + (u":".join(map(lambda field: params.get(field, ''), fields)))
-        return hashlib.md5(text).hexdigest()
+        return Signature(fields, separator=':', key_first=True).compute(params, PIN)
 
     @staticmethod
     def online(params, ip):
+        config = PaymentProcessor.get_backend_config()
 
-        allowed_ip = PaymentProcessor.get_backend_setting('allowed_ip', PaymentProcessor._ALLOWED_IP)
-
-        if len(allowed_ip) != 0 and ip not in allowed_ip:
-            logger.warning('Got message from not allowed IP %s' % str(allowed_ip))
+        if len(config.allowed_ip) != 0 and ip not in config.allowed_ip:
+            logger.warning('Got message from not allowed IP %s' % str(config.allowed_ip))
             return 'IP ERR'
 
-        PIN = PaymentProcessor.get_backend_setting('PIN', '')
+        notification = Notification(PaymentProcessor.BACKEND, params.get('t_id', ''), params)
+        response = notification.get_response()
+        if response is not None:
+            return response
 
-        if params['md5'] != PaymentProcessor.compute_sig(params, PaymentProcessor._ONLINE_SIG_FIELDS, PIN):
+        if not PaymentProcessor._ONLINE_SIG.verify(params, config.PIN, params['md5']):
             logger.warning('Got message with wrong sig, %s' % str(params))
             return 'SIG ERR'
 
@@ -57,9 +76,13 @@ class PaymentProcessor(PaymentProcessorBase):
             params['id'] = int(params['id'])
         except ValueError:
             return 'ID ERR'
-        if params['id'] != int(PaymentProcessor.get_backend_setting('id')):
+        if params['id'] != int(config.id):
             return 'ID ERR'
 
+        response = defer_notification(PaymentProcessor, params['control'], 'OK', params, ip)
+        if response is not None:
+            return response
+
         from getpaid.models import Payment
         try:
             payment = Payment.objects.get(pk=int(params['control']))
@@ -74,43 +97,31 @@ class PaymentProcessor(PaymentProcessorBase):
             return 'CURRENCY ERR'
 
         if int(params['t_status']) == DotpayTransactionStatus.FINISHED:
-            payment.amount_paid = Decimal(amount)
-            payment.paid_on = datetime.datetime.utcnow().replace(tzinfo=utc)
+            amount_paid = Decimal(amount)
+            paid_on = datetime.datetime.utcnow().replace(tzinfo=utc)
             if payment.amount <= Decimal(amount):
                 # Amount is correct or it is overpaid
-                payment.change_status('paid')
+                payment.change_status('paid', amount_paid=amount_paid, paid_on=paid_on)
             else:
-                payment.change_status('partially_paid')
+                payment.change_status('partially_paid', amount_paid=amount_paid, paid_on=paid_on)
         elif int(params['t_status']) in [DotpayTransactionStatus.REJECTED, DotpayTransactionStatus.RECLAMATION, DotpayTransactionStatus.REFUNDED]:
             payment.change_status('failed')
 
-
-        return 'OK'
+        return notification.acknowledge('OK')
 
     def get_URLC(self):
-        urlc = reverse('getpaid:dotpay:online')
-        current_site = Site.objects.get_current()
-        if PaymentProcessor.get_backend_setting('force_ssl', False):
-            return 'https://%s%s' % (current_site.domain, urlc)
-        else:
-            return 'http://%s%s' % (current_site.domain, urlc)
+        return build_absolute_url('getpaid:dotpay:online', PaymentProcessor.get_backend_config().force_ssl)
 
     def get_URL(self, pk):
-        current_site = Site.objects.get_current()
-        url = reverse('getpaid:dotpay:return', kwargs={'pk' : pk})
-        if PaymentProcessor.get_backend_setting('force_ssl', False):
-            return 'https://%s%s' % (current_site.domain, url)
-        else:
-            return 'http://%s%s' % (current_site.domain, url)
-
-
+        return build_absolute_url('getpaid:dotpay:return', PaymentProcessor.get_backend_config().force_ssl, pk)
 
     def get_gateway_url(self, request):
         """
         Routes a payment to Gateway, should return URL for redirection.
         """
+        config = PaymentProcessor.get_backend_config()
         params = {
-            'id': PaymentProcessor.get_backend_setting('id'),
+            'id': config.id,
             'description' : self.get_order_description(self.payment, self.payment.order),
             'amount' : self.payment.amount,
             'currency' : self.payment.currency,
@@ -131,25 +142,26 @@ class PaymentProcessor(PaymentProcessorBase):
 
         if user_data['lang'] and user_data['lang'].lower() in PaymentProcessor._ACCEPTED_LANGS:
             params['lang'] = user_data['lang'].lower()
-        elif PaymentProcessor.get_backend_setting('lang', False) and \
-             PaymentProcessor.get_backend_setting('lang').lower() in PaymentProcessor._ACCEPTED_LANGS:
-            params['lang'] = PaymentProcessor.get_backend_setting('lang').lower()
+        elif config.lang and config.lang.lower() in PaymentProcessor._ACCEPTED_LANGS:
+            params['lang'] = config.lang.lower()
 
-        if PaymentProcessor.get_backend_setting('onlinetransfer', False):
+        if config.onlinetransfer:
             params['onlinetransfer'] = 1
-        if PaymentProcessor.get_backend_setting('p_email', False):
-            params['p_email'] = PaymentProcessor.get_backend_setting('p_email')
-        if PaymentProcessor.get_backend_setting('p_info', False):
-            params['p_info'] = PaymentProcessor.get_backend_setting('p_info')
-        if PaymentProcessor.get_backend_setting('tax', False):
+        if config.p_email:
+            params['p_email'] = config.p_email
+        if config.p_info:
+            params['p_info'] = config.p_info
+        if config.tax:
             params['tax'] = 1
 
 
-        if PaymentProcessor.get_backend_setting('method', 'get').lower() == 'post':
-            return self._GATEWAY_URL , 'POST', params
-        elif PaymentProcessor.get_backend_setting('method', 'get').lower() == 'get':
+        gateway_url = config.get('gateway_url') or self._GATEWAY_URL
+        method = config.method.lower()
+        if method == 'post':
+            return gateway_url, 'POST', params
+        elif method == 'get':
             for key in params.keys():
                 params[key] = unicode(params[key]).encode('utf-8')
-            return self._GATEWAY_URL + '?' + urllib.urlencode(params), "GET", {}
+            return gateway_url + '?' + urllib.urlencode(params), "GET", {}
         else:
             raise ImproperlyConfigured('Dotpay payment backend accepts only GET or POST')
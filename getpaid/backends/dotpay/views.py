@@ -2,6 +2,8 @@ import logging
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
 from django.views.generic.base import View
+from getpaid import metrics
+from getpaid.dispatch import notification_transaction
 from django.views.generic.detail import DetailView
 from getpaid.backends.dotpay import PaymentProcessor
 from getpaid.models import Payment
@@ -43,7 +45,8 @@ class OnlineView(View):
 
 
 
-        status = PaymentProcessor.online(params, ip=request.META['REMOTE_ADDR'])
+        with metrics.timed('getpaid_online_seconds', backend=PaymentProcessor.BACKEND), notification_transaction():
+            status = PaymentProcessor.online(params, ip=request.META['REMOTE_ADDR'])
         return HttpResponse(status)
 
 class ReturnView(DetailView):
@@ -0,0 +1,220 @@
+"""
+HTTP client used by backends to call payment gateway APIs.
+"""
+from StringIO import StringIO
+import httplib
+import logging
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+from django.conf import settings
+from django.test.signals import setting_changed
+from getpaid import metrics
+
+logger = logging.getLogger('getpaid.backends.httpclient')
+
+DEFAULT_SETTINGS = {
+    'connect_timeout': 5,
+    'read_timeout': 30,
+    'retries': 2,
+    'pool_size': 4,
+}
+
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+
+class HTTPError(IOError):
+    pass
+
+
+def _closed_without_response(error):
+    """
+    Returns ``True`` if the gateway closed the connection without sending any byte of a response.
+    """
+    if not isinstance(error, httplib.BadStatusLine):
+        return False
+    line = error.line.strip("'")
+    return not line or line.startswith('No status line received')
+
+
+class Response(object):
+    """
+    Response read in whole from a gateway; the body can be also read like a file.
+    """
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self._file = StringIO(body)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+
+class HostStats(object):
+    """
+    Latency of calls made to one gateway host, in seconds.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed, error=False):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+    @property
+    def average_time(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+class HTTPClient(object):
+    """
+    Keeps a pool of keep-alive connections per gateway host (``scheme, host, port``).
+
+    Every call connects with ``connect_timeout`` and then waits at most ``read_timeout`` for data. A call is
+    retried (at most ``retries`` times) only when the request could not have reached the gateway: connecting or
+    sending failed, or a pooled connection turned out to be closed by the gateway without any response. Other
+    errors of a reused connection after the request was sent (e.g. connection reset while reading the response)
+    are retried only for idempotent methods, as a POST could have been processed already.
+    Latency of every call is recorded per host in ``stats``.
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=30, retries=2, pool_size=4):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.stats = {}
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _get_connection(self, host_key):
+        with self._lock:
+            pool = self._pools.get(host_key)
+            if pool:
+                return pool.pop(), True
+        scheme, host, port = host_key
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        connection = connection_class(host, port, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
+
+    def _release_connection(self, host_key, connection):
+        with self._lock:
+            pool = self._pools.setdefault(host_key, [])
+            if len(pool) < self.pool_size:
+                pool.append(connection)
+                return
+        connection.close()
+
+    def _record(self, host_key, elapsed, error=False):
+        with self._lock:
+            stats = self.stats.get(host_key[1])
+            if stats is None:
+                stats = self.stats[host_key[1]] = HostStats()
+            stats.record(elapsed, error)
+        metrics.observe('getpaid_gateway_request_seconds', elapsed, host=host_key[1],
+                        outcome='error' if error else 'ok')
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Sends request and returns ``Response``. Raises ``HTTPError`` if the gateway could not be reached,
+        did not respond in time or responded with an error status.
+        """
+        parts = urlparse.urlsplit(url)
+        host_key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or {})
+        attempt = 0
+        start = time.time()
+        while True:
+            connection, reused = None, False
+            sent = False
+            try:
+                connection, reused = self._get_connection(host_key)
+                connection.request(method, path, body, headers)
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+            except (socket.error, httplib.HTTPException), e:
+                if connection is not None:
+                    connection.close()
+                stale = reused and not isinstance(e, socket.timeout) and (
+                    _closed_without_response(e) or method.upper() in IDEMPOTENT_METHODS
+                    and isinstance(e, (httplib.BadStatusLine, socket.error)))
+                if attempt < self.retries and (not sent or stale):
+                    attempt += 1
+                    logger.debug('Retrying %s %s after %r', method, url, e)
+                    continue
+                self._record(host_key, time.time() - start, error=True)
+                raise HTTPError('%s %s failed: %r' % (method, url, e))
+            break
+        elapsed = time.time() - start
+        self._record(host_key, elapsed)
+        logger.debug('%s %s: %d in %.3fs', method, url, response.status, elapsed)
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(host_key, connection)
+        if response.status >= 400:
+            raise HTTPError('%s %s failed: %d %s' % (method, url, response.status, response.reason))
+        return Response(response.status, response.reason, dict(response.getheaders()), data)
+
+    def post(self, url, data, headers=None):
+        """
+        Posts ``data``, which is a string or dict of params to be URL encoded.
+        """
+        headers = dict(headers or {})
+        if isinstance(data, dict):
+            data = urllib.urlencode(data)
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        return self.request('POST', url, data, headers)
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for connection in pool:
+                connection.close()
+
+
+_client = None
+
+
+def get_http_client():
+    """
+    Returns HTTP client shared by all backends, configured with ``GETPAID_HTTP_CLIENT`` setting.
+    """
+    global _client
+    if _client is None:
+        options = dict(DEFAULT_SETTINGS)
+        options.update(getattr(settings, 'GETPAID_HTTP_CLIENT', {}))
+        _client = HTTPClient(**options)
+    return _client
+
+
+def reset_http_client(**kwargs):
+    global _client
+    if kwargs.get('setting', 'GETPAID_HTTP_CLIENT') == 'GETPAID_HTTP_CLIENT':
+        if _client is not None:
+            _client.close()
+        _client = None
+
+setting_changed.connect(reset_http_client)
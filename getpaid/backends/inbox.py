@@ -0,0 +1,140 @@
+"""
+Inbox of verified notifications processed after the gateway got its answer.
+
+Backends with ``deferred`` setting enabled only verify a notification, append it to ``InboxNotification`` table
+and acknowledge it at once. Loading the payment, changing its status and running ``payment_status_changed``
+receivers happen later in ``process_inbox()``, which calls backend ``online()`` again with the same arguments.
+Notifications of one payment are processed one at a time, in the order they were received. A notification that
+failed ``max_attempts`` times is given up: it is marked processed with ``failed_on`` set, so later notifications
+of its payment are not blocked.
+"""
+from multiprocessing.pool import ThreadPool
+import json
+import logging
+import threading
+import traceback
+
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django.db.models.loading import get_model
+from django.utils import timezone
+from getpaid.dispatch import notification_transaction
+from getpaid.registry import get_registry
+
+logger = logging.getLogger('getpaid.backends.inbox')
+
+_LOCK_KEY = 'getpaid.inbox.payment:%s:%s'
+LOCK_TIMEOUT = 300
+MAX_ATTEMPTS = 5
+
+_state = threading.local()
+
+
+def defer_notification(processor, payment_id, response, *args, **kwargs):
+    """
+    Appends notification to the inbox if backend of ``processor`` has ``deferred`` setting enabled, and returns
+    ``response`` that acknowledges it. ``args`` and ``kwargs`` are what ``online()`` should be called with.
+
+    Returns ``None`` if the notification should be processed at once: the backend is not deferred, the inbox
+    is being processed right now or ``payment_id`` is malformed (so the gateway gets an error immediately).
+    """
+    if getattr(_state, 'processing', False) or not processor.get_backend_config().get('deferred', False):
+        return None
+    try:
+        payment_id = int(payment_id)
+    except (TypeError, ValueError):
+        return None
+    InboxNotification = get_model('getpaid', 'InboxNotification')
+    InboxNotification.objects.create(backend=processor.BACKEND, payment_id=payment_id,
+                                     payload=json.dumps({'args': args, 'kwargs': kwargs}))
+    return response
+
+
+def _process_payment(backend, payment_id, max_attempts=MAX_ATTEMPTS):
+    """
+    Processes pending notifications of one payment and returns tuple of numbers of processed ones and errors.
+    Processing stops at the first failing notification, so the later ones are not applied before it, unless the
+    notification failed ``max_attempts`` times and is given up.
+    """
+    lock = _LOCK_KEY % (backend, payment_id)
+    if not cache.add(lock, 1, LOCK_TIMEOUT):
+        # Another worker processes this payment
+        return 0, 0
+    InboxNotification = get_model('getpaid', 'InboxNotification')
+    processed = errors = 0
+    try:
+        processor = get_registry().get_processor(backend)
+        for notification in InboxNotification.objects.filter(backend=backend, payment_id=payment_id,
+                                                             processed_on=None):
+            payload = json.loads(notification.payload)
+            kwargs = dict((str(key), value) for key, value in payload['kwargs'].items())
+            _state.processing = True
+            try:
+                with notification_transaction(atomic=True):
+                    response = processor.online(*payload['args'], **kwargs)
+                    InboxNotification.objects.filter(pk=notification.pk).update(
+                        processed_on=timezone.now(), response=response, attempts=F('attempts') + 1)
+            except Exception:
+                logger.exception('Processing notification #%d failed' % notification.pk)
+                errors += 1
+                if notification.attempts + 1 < max_attempts:
+                    InboxNotification.objects.filter(pk=notification.pk).update(
+                        error=traceback.format_exc(), attempts=F('attempts') + 1)
+                    return processed, errors
+                logger.error('Notification #%d failed %d times, giving up' % (notification.pk, max_attempts))
+                now = timezone.now()
+                InboxNotification.objects.filter(pk=notification.pk).update(
+                    error=traceback.format_exc(), attempts=F('attempts') + 1, processed_on=now, failed_on=now)
+                continue
+            finally:
+                _state.processing = False
+            processed += 1
+    finally:
+        cache.delete(lock)
+    return processed, errors
+
+
+def _process_payment_in_thread(args):
+    try:
+        return _process_payment(*args)
+    finally:
+        # Django opens a connection for every thread
+        connection.close()
+
+
+def process_inbox(backend=None, workers=4, limit=1000, max_attempts=MAX_ATTEMPTS):
+    """
+    Processes pending notifications of at most ``limit`` payments, optionally only of given ``backend``.
+    Payments are processed concurrently in ``workers`` threads, or in the calling thread if ``workers`` is 1.
+    Notifications that failed ``max_attempts`` times are given up.
+
+    Returns dict with number of ``payments``, ``processed`` notifications and ``errors``.
+    """
+    InboxNotification = get_model('getpaid', 'InboxNotification')
+    pending = InboxNotification.objects.filter(processed_on=None)
+    if backend is not None:
+        pending = pending.filter(backend=backend)
+    payments, seen = [], set()
+    for payment in pending.values_list('backend', 'payment_id').iterator():
+        if payment not in seen:
+            seen.add(payment)
+            payments.append(payment)
+            if len(payments) == limit:
+                break
+
+    if workers > 1 and len(payments) > 1:
+        pool = ThreadPool(min(workers, len(payments)))
+        try:
+            results = pool.map(_process_payment_in_thread,
+                               [(backend, payment_id, max_attempts) for backend, payment_id in payments])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_process_payment(backend, payment_id, max_attempts) for backend, payment_id in payments]
+    return {
+        'payments': len(payments),
+        'processed': sum(processed for processed, errors in results),
+        'errors': sum(errors for processed, errors in results),
+    }
@@ -0,0 +1,112 @@
+"""
+Ledger of notifications that were already processed.
+
+Payment brokers repeat a notification until they receive the expected answer, and they also retry answered
+notifications whenever the answer got lost on the way. Every acknowledged notification is stored under
+``(backend, transaction id, payload hash)``, so its repeated deliveries are answered with the original response
+without verifying and processing them again.
+"""
+from collections import OrderedDict
+import hashlib
+import threading
+
+from django.db import IntegrityError, transaction
+from django.db.models.loading import get_model
+
+
+def hash_payload(payload):
+    """
+    Returns MD5 hex digest of ``payload``, which is a dict of notification params or a raw notification string.
+    """
+    if isinstance(payload, dict):
+        payload = u'&'.join([u'%s=%s' % (key, payload[key]) for key in sorted(payload)])
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    return hashlib.md5(payload).hexdigest()
+
+
+class NotificationLedger(object):
+    """
+    Processed notifications stored in ``ProcessedNotification`` table, with an in-process LRU cache of ``size``
+    most recent ones in front of it.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, response):
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = response
+            if len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+    def get(self, key):
+        """
+        Returns response given to notification with ``key``, or ``None`` if it was not processed yet.
+        """
+        with self._lock:
+            response = self._cache.pop(key, None)
+            if response is not None:
+                self._cache[key] = response
+                return response
+        backend, transaction_id, payload_hash = key
+        ProcessedNotification = get_model('getpaid', 'ProcessedNotification')
+        responses = list(ProcessedNotification.objects.filter(
+            backend=backend, transaction_id=transaction_id, payload_hash=payload_hash
+        ).values_list('response', flat=True)[:1])
+        if responses:
+            self._remember(key, responses[0])
+            return responses[0]
+
+    def put(self, key, response):
+        backend, transaction_id, payload_hash = key
+        ProcessedNotification = get_model('getpaid', 'ProcessedNotification')
+        sid = transaction.savepoint()
+        try:
+            ProcessedNotification.objects.create(backend=backend, transaction_id=transaction_id,
+                                                 payload_hash=payload_hash, response=response)
+        except IntegrityError:
+            # The same notification was processed concurrently
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
+        self._remember(key, response)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+ledger = NotificationLedger()
+
+
+class Notification(object):
+    """
+    Notification received by a backend::
+
+        notification = Notification(PaymentProcessor.BACKEND, params['t_id'], params)
+        response = notification.get_response()
+        if response is not None:
+            return response     # already processed
+        ...
+        return notification.acknowledge('OK')
+    """
+
+    def __init__(self, backend, transaction_id, payload):
+        self.key = (backend, unicode(transaction_id)[:100], hash_payload(payload))
+
+    def get_response(self):
+        """
+        Returns response given when the notification was processed before, or ``None``.
+        """
+        return ledger.get(self.key)
+
+    def acknowledge(self, response):
+        """
+        Records the notification as processed with ``response`` and returns the response.
+        """
+        ledger.put(self.key, response)
+        return response
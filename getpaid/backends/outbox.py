@@ -0,0 +1,90 @@
+"""
+Transactional outbox of celery task calls.
+
+With ``GETPAID_OUTBOX`` setting enabled, ``enqueue()`` does not talk to the celery broker but stores the call in
+``OutboxMessage`` table, in the transaction of the caller: the task is sent only if the notification handler
+commits, and a slow broker does not slow down the answer to the payment gateway. ``relay_outbox()`` sends stored
+calls to the broker in batches. A call is marked sent after the broker accepted it, so it is sent at least once;
+tasks must be safe to run twice.
+"""
+from datetime import timedelta
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.loading import get_model
+from django.utils import timezone
+
+logger = logging.getLogger('getpaid.backends.outbox')
+
+_RELAY_LOCK_KEY = 'getpaid.outbox.relay'
+RELAY_LOCK_TIMEOUT = 300
+
+
+def enqueue(task, args=(), kwargs=None, countdown=None):
+    """
+    Calls celery ``task`` with ``args`` and ``kwargs`` (after ``countdown`` seconds, if given), through the outbox
+    if ``GETPAID_OUTBOX`` setting is enabled or directly otherwise.
+    """
+    kwargs = kwargs or {}
+    if not getattr(settings, 'GETPAID_OUTBOX', False):
+        if countdown:
+            task.apply_async(args, kwargs, countdown=countdown)
+        else:
+            task.delay(*args, **kwargs)
+        return
+    eta = timezone.now() + timedelta(seconds=countdown) if countdown else None
+    OutboxMessage = get_model('getpaid', 'OutboxMessage')
+    OutboxMessage.objects.create(task=task.name, eta=eta,
+                                 payload=json.dumps({'args': list(args), 'kwargs': kwargs}))
+
+
+def _send(message):
+    from celery import current_app
+    payload = json.loads(message.payload)
+    args = payload['args']
+    kwargs = dict((str(key), value) for key, value in payload['kwargs'].items())
+    try:
+        task = current_app.tasks[message.task]
+    except KeyError:
+        # task is not registered in this process, the broker routes it by name
+        current_app.send_task(message.task, args, kwargs, eta=message.eta)
+    else:
+        task.apply_async(args, kwargs, eta=message.eta)
+
+
+def relay_outbox(batch_size=100):
+    """
+    Sends stored task calls to the celery broker, ``batch_size`` of them at once, until the outbox is empty or
+    the broker fails. Only one relay runs at a time.
+
+    Returns dict with number of ``sent`` calls and ``errors``.
+    """
+    summary = {'sent': 0, 'errors': 0}
+    if not cache.add(_RELAY_LOCK_KEY, 1, RELAY_LOCK_TIMEOUT):
+        logger.debug('Outbox is already being relayed')
+        return summary
+    OutboxMessage = get_model('getpaid', 'OutboxMessage')
+    try:
+        while True:
+            messages = list(OutboxMessage.objects.filter(sent_on=None)[:batch_size])
+            sent = []
+            try:
+                for message in messages:
+                    _send(message)
+                    sent.append(message.pk)
+            except Exception:
+                logger.exception('Sending task %s failed' % message.task)
+                OutboxMessage.objects.filter(pk=message.pk).update(attempts=F('attempts') + 1)
+                summary['errors'] += 1
+            finally:
+                if sent:
+                    OutboxMessage.objects.filter(pk__in=sent).update(sent_on=timezone.now(),
+                                                                     attempts=F('attempts') + 1)
+                    summary['sent'] += len(sent)
+            if summary['errors'] or len(messages) < batch_size:
+                return summary
+    finally:
+        cache.delete(_RELAY_LOCK_KEY)
@@ -1,7 +1,6 @@
 from datetime import datetime
 from decimal import Decimal
 import logging
-import hashlib
 import urllib
 
 from django.core.exceptions import ImproperlyConfigured
@@ -10,6 +9,10 @@ from django.utils.timezone import utc
 from django.utils.translation import ugettext_lazy as _
 from getpaid import signals
 from getpaid.backends import PaymentProcessorBase
+from getpaid.backends.inbox import defer_notification
+from getpaid.backends.ledger import Notification
+from getpaid.backends.signing import Signature
+from getpaid.backends.xmlwriter import XMLTemplate
 
 import forms
 
@@ -29,14 +32,35 @@ class PaymentProcessor(PaymentProcessorBase):
     _PAY_SIG_FIELDS = ('id', 'transaction_id', 'operation_id', 'amount', 'currency_code', 'test_mode')
     _CHECK_SIG_FIELDS = ('command', ) + _PAY_SIG_FIELDS
     _CHECK_ANSWER_SIG_FIELDS = ('result_code', 'id', 'transaction_id')
+    _PAY_FORM_SIG = Signature(_PAY_FORM_SIG_FIELDS)
+    _CHECK_SIG = Signature(_CHECK_SIG_FIELDS, name='payanyway.check')
+    _CHECK_ANSWER_SIG = Signature(_CHECK_ANSWER_SIG_FIELDS)
+
+    _CHECK_RESPONSE = XMLTemplate(u'''<?xml version="1.0" encoding="UTF-8"?>
+            <MNT_RESPONSE>
+                    <MNT_ID>{id}</MNT_ID>
+                    <MNT_TRANSACTION_ID>{transaction_id}</MNT_TRANSACTION_ID>
+                    <MNT_RESULT_CODE>{result_code}</MNT_RESULT_CODE>
+                    <MNT_DESCRIPTION>{description}</MNT_DESCRIPTION>
+                    <MNT_AMOUNT>{amount}</MNT_AMOUNT>
+                    <MNT_SIGNATURE>{signature}</MNT_SIGNATURE>
+                    <MNT_ATTRIBUTES>
+                        <ATTRIBUTE>
+                            <KEY></KEY>
+                            <VALUE></VALUE>
+                        </ATTRIBUTE>
+                    </MNT_ATTRIBUTES>
+            </MNT_RESPONSE>
+        ''')
+
+    BACKEND_REQUIRED_SETTINGS = ('id', 'key', 'currency', 'testing', 'demo')
+    BACKEND_DEFAULT_SETTINGS = {
+        'method': 'get',
+    }
 
     @staticmethod
     def compute_sig(params, fields, key):
-        text = ''
-        for field in fields:
-            text += unicode(params.get(field, '')).encode('utf-8')
-        text += key
-        return hashlib.md5(text).hexdigest()
+        return Signature(fields).compute(params, key)
 
     @staticmethod
     def check(payment, **params):
@@ -54,38 +78,32 @@ class PaymentProcessor(PaymentProcessorBase):
         logger.debug('Result code: %s', params['result_code'])
 
         # Send answer
-        key = PaymentProcessor.get_backend_setting('key')
-        if bool(PaymentProcessor.get_backend_setting('demo')):
-            key = PaymentProcessor.get_backend_setting('demo_key')
+        config = PaymentProcessor.get_backend_config()
+        key = config.key
+        if bool(config.demo):
+            key = config.demo_key
         params['description'] = payment.status
-        params['signature'] = PaymentProcessor.compute_sig(params, PaymentProcessor._CHECK_ANSWER_SIG_FIELDS, key)
-        return \
-        '''<?xml version="1.0" encoding="UTF-8"?>
-            <MNT_RESPONSE>
-                    <MNT_ID>%(id)s</MNT_ID>
-                    <MNT_TRANSACTION_ID>%(transaction_id)s</MNT_TRANSACTION_ID>
-                    <MNT_RESULT_CODE>%(result_code)s</MNT_RESULT_CODE>
-                    <MNT_DESCRIPTION>%(description)s</MNT_DESCRIPTION>
-                    <MNT_AMOUNT>%(amount)s</MNT_AMOUNT>
-                    <MNT_SIGNATURE>%(signature)s</MNT_SIGNATURE>
-                    <MNT_ATTRIBUTES>
-                        <ATTRIBUTE>
-                            <KEY></KEY>
-                            <VALUE></VALUE>
-                        </ATTRIBUTE>
-                    </MNT_ATTRIBUTES>
-            </MNT_RESPONSE>
-        ''' % params
+        params['signature'] = PaymentProcessor._CHECK_ANSWER_SIG.compute(params, key)
+        return PaymentProcessor._CHECK_RESPONSE.render(params)
 
     @staticmethod
     def online(**params):
-        id = PaymentProcessor.get_backend_setting('id')
-        key = PaymentProcessor.get_backend_setting('key')
-        if bool(PaymentProcessor.get_backend_setting('demo')):
-            id = PaymentProcessor.get_backend_setting('demo_id')
-            key = PaymentProcessor.get_backend_setting('demo_key')
-
-        if params['signature'] != PaymentProcessor.compute_sig(params, PaymentProcessor._CHECK_SIG_FIELDS, key):
+        config = PaymentProcessor.get_backend_config()
+        id = config.id
+        key = config.key
+        if bool(config.demo):
+            id = config.demo_id
+            key = config.demo_key
+
+        # CHECK requests only query the payment, so they are answered every time
+        notification = None
+        if params.get('command') != 'CHECK':
+            notification = Notification(PaymentProcessor.BACKEND, params.get('operation_id', ''), params)
+            response = notification.get_response()
+            if response is not None:
+                return response
+
+        if not PaymentProcessor._CHECK_SIG.verify(params, key, params['signature']):
             logger.warning('Got message with wrong sig, %s' % str(params))
             return 'FAIL SIG ERR'
 
@@ -93,6 +111,11 @@ class PaymentProcessor(PaymentProcessorBase):
             logger.warning('Got message with wrong id, %s' % str(params))
             return 'FAIL ID ERR'
 
+        if notification is not None:
+            response = defer_notification(PaymentProcessor, params['transaction_id'], 'SUCCESS', **params)
+            if response is not None:
+                return response
+
         Payment = get_model('getpaid', 'Payment')
         try:
             payment = Payment.objects.get(pk=int(params['transaction_id']))
@@ -103,29 +126,31 @@ class PaymentProcessor(PaymentProcessorBase):
         if params['command'] == 'CHECK':
             return PaymentProcessor.check(payment, **params)
         elif payment and params['amount']:
-            payment.amount_paid = Decimal(params['amount'])
-            payment.paid_on = datetime.utcnow().replace(tzinfo=utc)
+            amount_paid = Decimal(params['amount'])
+            paid_on = datetime.utcnow().replace(tzinfo=utc)
             if payment.amount <= Decimal(params['amount']):
                 # Amount is correct or it is overpaid
-                payment.change_status('paid')
+                payment.change_status('paid', amount_paid=amount_paid, paid_on=paid_on)
             else:
-                payment.change_status('partially_paid')
-            return 'SUCCESS'
+                payment.change_status('partially_paid', amount_paid=amount_paid, paid_on=paid_on)
+            return notification.acknowledge('SUCCESS')
         elif payment.status != 'paid':
             payment.change_status('failed')
         return 'FAIL'
 
     def get_gateway_url(self, request):
-        id = PaymentProcessor.get_backend_setting('id')
-        key = PaymentProcessor.get_backend_setting('key')
-        currency = PaymentProcessor.get_backend_setting('currency')
-        testing = bool(PaymentProcessor.get_backend_setting('testing'))
+        config = PaymentProcessor.get_backend_config()
+        id = config.id
+        key = config.key
+        currency = config.currency
+        testing = bool(config.testing)
 
         gateway_url = self._GATEWAY_URL
-        if bool(PaymentProcessor.get_backend_setting('demo')):
+        if bool(config.demo):
             gateway_url = self._GATEWAY_URL_FOR_DEMO
-            id = PaymentProcessor.get_backend_setting('demo_id')
-            key = PaymentProcessor.get_backend_setting('demo_key')
+            id = config.demo_id
+            key = config.demo_key
+        gateway_url = config.get('gateway_url') or gateway_url
 
         user_data = {
             'lang': None,
@@ -144,11 +169,12 @@ class PaymentProcessor(PaymentProcessorBase):
             'MNT_TEST_MODE': '1' if testing else '0',
         }
         params.update(addition_user_data)
-        params['MNT_SIGNATURE'] = self.compute_sig(params, PaymentProcessor._PAY_FORM_SIG_FIELDS, key)
+        params['MNT_SIGNATURE'] = PaymentProcessor._PAY_FORM_SIG.compute(params, key)
 
-        if PaymentProcessor.get_backend_setting('method', 'get').lower() == 'post':
+        method = config.method.lower()
+        if method == 'post':
             return gateway_url, 'POST', params
-        elif PaymentProcessor.get_backend_setting('method', 'get').lower() == 'get':
+        elif method == 'get':
             for key in params.keys():
                 params[key] = unicode(params[key]).encode('utf-8')
             return gateway_url + '?' + urllib.urlencode(params), 'GET', {}
@@ -4,6 +4,8 @@ import logging
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
 from django.views.generic.base import View
+from getpaid import metrics
+from getpaid.dispatch import notification_transaction
 from django.views.generic.detail import DetailView
 from getpaid.backends.payanyway import PaymentProcessor
 from getpaid.models import Payment
@@ -36,10 +38,11 @@ class OnlineView(View):
             logger.warning('Got malformed POST request: %s' % str(request.POST))
             return HttpResponse('FAIL')
 
-        status = PaymentProcessor.online(command=command, id=id, transaction_id=transaction_id,
-                                         operation_id=operation_id, amount=amount,
-                                         currency_code=currency_code, test_mode=test_mode, signature=signature,
-                                         user=user, payment_system=payment_system, corraccount=corraccount)
+        with metrics.timed('getpaid_online_seconds', backend=PaymentProcessor.BACKEND), notification_transaction():
+            status = PaymentProcessor.online(command=command, id=id, transaction_id=transaction_id,
+                                             operation_id=operation_id, amount=amount,
+                                             currency_code=currency_code, test_mode=test_mode, signature=signature,
+                                             user=user, payment_system=payment_system, corraccount=corraccount)
         return HttpResponse(status)
 
 
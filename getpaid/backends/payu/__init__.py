@@ -1,11 +1,11 @@
 import datetime
 from decimal import Decimal
-import hashlib
+from functools import partial
 import logging
 import urllib
-import urllib2
-from xml.dom.minidom import parseString, Node
+from xml.parsers.expat import ExpatError
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models.loading import get_model
 from django.template.base import Template
 from django.template.context import Context
 from django.utils.timezone import utc
@@ -13,7 +13,13 @@ from django.utils.translation import ugettext_lazy as _
 import time
 from getpaid import signals
 from getpaid.backends import PaymentProcessorBase
+from getpaid.backends.httpclient import get_http_client
+from getpaid.backends.outbox import enqueue
+from getpaid.backends.signing import Signature
+from getpaid.dispatch import on_rollback
+from getpaid.backends.payu.coalescing import claim_poll, release_poll
 from getpaid.backends.payu.tasks import get_payment_status_task
+from getpaid.backends.payu.xml_parsing import TransParser
 
 logger = logging.getLogger('getpaid.backends.payu')
 
@@ -43,23 +49,39 @@ class PaymentProcessor(PaymentProcessorBase):
     _ONLINE_SIG_FIELDS = ('pos_id', 'session_id', 'ts',)
     _GET_SIG_FIELDS =  ('pos_id', 'session_id', 'ts',)
     _GET_RESPONSE_SIG_FIELDS =  ('pos_id', 'session_id', 'order_id', 'status', 'amount', 'desc', 'ts',)
+    _REQUEST_SIG = Signature(_REQUEST_SIG_FIELDS)
+    _ONLINE_SIG = Signature(_ONLINE_SIG_FIELDS, name='payu.online')
+    _GET_SIG = Signature(_GET_SIG_FIELDS)
+    _GET_RESPONSE_SIG = Signature(_GET_RESPONSE_SIG_FIELDS, name='payu.get_response')
+    _GET_RESPONSE_FIELDS = _GET_RESPONSE_SIG_FIELDS + ('sig',)
+
+    BACKEND_REQUIRED_SETTINGS = ('pos_id', 'pos_auth_key', 'key1', 'key2')
+    BACKEND_DEFAULT_SETTINGS = {
+        'lang': None,
+        'signing': True,
+        'testing': False,
+        'method': 'get',
+        'poll_window': 0,
+        'polling': False,
+    }
+
+    @staticmethod
+    def get_gateway_base_url():
+        """
+        Returns base URL of PayU gateway, which is replaced by ``gateway_url`` setting (e.g. of a simulator).
+        """
+        return PaymentProcessor.get_backend_config().get('gateway_url') or PaymentProcessor._GATEWAY_URL
 
     @staticmethod
     def compute_sig(params, fields, key):
-        text = ''
-        for field in fields:
-            text += unicode(params.get(field, '')).encode('utf-8')
-        text += key
-        return hashlib.md5(text).hexdigest()
+        return Signature(fields).compute(params, key)
 
     @staticmethod
     def online(pos_id, session_id, ts, sig):
         params = {'pos_id' : pos_id, 'session_id': session_id, 'ts': ts, 'sig': sig}
 
-
-
-        key2 = PaymentProcessor.get_backend_setting('key2')
-        if sig != PaymentProcessor.compute_sig(params, PaymentProcessor._ONLINE_SIG_FIELDS, key2):
+        config = PaymentProcessor.get_backend_config()
+        if not PaymentProcessor._ONLINE_SIG.verify(params, config.key2, sig):
             logger.warning('Got message with wrong sig, %s' % str(params))
             return 'SIG ERR'
 
@@ -67,7 +89,7 @@ class PaymentProcessor(PaymentProcessorBase):
             params['pos_id'] = int(params['pos_id'])
         except ValueError:
             return 'POS_ID ERR'
-        if params['pos_id'] != int(PaymentProcessor.get_backend_setting('pos_id')):
+        if params['pos_id'] != int(config.pos_id):
             return 'POS_ID ERR'
 
         try:
@@ -76,7 +98,15 @@ class PaymentProcessor(PaymentProcessorBase):
             logger.warning('Got message with wrong session_id, %s' % str(params))
             return 'SESSION_ID ERR'
 
-        get_payment_status_task.delay(payment_id, session_id)
+        window = config.poll_window
+        if not window:
+            enqueue(get_payment_status_task, (payment_id, session_id))
+        elif claim_poll(session_id, window):
+            # if the notification is rolled back, so is the poll stored in the outbox
+            on_rollback(partial(release_poll, session_id))
+            enqueue(get_payment_status_task, (payment_id, session_id), countdown=window)
+        else:
+            logger.debug('Poll of session_id=%s is already pending' % session_id)
         return 'OK'
 
     def get_gateway_url(self, request):
@@ -84,9 +114,10 @@ class PaymentProcessor(PaymentProcessorBase):
         Routes a payment to Gateway, should return URL for redirection.
 
         """
+        config = PaymentProcessor.get_backend_config()
         params = {
-            'pos_id': PaymentProcessor.get_backend_setting('pos_id'),
-            'pos_auth_key': PaymentProcessor.get_backend_setting('pos_auth_key'),
+            'pos_id': config.pos_id,
+            'pos_auth_key': config.pos_auth_key,
             'desc': self.get_order_description(self.payment, self.payment.order),
 
         }
@@ -102,16 +133,10 @@ class PaymentProcessor(PaymentProcessorBase):
 
         if user_data['lang'] and user_data['lang'].lower() in PaymentProcessor._ACCEPTED_LANGS:
             params['language'] = user_data['lang'].lower()
-        elif PaymentProcessor.get_backend_setting('lang', False) and\
-                PaymentProcessor.get_backend_setting('lang').lower() in PaymentProcessor._ACCEPTED_LANGS:
-            params['language'] = PaymentProcessor.get_backend_setting('lang').lower()
-
-        key1 = PaymentProcessor.get_backend_setting('key1')
+        elif config.lang and config.lang.lower() in PaymentProcessor._ACCEPTED_LANGS:
+            params['language'] = config.lang.lower()
 
-        signing = PaymentProcessor.get_backend_setting('signing', True)
-        testing = PaymentProcessor.get_backend_setting('testing', False)
-
-        if testing:
+        if config.testing:
             # Switch to testing mode, where payment method is set to "test payment"->"t"
             # Warning: testing mode need to be enabled also in payu.pl system for this POS
             params['pay_type'] = 't'
@@ -123,65 +148,78 @@ class PaymentProcessor(PaymentProcessorBase):
         params['amount'] = int(self.payment.amount * 100)
 
         params['session_id'] = "%d:%s" % (self.payment.pk, str(time.time()))
+        if config.polling:
+            # Remember the session, so status of the payment can be polled later
+            get_model('payu', 'PaymentSession').objects.create(payment=self.payment, session_id=params['session_id'])
 
         #Warning: please make sure that this header actually has client IP
         #         rather then web server proxy IP in your WSGI environment
         params['client_ip'] = request.META['REMOTE_ADDR']
 
 
-        if signing:
+        if config.signing:
             params['ts'] = time.time()
-            params['sig'] = PaymentProcessor.compute_sig(params, self._REQUEST_SIG_FIELDS, key1)
+            params['sig'] = self._REQUEST_SIG.compute(params, config.key1)
 
-        if PaymentProcessor.get_backend_setting('method', 'get').lower() == 'post':
-            return self._GATEWAY_URL + 'UTF/NewPayment', 'POST', params
-        elif PaymentProcessor.get_backend_setting('method', 'get').lower() == 'get':
+        method = config.method.lower()
+        if method == 'post':
+            return self.get_gateway_base_url() + 'UTF/NewPayment', 'POST', params
+        elif method == 'get':
             for key in params.keys():
                 params[key] = unicode(params[key]).encode('utf-8')
-            return self._GATEWAY_URL + 'UTF/NewPayment?' + urllib.urlencode(params), 'GET', {}
+            return self.get_gateway_base_url() + 'UTF/NewPayment?' + urllib.urlencode(params), 'GET', {}
         else:
             raise ImproperlyConfigured('PayU payment backend accepts only GET or POST')
 
-    def get_payment_status(self, session_id):
-        params = {'pos_id': PaymentProcessor.get_backend_setting('pos_id'), 'session_id': session_id, 'ts': time.time()}
-        key1 = PaymentProcessor.get_backend_setting('key1')
-        key2 = PaymentProcessor.get_backend_setting('key2')
+    def fetch_payment_status(self, session_id):
+        """
+        Asks PayU about status of ``session_id`` transaction. Returns verified Payment/get response params,
+        or ``None`` if response is not valid. Does not touch the database.
+        """
+        config = PaymentProcessor.get_backend_config()
+        params = {'pos_id': config.pos_id, 'session_id': session_id, 'ts': time.time()}
 
-        params['sig'] = PaymentProcessor.compute_sig(params, self._GET_SIG_FIELDS, key1)
+        params['sig'] = self._GET_SIG.compute(params, config.key1)
 
         for key in params.keys():
             params[key] = unicode(params[key]).encode('utf-8')
 
-        data = urllib.urlencode(params)
-        url = self._GATEWAY_URL + 'UTF/Payment/get/xml'
-        request = urllib2.Request(url, data)
-        response = urllib2.urlopen(request)
-        xml_response = response.read()
-        xml_dom = parseString(xml_response)
-        tag_response = xml_dom.getElementsByTagName('trans')[0]
-        response_params={}
-        for tag in tag_response.childNodes:
-            if tag.nodeType == Node.ELEMENT_NODE:
-                response_params[tag.nodeName] = reduce(lambda x,y: x + y.nodeValue, tag.childNodes, u"")
-        if PaymentProcessor.compute_sig(response_params, self._GET_RESPONSE_SIG_FIELDS, key2) == response_params['sig']:
-            if not (int(response_params['pos_id']) == params['pos_id'] or int(response_params['order_id']) == self.payment.pk):
-                logger.error('Wrong pos_id and/or payment for Payment/get response data %s' % str(response_params))
-                return
-
-            status = int(response_params['status'])
-            if status == PayUTransactionStatus.FINISHED:
-                self.payment.amount_paid = Decimal(response_params['amount']) / Decimal('100')
-                self.payment.paid_on = datetime.datetime.utcnow().replace(tzinfo=utc)
-                if Decimal(response_params['amount']) / Decimal('100') >= self.payment.amount:
-                    self.payment.change_status('paid')
-                else:
-                    self.payment.change_status('partially_paid')
-            elif status in (    PayUTransactionStatus.CANCELED,
-                                PayUTransactionStatus.ERROR,
-                                PayUTransactionStatus.REJECTED,
-                                PayUTransactionStatus.REJECTED_AFTER_CANCEL):
-                self.payment.change_status('failed')
+        response = get_http_client().post(self.get_gateway_base_url() + 'UTF/Payment/get/xml', params)
+        try:
+            response_params = TransParser(self._GET_RESPONSE_FIELDS).parse(response)
+        except ExpatError, e:
+            logger.error('Malformed Payment/get response: %s' % e)
+            return
+        if response_params is None:
+            logger.error('No transaction in Payment/get response for session_id=%s' % session_id)
+            return
+        if not self._GET_RESPONSE_SIG.verify(response_params, config.key2, response_params.get('sig')):
+            logger.error('Wrong signature for Payment/get response data %s' % str(response_params))
+            return
+        if not (int(response_params['pos_id']) == params['pos_id'] or int(response_params['order_id']) == self.payment.pk):
+            logger.error('Wrong pos_id and/or payment for Payment/get response data %s' % str(response_params))
+            return
+        return response_params
 
+    def apply_payment_status(self, response_params):
+        """
+        Changes payment status according to verified Payment/get response params.
+        """
+        status = int(response_params['status'])
+        if status == PayUTransactionStatus.FINISHED:
+            amount_paid = Decimal(response_params['amount']) / Decimal('100')
+            paid_on = datetime.datetime.utcnow().replace(tzinfo=utc)
+            if Decimal(response_params['amount']) / Decimal('100') >= self.payment.amount:
+                self.payment.change_status('paid', amount_paid=amount_paid, paid_on=paid_on)
+            else:
+                self.payment.change_status('partially_paid', amount_paid=amount_paid, paid_on=paid_on)
+        elif status in (    PayUTransactionStatus.CANCELED,
+                            PayUTransactionStatus.ERROR,
+                            PayUTransactionStatus.REJECTED,
+                            PayUTransactionStatus.REJECTED_AFTER_CANCEL):
+            self.payment.change_status('failed')
 
-        else:
-            logger.error('Wrong signature for Payment/get response data %s' % str(response_params))
+    def get_payment_status(self, session_id):
+        response_params = self.fetch_payment_status(session_id)
+        if response_params is not None:
+            self.apply_payment_status(response_params)
@@ -0,0 +1,45 @@
+"""
+Coalescing of PayU notifications.
+
+PayU notifies about every change of a transaction, so a few notifications for one session can arrive within
+seconds. The first one schedules a status poll delayed by ``poll_window`` seconds; notifications for the same
+session arriving before the poll starts are covered by it and do not schedule another one. Pending polls are
+kept in Django cache, so all web processes share them. Coalescing is off unless ``poll_window`` setting is given.
+"""
+from django.core.cache import cache
+
+_PENDING_KEY = 'getpaid.payu.poll:%s'
+_SAVED_KEY = 'getpaid.payu.saved_polls'
+
+# Django 1.4 cache treats timeout None as the default timeout (300 seconds), so the counter of saved polls is kept
+# for 30 days (the longest relative timeout memcached accepts) since it was started.
+SAVED_POLLS_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def claim_poll(session_id, window):
+    """
+    Returns ``True`` if a poll of ``session_id`` should be scheduled, or ``False`` if one is already pending.
+    """
+    if cache.add(_PENDING_KEY % session_id, 1, window * 2 + 60):
+        return True
+    try:
+        cache.incr(_SAVED_KEY)
+    except ValueError:
+        cache.add(_SAVED_KEY, 0, SAVED_POLLS_TIMEOUT)
+        cache.incr(_SAVED_KEY)
+    return False
+
+
+def release_poll(session_id):
+    """
+    Called when a poll starts; notifications received from now on schedule a new poll.
+    """
+    cache.delete(_PENDING_KEY % session_id)
+
+
+def saved_polls():
+    """
+    Returns number of polls that were not scheduled thanks to coalescing, counted for ``SAVED_POLLS_TIMEOUT``
+    seconds since the first one.
+    """
+    return cache.get(_SAVED_KEY, 0)
@@ -0,0 +1,29 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db.models.loading import get_model
+from getpaid.backends.payu.polling import poll_payment_statuses
+
+
+class Command(BaseCommand):
+    args = '[session_id ...]'
+    help = 'Poll PayU for statuses of given sessions, or of all PayU payments with given status'
+    option_list = BaseCommand.option_list + (
+        make_option('--status', default='in_progress',
+                    help='Poll payments with this status if no session ids are given [default: %default]'),
+        make_option('--workers', type='int', default=8,
+                    help='Number of concurrent requests [default: %default]'),
+        make_option('--per-host', type='int', default=4, dest='per_host',
+                    help='Maximal number of concurrent requests to one PayU host [default: %default]'),
+        make_option('--batch-size', type='int', default=100, dest='batch_size',
+                    help='Number of payments updated in one transaction [default: %default]'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            targets = list(args)
+        else:
+            Payment = get_model('getpaid', 'Payment')
+            targets = Payment.objects.filter(backend='getpaid.backends.payu', status=options['status'])
+        summary = poll_payment_statuses(targets, workers=options['workers'], per_host=options['per_host'],
+                                        batch_size=options['batch_size'])
+        self.stdout.write('Polled %(polled)d sessions: %(changed)d payments changed, %(errors)d errors\n' % summary)
@@ -1,3 +1,28 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+from getpaid.abstract_mixin import AbstractMixin
+
+
+class PaymentSessionFactory(models.Model, AbstractMixin):
+    """
+    PayU session started for a payment, needed to ask PayU about status of the payment later.
+    """
+    session_id = models.CharField(_("session id"), max_length=64, unique=True)
+    created_on = models.DateTimeField(_("created on"), auto_now_add=True)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def contribute(cls, payment):
+        return {'payment': models.ForeignKey(payment, related_name='payu_sessions')}
+
+PaymentSession = None
+
 
 def build_models(payment_class):
-    return []
\ No newline at end of file
+    global PaymentSession
+
+    class PaymentSession(PaymentSessionFactory.construct(payment_class)):
+        pass
+    return [PaymentSession]
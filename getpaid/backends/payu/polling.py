@@ -0,0 +1,108 @@
+"""
+Batch polling of PayU payment statuses, e.g. for re-checking payments left ``in_progress`` after a PayU outage.
+"""
+from multiprocessing.pool import ThreadPool
+import logging
+import threading
+import urlparse
+
+from django.db import transaction
+from django.db.models.loading import get_model
+from django.db.models.query import QuerySet
+from getpaid.backends.httpclient import HTTPError
+from getpaid.backends.payu import PaymentProcessor
+from getpaid.dispatch import notification_transaction
+
+logger = logging.getLogger('getpaid.backends.payu')
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+
+def _get_host_semaphore(host, limit):
+    with _host_semaphores_lock:
+        semaphore = _host_semaphores.get((host, limit))
+        if semaphore is None:
+            semaphore = _host_semaphores[(host, limit)] = threading.BoundedSemaphore(limit)
+        return semaphore
+
+
+def get_sessions(targets):
+    """
+    Returns list of ``(payment, session_id)`` pairs for ``targets``, which is a queryset of payments (their
+    latest PayU sessions are polled, which are stored only with ``polling`` setting enabled) or a list of session
+    ids (which start with payment id).
+    """
+    Payment = get_model('getpaid', 'Payment')
+    if isinstance(targets, QuerySet):
+        PaymentSession = get_model('payu', 'PaymentSession')
+        latest = {}
+        for payment_id, session_id in PaymentSession.objects.filter(payment__in=targets)\
+                .order_by('created_on', 'pk').values_list('payment_id', 'session_id'):
+            latest[payment_id] = session_id
+        payments = Payment.objects.in_bulk(latest.keys())
+        return [(payments[payment_id], session_id) for payment_id, session_id in latest.items()]
+
+    sessions = []
+    for session_id in targets:
+        try:
+            sessions.append((int(session_id.split(':')[0]), session_id))
+        except ValueError:
+            logger.warning('Skipping malformed session_id=%s' % session_id)
+    payments = Payment.objects.in_bulk(set(payment_id for payment_id, session_id in sessions))
+    return [(payments[payment_id], session_id) for payment_id, session_id in sessions if payment_id in payments]
+
+
+def poll_payment_statuses(targets, workers=8, per_host=4, batch_size=100):
+    """
+    Polls PayU for statuses of ``targets`` (see ``get_sessions()``) and updates payments.
+
+    Payment/get requests run concurrently in a pool of ``workers`` threads, with at most ``per_host`` requests
+    to one PayU host at a time. Threads only talk to PayU; results are applied to payments in the calling
+    thread, in transactions of ``batch_size`` payments.
+
+    Returns dict with number of ``polled`` sessions, ``changed`` payments and ``errors``. A session which could
+    not be fetched or applied is counted as an error and does not stop the others.
+    """
+    sessions = get_sessions(targets)
+    semaphore = _get_host_semaphore(urlparse.urlsplit(PaymentProcessor.get_gateway_base_url()).hostname, per_host)
+
+    def fetch(session):
+        payment, session_id = session
+        with semaphore:
+            try:
+                return PaymentProcessor(payment).fetch_payment_status(session_id)
+            except HTTPError, e:
+                logger.error('Payment/get failed for session_id=%s: %s' % (session_id, e))
+            except Exception:
+                logger.exception('Payment/get failed for session_id=%s' % session_id)
+
+    summary = {'polled': len(sessions), 'changed': 0, 'errors': 0}
+    if not sessions:
+        return summary
+    pool = ThreadPool(min(workers, len(sessions)))
+    try:
+        results = pool.imap(fetch, sessions)
+        for start in range(0, len(sessions), batch_size):
+            with notification_transaction(atomic=True):
+                for payment, session_id in sessions[start:start + batch_size]:
+                    response_params = results.next()
+                    if response_params is None:
+                        summary['errors'] += 1
+                        continue
+                    old_status = payment.status
+                    savepoint = transaction.savepoint()
+                    try:
+                        PaymentProcessor(payment).apply_payment_status(response_params)
+                    except Exception:
+                        transaction.savepoint_rollback(savepoint)
+                        logger.exception('Applying Payment/get response failed for session_id=%s' % session_id)
+                        summary['errors'] += 1
+                        continue
+                    transaction.savepoint_commit(savepoint)
+                    if payment.status != old_status:
+                        summary['changed'] += 1
+    finally:
+        pool.close()
+        pool.join()
+    return summary
@@ -1,6 +1,8 @@
 import logging
 from celery.task.base import task
 from django.db.models.loading import get_model
+from getpaid.dispatch import notification_transaction
+from getpaid.backends.payu.coalescing import release_poll
 
 
 logger = logging.getLogger('getpaid.backends.payu')
@@ -8,6 +10,7 @@ logger = logging.getLogger('getpaid.backends.payu')
 
 @task
 def get_payment_status_task(payment_id, session_id):
+    release_poll(session_id)
     Payment = get_model('getpaid', 'Payment')
     try:
         payment = Payment.objects.get(pk=int(payment_id))
@@ -17,4 +20,18 @@ def get_payment_status_task(payment_id, session_id):
 
     from getpaid.backends.payu import PaymentProcessor # Avoiding circular import
     processor = PaymentProcessor(payment)
-    processor.get_payment_status(session_id)
\ No newline at end of file
+    with notification_transaction():
+        processor.get_payment_status(session_id)
+
+@task
+def poll_payment_statuses_task(session_ids=None, status='in_progress', **kwargs):
+    """
+    Polls statuses of ``session_ids`` or, if not given, of all PayU payments with ``status``.
+    """
+    from getpaid.backends.payu.polling import poll_payment_statuses # Avoiding circular import
+    if session_ids is None:
+        Payment = get_model('getpaid', 'Payment')
+        session_ids = Payment.objects.filter(backend='getpaid.backends.payu', status=status)
+    summary = poll_payment_statuses(session_ids, **kwargs)
+    logger.info('Polled %(polled)d PayU sessions: %(changed)d payments changed, %(errors)d errors' % summary)
+    return summary
@@ -2,6 +2,8 @@ import logging
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
 from django.views.generic.base import View
+from getpaid import metrics
+from getpaid.dispatch import notification_transaction
 from django.views.generic.detail import DetailView
 from getpaid.backends.payu import PaymentProcessor
 from getpaid.models import Payment
@@ -25,7 +27,8 @@ class OnlineView(View):
             logger.warning('Got malformed POST request: %s' % str(request.POST))
             return HttpResponse('MALFORMED')
 
-        status = PaymentProcessor.online(pos_id, session_id, ts, sig)
+        with metrics.timed('getpaid_online_seconds', backend=PaymentProcessor.BACKEND), notification_transaction():
+            status = PaymentProcessor.online(pos_id, session_id, ts, sig)
         return HttpResponse(status)
 
 class SuccessView(DetailView):
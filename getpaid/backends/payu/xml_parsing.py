@@ -0,0 +1,77 @@
+from xml.parsers import expat
+
+from getpaid import metrics
+
+CHUNK_SIZE = 4096
+
+
+class _Done(Exception):
+    pass
+
+
+class TransParser(object):
+    """
+    Incremental parser of PayU ``Payment/get`` responses.
+
+    Collects text of ``fields`` elements of the first ``trans`` element. The response is read and fed to expat
+    in chunks, and reading stops as soon as all ``fields`` were collected or the ``trans`` element is closed,
+    so other transactions listed in the response are never read.
+    """
+
+    def __init__(self, fields):
+        self.fields = frozenset(fields)
+        self.result = {}
+        self.depth = None
+        self.text = None
+
+    def start_element(self, name, attrs):
+        depth = self.depth
+        if depth is None:
+            if name == 'trans':
+                self.depth = 0
+            return
+        depth += 1
+        self.depth = depth
+        if depth == 1 and name in self.fields:
+            self.text = []
+
+    def end_element(self, name):
+        depth = self.depth
+        if depth is None:
+            return
+        if depth == 0:
+            raise _Done
+        if depth == 1 and self.text is not None:
+            self.result[name] = u''.join(self.text)
+            self.text = None
+            if len(self.result) == len(self.fields):
+                raise _Done
+        self.depth = depth - 1
+
+    def character_data(self, data):
+        if self.text is not None and self.depth == 1:
+            self.text.append(data)
+
+    def parse(self, response, chunk_size=CHUNK_SIZE):
+        """
+        Reads file-like ``response`` and returns dict of collected fields, or ``None`` if there is no ``trans``
+        element. Raises ``xml.parsers.expat.ExpatError`` for malformed responses.
+        """
+        with metrics.timed('getpaid_xml_parse_seconds', parser='payu'):
+            return self._parse(response, chunk_size)
+
+    def _parse(self, response, chunk_size):
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.character_data
+        try:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    parser.Parse('', True)
+                    break
+                parser.Parse(chunk, False)
+        except _Done:
+            return self.result
+        return self.result if self.depth is not None else None
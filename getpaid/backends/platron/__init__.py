@@ -5,17 +5,21 @@ import hashlib
 import logging
 from random import randint as rnd
 import urllib
-import urllib2
 
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.db.models.loading import get_model
 from django.utils.timezone import utc
 from django.utils.translation import ugettext_lazy as _
-from getpaid import signals
+from getpaid import metrics, signals
 from getpaid.backends import PaymentProcessorBase
+from getpaid.backends.httpclient import get_http_client
+from getpaid.backends.inbox import defer_notification
+from getpaid.backends.ledger import Notification
+from getpaid.backends.signing import compute_md5, signatures_equal
+from getpaid.backends.xmlwriter import XMLTemplate, escape
 
-from xml_parsing import XMLParser
+from xml_parsing import XMLParseError, XMLParser
 
 
 logger = logging.getLogger('getpaid.backends.platron')
@@ -39,35 +43,68 @@ class PaymentProcessor(PaymentProcessorBase):
         'pg_language',
     ]
 
-    @staticmethod
-    def _get_order(dic):
-        flat = {}
-
-        order = dic.keys()
-        order.sort()
+    # Callback response, elements are in signing order
+    _RESPONSE = XMLTemplate(u'<?xml version="1.0" encoding="utf-8"?><response>\n'
+                            u'  <pg_description>{pg_description}</pg_description>\n'
+                            u'  <pg_error_description>{pg_error_description}</pg_error_description>\n'
+                            u'  <pg_salt>{pg_salt}</pg_salt>\n'
+                            u'  <pg_status>{pg_status}</pg_status>\n'
+                            u'  <pg_sig>{pg_sig}</pg_sig>\n'
+                            u'</response>')
 
-        for k, v in dic.items():
-            if isinstance(dic[k], dict):
-                deep_flat, deep_order = PaymentProcessor._get_order(v)
-                flat.update(deep_flat)
+    BACKEND_REQUIRED_SETTINGS = ('id', 'key', 'currency', 'testing', 'check_url')
+    BACKEND_DEFAULT_SETTINGS = {
+        'method': 'get',
+    }
 
-                i = order.index(k)
-                del order[i]
-                order = order[:i] + deep_order + order[i:]
+    @staticmethod
+    def _flatten(dic, items, xml=None):
+        """
+        Walks ``dic`` in Platron signing order: keys are sorted once on every level and nested dicts
+        are expanded in place of their key. Appends ``(key, value)`` leaves to ``items`` and, if ``xml``
+        list is given, XML elements of the same tree.
+        """
+        for key in sorted(dic):
+            value = dic[key]
+            if isinstance(value, dict):
+                if xml is not None:
+                    xml.append(u'  <%s>\n' % key)
+                PaymentProcessor._flatten(value, items, xml)
+                if xml is not None:
+                    xml.append(u'  </%s>\n' % key)
             else:
-                flat[k] = v
-        return flat, order
+                items.append((key, value))
+                if xml is not None:
+                    xml.append(u'  <%s>%s</%s>\n' % (key, escape(value), key))
+
+    @staticmethod
+    def _get_order(dic):
+        items = []
+        PaymentProcessor._flatten(dic, items)
+        return dict(items), [key for key, value in items]
 
     @staticmethod
     def compute_sig(script_name, pg, secret_key):
-        sig = ''
-        flat_pg, order = PaymentProcessor._get_order(pg)
-        for key in order:
-            sig += unicode(flat_pg[key]).encode('utf-8') + ';'
-        to_compute = script_name + ';' + sig + secret_key
-        signature = hashlib.md5(to_compute).hexdigest()
-        logger.debug('%s = %s', to_compute, signature)
-        return signature
+        items = []
+        PaymentProcessor._flatten(pg, items)
+        values = [script_name]
+        values.extend([value for key, value in items])
+        return compute_md5(values, secret_key, separator=';')
+
+    @staticmethod
+    def sign_and_serialize(script_name, pg, secret_key, type='request'):
+        """
+        Computes ``pg_sig`` of ``pg`` and serializes it together with the signature to XML in a single walk.
+
+        Returns tuple of signature and UTF-8 encoded XML.
+        """
+        items, xml = [], []
+        PaymentProcessor._flatten(pg, items, xml)
+        values = [script_name]
+        values.extend([value for key, value in items])
+        signature = compute_md5(values, secret_key, separator=';')
+        xml.append(u'  <pg_sig>%s</pg_sig>\n' % signature)
+        return signature, XMLParser.envelope(xml, type)
 
     @staticmethod
     def generate_salt():
@@ -75,20 +112,35 @@ class PaymentProcessor(PaymentProcessorBase):
 
     @staticmethod
     def send_response(script_name, description='', status='error'):
-        key = PaymentProcessor.get_backend_setting('key')
-        response = {
-            'pg_salt': PaymentProcessor.generate_salt(),
-            'pg_status': 'ok' if not description else status,
+        key = PaymentProcessor.get_backend_config().key
+        salt = PaymentProcessor.generate_salt()
+        status = 'ok' if not description else status
+        signature = compute_md5((script_name, description, description, salt, status), key, separator=';')
+        return PaymentProcessor._RESPONSE.render({
             'pg_description': description,
-            'pg_error_description': description}
-        response['pg_sig'] = PaymentProcessor.compute_sig(script_name, response, key)
-        return XMLParser.to_xml(response, 'response')
+            'pg_error_description': description,
+            'pg_salt': salt,
+            'pg_status': status,
+            'pg_sig': signature})
 
     @staticmethod
     def online(xml, script_name):
-        key = PaymentProcessor.get_backend_setting('key')
-        currency = PaymentProcessor.get_backend_setting('currency')
-        pg = XMLParser.to_dict(xml)
+        config = PaymentProcessor.get_backend_config()
+        key = config.key
+        currency = config.currency
+        try:
+            pg = XMLParser.to_dict(xml)
+        except XMLParseError, e:
+            logger.warning('Got malformed XML: %s', e)
+            return 'MALFORMED'
+
+        # Check requests only query the payment, so they are answered every time
+        notification = None
+        if script_name == 'result':
+            notification = Notification(PaymentProcessor.BACKEND, pg.get('pg_payment_id', ''), xml)
+            response = notification.get_response()
+            if response is not None:
+                return response
 
         # check signature
         if 'pg_sig' not in pg:
@@ -96,7 +148,9 @@ class PaymentProcessor(PaymentProcessorBase):
         else:
             sig = pg['pg_sig']
             del pg['pg_sig']
-            if sig != PaymentProcessor.compute_sig(script_name, pg, key):
+            with metrics.timed('getpaid_signature_seconds', signature='platron.%s' % script_name):
+                valid = signatures_equal(sig, PaymentProcessor.compute_sig(script_name, pg, key))
+            if not valid:
                 return 'SIG ERR'
 
         # Special for Platron
@@ -107,6 +161,11 @@ class PaymentProcessor(PaymentProcessorBase):
         if currency != pg['pg_ps_currency']:
             return 'CUR ERR'
 
+        if notification is not None:
+            response = defer_notification(PaymentProcessor, pg.get('pg_order_id'), 'OK', xml, script_name)
+            if response is not None:
+                return response
+
         Payment = get_model('getpaid', 'Payment')
         try:
             payment = Payment.objects.select_related('order').get(pk=int(pg['pg_order_id']))
@@ -119,12 +178,12 @@ class PaymentProcessor(PaymentProcessorBase):
 
         result = pg.get('pg_result', None)
         if result == '1':
-            payment.amount_paid = Decimal(pg['pg_amount'])
-            payment.paid_on = datetime.utcnow().replace(tzinfo=utc)
+            amount_paid = Decimal(pg['pg_amount'])
+            paid_on = datetime.utcnow().replace(tzinfo=utc)
             if payment.amount <= Decimal(pg['pg_amount']):
-                payment.change_status('paid')
+                payment.change_status('paid', amount_paid=amount_paid, paid_on=paid_on)
             else:
-                payment.change_status('partially_paid')
+                payment.change_status('partially_paid', amount_paid=amount_paid, paid_on=paid_on)
         elif result == '0':
             description = pg.get('pg_description', None)
             logger.info('Non result response: %s', unicode(description).encode('utf-8'))
@@ -133,14 +192,17 @@ class PaymentProcessor(PaymentProcessorBase):
         else:
             # Check
             pass
+        if notification is not None:
+            return notification.acknowledge('OK')
         return 'OK'
 
     def get_gateway_url(self, request):
-        id = PaymentProcessor.get_backend_setting('id')
-        key = PaymentProcessor.get_backend_setting('key')
-        currency = PaymentProcessor.get_backend_setting('currency')
-        testing = PaymentProcessor.get_backend_setting('testing')
-        check_url = PaymentProcessor.get_backend_setting('check_url')
+        config = PaymentProcessor.get_backend_config()
+        id = config.id
+        key = config.key
+        currency = config.currency
+        testing = config.testing
+        check_url = config.check_url
 
         # Special for Platron
         if currency == 'RUB':
@@ -207,15 +269,12 @@ class PaymentProcessor(PaymentProcessorBase):
             del user_data['pg_payment_system']
         pg.update([(k, v) for k, v in user_data.items() if k in self._ADDITION_DATA])
 
-        pg['pg_sig'] = PaymentProcessor.compute_sig('init_payment.php', pg, key)
-
-        # Assembling XML-request
-        xml_req = XMLParser.to_xml(pg)
+        # Signing and assembling XML-request
+        pg['pg_sig'], xml_req = PaymentProcessor.sign_and_serialize('init_payment.php', pg, key)
 
         # Send payment request
-        req = urllib2.Request(PaymentProcessor._INIT_PAYMENT_URL, data=xml_req)
-        req.add_header('Content-Type', 'text/xml')
-        xml_resp = urllib2.urlopen(req).read()
+        init_payment_url = config.get('init_payment_url') or PaymentProcessor._INIT_PAYMENT_URL
+        xml_resp = get_http_client().post(init_payment_url, xml_req, {'Content-Type': 'text/xml'}).body
 
         # Parsing answer
         xml_dict = XMLParser.to_dict(xml_resp)
@@ -228,10 +287,12 @@ class PaymentProcessor(PaymentProcessorBase):
                       'pg_error_description': xml_dict['pg_error_description'],
                       'pg_order_id': self.payment.pk}
             gateway_url = reverse('getpaid:platron:failure')
+            # a failed payment request is made again on the next submission
+            self.gateway_url_reusable = False
         else:
             gateway_url = xml_dict['pg_redirect_url']
 
-        if PaymentProcessor.get_backend_setting('method', 'get').lower() == 'get':
+        if config.method.lower() == 'get':
             for key in params.keys():
                 params[key] = unicode(params[key]).encode('utf-8')
             gateway_url += '' if gateway_url.find('?') > 0 else '?'
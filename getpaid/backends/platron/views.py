@@ -3,6 +3,8 @@ import logging
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
 from django.views.generic.base import View
+from getpaid import metrics
+from getpaid.dispatch import notification_transaction
 from getpaid.backends.platron import PaymentProcessor
 
 
@@ -17,6 +19,7 @@ class OnlineView(View):
                         'CUR ERR': [u'Bad currency'],
                         'CRC ERR': [u'Order id is not found'],
                         'REJECT': [u'Payment rejected', 'rejected'],
+                        'MALFORMED': [u'Malformed request'],
                         'OK': ['']}
         return PaymentProcessor.send_response(self.script_name, *status_dict.get(status, ['']))
 
@@ -27,7 +30,8 @@ class OnlineView(View):
             logger.warning('Got malformed POST request: %s' % str(request.POST))
             return HttpResponse('MALFORMED')
 
-        status = PaymentProcessor.online(xml, self.script_name)
+        with metrics.timed('getpaid_online_seconds', backend=PaymentProcessor.BACKEND), notification_transaction():
+            status = PaymentProcessor.online(xml, self.script_name)
         logger.debug('Online response: %s, %s', status, xml)
         return HttpResponse(self.get_response(status))
 
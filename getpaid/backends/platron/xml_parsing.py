@@ -1,49 +1,95 @@
-from xml.dom.minidom import parseString
+from xml.parsers import expat
+
+from getpaid import metrics
+from getpaid.backends.xmlwriter import escape
+
+
+class XMLParseError(ValueError):
+    pass
 
 
 class XMLParser(object):
-    def __init__(self, max_depth=2):
+    """
+    Streaming parser of Platron ``request`` and ``response`` documents.
+
+    Children of the first ``request`` or ``response`` element are collected into a dict in one pass over
+    the document, without building a tree: text elements become unicode values and elements with child
+    elements become nested dicts, at most ``max_depth`` levels deep. Documents larger than ``max_size`` bytes,
+    nested too deep or declaring a DTD (so no entities can be expanded) are rejected with ``XMLParseError``.
+    """
+    MAX_SIZE = 64 * 1024
+
+    def __init__(self, max_depth=2, max_size=MAX_SIZE):
         self.max_depth = max_depth
-        self.depth = 0
-
-    def parse(self, xml_node):
-        d = {}
-        self.depth += 1
-        for node in xml_node.childNodes:
-            if node.nodeType != node.TEXT_NODE:
-                d[node.tagName] = ''
-                if node.childNodes:
-                    textnode = node.childNodes[0]
-                    if textnode.nodeType == node.TEXT_NODE and len(node.childNodes) == 1:
-                        d[node.tagName] = textnode.nodeValue
-                    elif self.depth <= self.max_depth:
-                        d[node.tagName] = self.parse(node)
-                    else:
-                        print textnode
-        self.depth -= 1
-        return d
+        self.max_size = max_size
+        self.result = {}
+        self.stack = None
+        self.done = False
 
-    @classmethod
-    def to_dict(cls, xml, max_depth=2):
-        parser = cls(max_depth)
+    def start_element(self, name, attrs):
+        stack = self.stack
+        if stack is None:
+            if not self.done and (name == 'request' or name == 'response'):
+                self.stack = [(name, [], self.result)]
+            return
+        if len(stack) > self.max_depth + 1:
+            raise XMLParseError('Element <%s> is nested too deep' % name)
+        parent = stack[-1]
+        if parent[2] is None:
+            stack[-1] = (parent[0], parent[1], {})
+        stack.append((name, [], None))
+
+    def end_element(self, name):
+        stack = self.stack
+        if stack is None:
+            return
+        name, text, children = stack.pop()
+        if not stack:
+            self.stack = None
+            self.done = True
+            return
+        stack[-1][2][name] = u''.join(text) if children is None else children
 
-        xml = parseString(unicode(xml).encode('utf-8'))
-        request = xml.getElementsByTagName('request')
-        response = xml.getElementsByTagName('response')
+    def character_data(self, data):
+        if self.stack is not None:
+            self.stack[-1][1].append(data)
 
-        if response:
-            return parser.parse(response[0])
-        elif request:
-            return parser.parse(request[0])
-        else:
-            return {}
+    def reject_dtd(self, *args):
+        raise XMLParseError('DTD is not allowed')
+
+    def feed(self, xml):
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        if len(xml) > self.max_size:
+            raise XMLParseError('Document is larger than %d bytes' % self.max_size)
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.character_data
+        parser.StartDoctypeDeclHandler = self.reject_dtd
+        parser.EntityDeclHandler = self.reject_dtd
+        try:
+            parser.Parse(xml, True)
+        except expat.ExpatError, e:
+            raise XMLParseError(str(e))
+        return self.result
+
+    @classmethod
+    def to_dict(cls, xml, max_depth=2, max_size=MAX_SIZE):
+        """
+        Returns dict of children of ``request`` (or ``response``) element, or empty dict if there is none.
+        """
+        with metrics.timed('getpaid_xml_parse_seconds', parser='platron'):
+            return cls(max_depth, max_size).feed(xml)
 
     @staticmethod
-    def to_xml(elements, type='request'):
-        params = ''
-        for key, value in elements.items():
-            params += '  <%(key)s>%(value)s</%(key)s>\n' % {'key': key, 'value': value}
+    def envelope(elements, type='request'):
+        """
+        Wraps list of already serialized unicode ``elements`` into a ``type`` document encoded with UTF-8.
+        """
+        return (u'<?xml version="1.0" encoding="utf-8"?><%s>\n%s</%s>' % (type, u''.join(elements), type)).encode('utf-8')
 
-        xml = '<?xml version="1.0" encoding="utf-8"?>'\
-                '<%(type)s>\n%(params)s</%(type)s>' % {'type': type, 'params': params}
-        return unicode(xml).encode('utf-8')
+    @staticmethod
+    def to_xml(elements, type='request'):
+        return XMLParser.envelope([u'  <%s>%s</%s>\n' % (key, escape(value), key) for key, value in elements.items()],
+                                  type)
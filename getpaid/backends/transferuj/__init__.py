@@ -1,16 +1,16 @@
 from decimal import Decimal
-import hashlib
 import logging
 import urllib
 import datetime
-from django.contrib.sites.models import Site
 from django.core.exceptions import ImproperlyConfigured
-from django.core.urlresolvers import reverse
 from django.db.models.loading import get_model
 from django.utils.timezone import utc
 from django.utils.translation import ugettext_lazy as _
 from getpaid import signals
-from getpaid.backends import PaymentProcessorBase
+from getpaid.backends import PaymentProcessorBase, build_absolute_url
+from getpaid.backends.inbox import defer_notification
+from getpaid.backends.ledger import Notification
+from getpaid.backends.signing import Signature
 
 logger = logging.getLogger('getpaid.backends.transferuj')
 
@@ -27,35 +27,54 @@ class PaymentProcessor(PaymentProcessorBase):
     _ALLOWED_IP = ('195.149.229.109', )
 
     _ONLINE_SIG_FIELDS = ('id', 'tr_id', 'tr_amount', 'tr_crc', )
+    _REQUEST_SIG = Signature(_REQUEST_SIG_FIELDS)
+    _ONLINE_SIG = Signature(_ONLINE_SIG_FIELDS, name='transferuj.online')
+
+    BACKEND_REQUIRED_SETTINGS = ('id', 'key')
+    BACKEND_DEFAULT_SETTINGS = {
+        'allowed_ip': _ALLOWED_IP,
+        'signing': True,
+        'force_ssl_online': False,
+        'force_ssl_return': False,
+        'method': 'get',
+    }
 
     @staticmethod
     def compute_sig(params, fields, key):
-        text = ''
-        for field in fields:
-            text += unicode(params.get(field, '')).encode('utf-8')
-        text += key
-        return hashlib.md5(text).hexdigest()
+        return Signature(fields).compute(params, key)
 
     @staticmethod
     def online(ip, id, tr_id, tr_date, tr_crc, tr_amount, tr_paid, tr_desc, tr_status, tr_error, tr_email, md5sum):
 
-        allowed_ip = PaymentProcessor.get_backend_setting('allowed_ip', PaymentProcessor._ALLOWED_IP)
+        config = PaymentProcessor.get_backend_config()
 
-        if len(allowed_ip) != 0 and ip not in allowed_ip:
-            logger.warning('Got message from not allowed IP %s' % str(allowed_ip))
+        if len(config.allowed_ip) != 0 and ip not in config.allowed_ip:
+            logger.warning('Got message from not allowed IP %s' % str(config.allowed_ip))
             return 'IP ERR'
 
         params = {'id' : id, 'tr_id': tr_id, 'tr_amount': tr_amount, 'tr_crc': tr_crc}
-        key = PaymentProcessor.get_backend_setting('key')
 
-        if md5sum != PaymentProcessor.compute_sig(params, PaymentProcessor._ONLINE_SIG_FIELDS, key):
+        notification = Notification(PaymentProcessor.BACKEND, tr_id, {
+            'id': id, 'tr_id': tr_id, 'tr_date': tr_date, 'tr_crc': tr_crc, 'tr_amount': tr_amount,
+            'tr_paid': tr_paid, 'tr_desc': tr_desc, 'tr_status': tr_status, 'tr_error': tr_error,
+            'tr_email': tr_email, 'md5sum': md5sum})
+        response = notification.get_response()
+        if response is not None:
+            return response
+
+        if not PaymentProcessor._ONLINE_SIG.verify(params, config.key, md5sum):
             logger.warning('Got message with wrong sig, %s' % str(params))
             return 'SIG ERR'
 
-        if int(id) != int(PaymentProcessor.get_backend_setting('id')):
+        if int(id) != int(config.id):
             logger.warning('Got message with wrong id, %s' % str(params))
             return 'ID ERR'
 
+        response = defer_notification(PaymentProcessor, tr_crc, 'TRUE', ip, id, tr_id, tr_date, tr_crc, tr_amount,
+                                      tr_paid, tr_desc, tr_status, tr_error, tr_email, md5sum)
+        if response is not None:
+            return response
+
         Payment = get_model('getpaid', 'Payment')
         try:
             payment = Payment.objects.select_related('order').get(pk=int(tr_crc))
@@ -67,26 +86,26 @@ class PaymentProcessor(PaymentProcessorBase):
 
         if tr_status == 'TRUE':
             # Due to Transferuj documentation, we need to check if amount is correct
-            payment.amount_paid = Decimal(tr_paid)
-            payment.paid_on = datetime.datetime.utcnow().replace(tzinfo=utc)
+            amount_paid = Decimal(tr_paid)
+            paid_on = datetime.datetime.utcnow().replace(tzinfo=utc)
             if payment.amount <= Decimal(tr_paid):
                 # Amount is correct or it is overpaid
-                payment.change_status('paid')
+                payment.change_status('paid', amount_paid=amount_paid, paid_on=paid_on)
             else :
-                payment.change_status('partially_paid')
+                payment.change_status('partially_paid', amount_paid=amount_paid, paid_on=paid_on)
         elif payment.status != 'paid':
             payment.change_status('failed')
 
-
-        return 'TRUE'
+        return notification.acknowledge('TRUE')
 
     def get_gateway_url(self, request):
         """
         Routes a payment to Gateway, should return URL for redirection.
 
         """
+        config = PaymentProcessor.get_backend_config()
         params = {
-            'id': PaymentProcessor.get_backend_setting('id'),
+            'id': config.id,
             'opis': self.get_order_description(self.payment, self.payment.order),
         }
 
@@ -100,40 +119,28 @@ class PaymentProcessor(PaymentProcessorBase):
         if user_data['email']:
             params['email'] = user_data['email']
 
-        key = PaymentProcessor.get_backend_setting('key')
-
-        signing = PaymentProcessor.get_backend_setting('signing', True)
-
         # Here we put payment.pk as we can get order through payment model
         params['crc'] = self.payment.pk
 
         # amount is  in format XXX.YY PLN
         params['kwota'] = str(self.payment.amount)
 
-        if signing:
-            params['md5sum'] = PaymentProcessor.compute_sig(params, self._REQUEST_SIG_FIELDS, key)
-
-        current_site = Site.objects.get_current()
-
-        if PaymentProcessor.get_backend_setting('force_ssl_online', False):
-            params['wyn_url'] = 'https://' + current_site.domain + reverse('getpaid:transferuj:online')
-        else:
-            params['wyn_url'] = 'http://' + current_site.domain + reverse('getpaid:transferuj:online')
-
-        if PaymentProcessor.get_backend_setting('force_ssl_return', False):
-            params['pow_url'] = 'https://' + current_site.domain + reverse('getpaid:transferuj:success', kwargs={'pk': self.payment.pk})
-            params['pow_url_blad'] = 'https://' + current_site.domain + reverse('getpaid:transferuj:failure', kwargs={'pk': self.payment.pk})
-        else:
-            params['pow_url'] = 'http://' + current_site.domain + reverse('getpaid:transferuj:success', kwargs={'pk': self.payment.pk})
-            params['pow_url_blad'] = 'http://' + current_site.domain + reverse('getpaid:transferuj:failure', kwargs={'pk': self.payment.pk})
+        if config.signing:
+            params['md5sum'] = self._REQUEST_SIG.compute(params, config.key)
 
+        params['wyn_url'] = build_absolute_url('getpaid:transferuj:online', config.force_ssl_online)
+        params['pow_url'] = build_absolute_url('getpaid:transferuj:success', config.force_ssl_return, self.payment.pk)
+        params['pow_url_blad'] = build_absolute_url('getpaid:transferuj:failure', config.force_ssl_return,
+                                                    self.payment.pk)
 
-        if PaymentProcessor.get_backend_setting('method', 'get').lower() == 'post':
-            return self._GATEWAY_URL , 'POST', params
-        elif PaymentProcessor.get_backend_setting('method', 'get').lower() == 'get':
+        gateway_url = config.get('gateway_url') or self._GATEWAY_URL
+        method = config.method.lower()
+        if method == 'post':
+            return gateway_url, 'POST', params
+        elif method == 'get':
             for key in params.keys():
                 params[key] = unicode(params[key]).encode('utf-8')
-            return self._GATEWAY_URL + '?' + urllib.urlencode(params), "GET", {}
+            return gateway_url + '?' + urllib.urlencode(params), "GET", {}
         else:
             raise ImproperlyConfigured('Transferuj.pl payment backend accepts only GET or POST')
 
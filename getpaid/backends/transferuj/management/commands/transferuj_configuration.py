@@ -6,7 +6,7 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
 
-        key = PaymentProcessor.get_backend_setting('key', None)
+        key = PaymentProcessor.get_backend_config().get('key')
         if key is None:
             self.stdout.write('Please be sure to provide "key" setting for this backend (random max. 16 characters)')
         else:
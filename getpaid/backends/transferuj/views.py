@@ -2,6 +2,8 @@ import logging
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
 from django.views.generic.base import View
+from getpaid import metrics
+from getpaid.dispatch import notification_transaction
 from django.views.generic.detail import DetailView
 from getpaid.backends.transferuj import PaymentProcessor
 from getpaid.models import Payment
@@ -31,7 +33,8 @@ class OnlineView(View):
             logger.warning('Got malformed POST request: %s' %  str(request.POST))
             return HttpResponse('MALFORMED')
 
-        status = PaymentProcessor.online(request.META['REMOTE_ADDR'], id, tr_id, tr_date, tr_crc, tr_amount, tr_paid, tr_desc, tr_status, tr_error, tr_email, md5sum)
+        with metrics.timed('getpaid_online_seconds', backend=PaymentProcessor.BACKEND), notification_transaction():
+            status = PaymentProcessor.online(request.META['REMOTE_ADDR'], id, tr_id, tr_date, tr_crc, tr_amount, tr_paid, tr_desc, tr_status, tr_error, tr_email, md5sum)
         return HttpResponse(status)
 
 class SuccessView(DetailView):
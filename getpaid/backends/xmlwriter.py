@@ -0,0 +1,40 @@
+import re
+
+_PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+
+def escape(value):
+    """
+    Returns ``value`` converted to unicode with ``&``, ``<``, ``>`` and ``"`` escaped.
+    """
+    value = unicode(value)
+    if u'&' in value:
+        value = value.replace(u'&', u'&amp;')
+    if u'<' in value:
+        value = value.replace(u'<', u'&lt;')
+    if u'>' in value:
+        value = value.replace(u'>', u'&gt;')
+    if u'"' in value:
+        value = value.replace(u'"', u'&quot;')
+    return value
+
+
+class XMLTemplate(object):
+    """
+    XML document with fixed layout, e.g. a gateway callback response.
+
+    Static text is compiled once, when the template is defined, and ``{name}`` placeholders are filled with
+    escaped params (missing ones are empty) on ``render()``, which returns the document encoded with UTF-8::
+
+        _RESPONSE = XMLTemplate(u'<?xml version="1.0" encoding="utf-8"?><response><status>{status}</status></response>')
+        _RESPONSE.render({'status': 'ok'})
+    """
+
+    def __init__(self, template):
+        parts = _PLACEHOLDER.split(template)
+        self.fields = tuple(parts[1::2])
+        self._format = u'%s'.join([part.replace(u'%', u'%%') for part in parts[::2]])
+
+    def render(self, params):
+        get = params.get
+        return (self._format % tuple([escape(get(field, u'')) for field in self.fields])).encode('utf-8')
@@ -0,0 +1,81 @@
+"""
+Dispatch of ``payment_status_changed`` signals.
+
+By default the signal is sent by ``Payment.change_status()`` right away, inside the transaction of the
+notification handler. With ``GETPAID_DISPATCH_AFTER_COMMIT`` setting enabled, writes of every notification handler
+wrapped with ``notification_transaction()`` are committed at once, and signals of status changes made by the
+handler are queued and sent in order only after the commit, together with one ``payment_statuses_changed``
+signal listing all the changes. Receivers run in one transaction of their own. If the handler fails, nothing is
+committed and the queued signals are dropped.
+
+Callbacks registered with ``on_rollback()`` undo side effects outside of the database (e.g. in Django cache) when
+the handler fails.
+"""
+from contextlib import contextmanager
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from getpaid import signals
+
+_state = threading.local()
+
+
+def send_status_changed(payment, old_status, new_status):
+    """
+    Sends signals about status change of ``payment``, or queues them until the enclosing
+    ``notification_transaction()`` commits.
+    """
+    queue = getattr(_state, 'queue', None)
+    if queue is not None:
+        queue.append((payment, old_status, new_status))
+    else:
+        _dispatch([(payment, old_status, new_status)])
+
+
+def _dispatch(changes):
+    for payment, old_status, new_status in changes:
+        signals.payment_status_changed.send(sender=type(payment), instance=payment,
+                                            old_status=old_status, new_status=new_status)
+    signals.payment_statuses_changed.send(sender=type(changes[0][0]), changes=changes)
+
+
+def on_rollback(callback):
+    """
+    Calls ``callback`` if the enclosing ``notification_transaction()`` fails, so its writes are not committed.
+    Does nothing outside of ``notification_transaction()``.
+    """
+    callbacks = getattr(_state, 'rollback_callbacks', None)
+    if callbacks is not None:
+        callbacks.append(callback)
+
+
+@contextmanager
+def notification_transaction(atomic=False):
+    """
+    Wraps writes of a notification handler. If ``GETPAID_DISPATCH_AFTER_COMMIT`` setting is enabled, the block
+    runs in a transaction and signals are sent after it commits; otherwise the block runs in a transaction only if
+    ``atomic`` is ``True``. Blocks nested in another ``notification_transaction()`` join the outer one.
+    """
+    if getattr(_state, 'rollback_callbacks', None) is not None:
+        yield
+        return
+    after_commit = getattr(settings, 'GETPAID_DISPATCH_AFTER_COMMIT', False)
+    queue = _state.queue = [] if after_commit else None
+    callbacks = _state.rollback_callbacks = []
+    try:
+        if after_commit or atomic:
+            with transaction.commit_on_success():
+                yield
+        else:
+            yield
+    except Exception:
+        for callback in callbacks:
+            callback()
+        raise
+    finally:
+        _state.queue = None
+        _state.rollback_callbacks = None
+    if queue:
+        with transaction.commit_on_success():
+            _dispatch(queue)
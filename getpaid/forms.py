@@ -6,25 +6,59 @@ from django.forms.models import ModelChoiceField
 from django.forms.widgets import HiddenInput, RadioSelect, RadioFieldRenderer, RadioInput
 from django.utils.encoding import force_unicode
 from django.utils.safestring import mark_safe
-from django.utils.translation import ugettext as _
+from django.test.signals import setting_changed
+from django.utils.translation import get_language, ugettext as _
 from getpaid.models import Order
-from utils import get_backend_choices, import_name
+from registry import get_registry
+from utils import get_backend_choices
 
 
-class PaymentRadioInput(RadioInput):
-    def __init__(self, name, value, attrs, choice, index):
-        super(PaymentRadioInput, self).__init__(name, value, attrs, choice, index)
-        logo_url = import_name(choice[0]).PaymentProcessor.get_logo_url()
+_labels = {}
+_rendered = {}
+
+
+def get_choice_label(choice):
+    """
+    Returns label of backend ``choice``: its logo if it has one, otherwise its name. Labels are built once
+    per backend and language.
+    """
+    key = (choice[0], get_language())
+    label = _labels.get(key)
+    if label is None:
+        logo_url = get_registry()[choice[0]].logo_url
         if logo_url :
-            self.choice_label = mark_safe('<img src="%s%s" alt="%s">' % (
+            label = mark_safe('<img src="%s%s" alt="%s">' % (
                 getattr(settings, 'STATIC_URL', ''),
                 logo_url,
                 force_unicode(choice[1]),
                 )
             )
+        else:
+            label = force_unicode(choice[1])
+        _labels[key] = label
+    return label
+
+
+def reset_rendered(**kwargs):
+    if kwargs.get('setting') in (None, 'GETPAID_BACKENDS', 'GETPAID_BACKENDS_SETTINGS', 'STATIC_URL'):
+        _labels.clear()
+        _rendered.clear()
+
+setting_changed.connect(reset_rendered)
+
+
+class PaymentRadioInput(RadioInput):
+    def __init__(self, name, value, attrs, choice, index):
+        super(PaymentRadioInput, self).__init__(name, value, attrs, choice, index)
+        self.choice_label = get_choice_label(choice)
 
 
 class PaymentRadioFieldRenderer(RadioFieldRenderer):
+    """
+    Renders backend choices with their logos. Markup of every choice, both not checked and checked, is built
+    once per field name, attributes, backends and language, so rendering only picks the checked one.
+    """
+
     def __iter__(self):
         for i, choice in enumerate(self.choices):
             yield PaymentRadioInput(self.name, self.value, self.attrs.copy(), choice, i)
@@ -33,6 +67,36 @@ class PaymentRadioFieldRenderer(RadioFieldRenderer):
         choice = self.choices[idx] # Let the IndexError propogate
         return PaymentRadioInput(self.name, self.value, self.attrs.copy(), choice, idx)
 
+    def get_rendered_choices(self):
+        """
+        Returns tuple of ``(value, markup, checked_markup)`` of choices, or ``None`` if they cannot be cached.
+        """
+        try:
+            key = (self.name, tuple(sorted(self.attrs.items())), tuple(choice[0] for choice in self.choices),
+                   get_language())
+            rendered = _rendered.get(key)
+        except TypeError:
+            # unhashable attributes
+            return None
+        if rendered is None:
+            rendered = []
+            for i, choice in enumerate(self.choices):
+                value = force_unicode(choice[0])
+                rendered.append((
+                    value,
+                    force_unicode(PaymentRadioInput(self.name, None, self.attrs.copy(), choice, i)),
+                    force_unicode(PaymentRadioInput(self.name, value, self.attrs.copy(), choice, i)),
+                ))
+            rendered = _rendered[key] = tuple(rendered)
+        return rendered
+
+    def render(self):
+        rendered = self.get_rendered_choices()
+        if rendered is None:
+            return super(PaymentRadioFieldRenderer, self).render()
+        return mark_safe(u'<ul>\n%s\n</ul>' % u'\n'.join([u'<li>%s</li>'
+                % (checked if value == self.value else markup) for value, markup, checked in rendered]))
+
 
 class PaymentRadioSelect(RadioSelect):
     renderer = PaymentRadioFieldRenderer
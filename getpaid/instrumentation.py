@@ -0,0 +1,280 @@
+"""
+Timing of ``getpaid.signals`` receivers.
+
+With ``GETPAID_SIGNAL_TIMING`` setting enabled, every receiver call of getpaid signals is timed and counted per
+receiver and per signal, and calls taking longer than the budget are logged. Numbers are available from
+``get_signal_timings()``. Tests can time signals sent within a block, regardless of the setting::
+
+    with signal_timings() as timings:
+        self.client.post(reverse('getpaid:new-payment', kwargs={'currency': 'EUR'}), data)
+    self.assertEqual(timings.over_budget(0.05), [])
+"""
+from collections import deque
+from contextlib import contextmanager
+import logging
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.test.signals import setting_changed
+from getpaid import metrics
+
+logger = logging.getLogger('getpaid.instrumentation')
+
+DEFAULT_BUDGET = 0.1
+SAMPLES = 1024
+
+
+class Timings(object):
+    """
+    Number, total and maximal time of calls, in seconds, with ``samples`` most recent times (all if ``None``) kept
+    for percentiles.
+    """
+
+    def __init__(self, samples=SAMPLES):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.over_budget = 0
+        self.samples = deque(maxlen=samples)
+
+    def record(self, elapsed, over_budget=False):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        if over_budget:
+            self.over_budget += 1
+        self.samples.append(elapsed)
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[int(round(percent / 100.0 * (len(samples) - 1)))]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'average': self.average,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'over_budget': self.over_budget,
+        }
+
+
+class SignalTimings(object):
+    """
+    Timings of whole signals (``signals``, by signal name) and of their receivers (``receivers``, by
+    ``(signal name, receiver name)``).
+    """
+
+    def __init__(self):
+        self.signals = {}
+        self.receivers = {}
+        self._lock = threading.Lock()
+
+    def record(self, signal_name, receiver_timings, elapsed, budget=None):
+        with self._lock:
+            for receiver_name, receiver_elapsed in receiver_timings:
+                timings = self.receivers.get((signal_name, receiver_name))
+                if timings is None:
+                    timings = self.receivers[(signal_name, receiver_name)] = Timings()
+                timings.record(receiver_elapsed, budget is not None and receiver_elapsed > budget)
+            timings = self.signals.get(signal_name)
+            if timings is None:
+                timings = self.signals[signal_name] = Timings()
+            timings.record(elapsed)
+
+    def over_budget(self, budget):
+        """
+        Returns sorted list of ``(signal name, receiver name)`` of receivers that were ever slower than ``budget``.
+        """
+        with self._lock:
+            return sorted(key for key, timings in self.receivers.items() if timings.max > budget)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'signals': dict((name, timings.as_dict()) for name, timings in self.signals.items()),
+                'receivers': dict((key, timings.as_dict()) for key, timings in self.receivers.items()),
+            }
+
+    def clear(self):
+        with self._lock:
+            self.signals.clear()
+            self.receivers.clear()
+
+
+_timings = SignalTimings()
+_collectors = []
+_sending = threading.local()
+_budget = None
+
+
+def get_budget():
+    """
+    Returns receiver time budget in seconds if ``GETPAID_SIGNAL_TIMING`` setting is enabled, or ``None``.
+    The setting is ``True`` or a dict with ``budget`` key.
+    """
+    global _budget
+    if _budget is None:
+        setting = getattr(settings, 'GETPAID_SIGNAL_TIMING', False)
+        if isinstance(setting, dict):
+            _budget = setting.get('budget', DEFAULT_BUDGET)
+        else:
+            _budget = DEFAULT_BUDGET if setting else False
+    return _budget if _budget is not False else None
+
+
+def reset_budget(**kwargs):
+    global _budget
+    if kwargs.get('setting', 'GETPAID_SIGNAL_TIMING') == 'GETPAID_SIGNAL_TIMING':
+        _budget = None
+
+setting_changed.connect(reset_budget)
+
+
+def get_signal_timings():
+    """
+    Returns ``SignalTimings`` of all signals sent by this process since ``GETPAID_SIGNAL_TIMING`` was enabled.
+    """
+    return _timings
+
+
+@contextmanager
+def signal_timings():
+    """
+    Times receivers of signals sent within the block and yields their ``SignalTimings``.
+    """
+    timings = SignalTimings()
+    _collectors.append(timings)
+    try:
+        yield timings
+    finally:
+        _collectors.remove(timings)
+
+
+def get_receiver_name(receiver):
+    if getattr(receiver, 'im_self', None) is not None:
+        return '%s.%s.%s' % (receiver.__module__, type(receiver.im_self).__name__, receiver.__name__)
+    return '%s.%s' % (getattr(receiver, '__module__', None), getattr(receiver, '__name__', type(receiver).__name__))
+
+
+def _receiver_key(receiver):
+    if getattr(receiver, 'im_self', None) is not None:
+        return 'getpaid.timed', id(receiver.im_self), id(receiver.im_func)
+    return 'getpaid.timed', id(receiver)
+
+
+def _reference(receiver, callback):
+    """
+    Returns function returning ``receiver``, or ``None`` after it was garbage collected (then ``callback`` is
+    called).
+    """
+    if getattr(receiver, 'im_self', None) is not None:
+        self_ref = weakref.ref(receiver.im_self, callback)
+        func = receiver.im_func
+
+        def get_receiver():
+            im_self = self_ref()
+            return None if im_self is None else func.__get__(im_self, type(im_self))
+        return get_receiver
+    try:
+        return weakref.ref(receiver, callback)
+    except TypeError:
+        return lambda: receiver
+
+
+def _unwrap(responses):
+    responses = [(timed_receiver.get_receiver(), response) for timed_receiver, response in responses]
+    return [(receiver, response) for receiver, response in responses if receiver is not None]
+
+
+class TimedSignal(Signal):
+    """
+    Signal which times its receivers if ``GETPAID_SIGNAL_TIMING`` is enabled or within ``signal_timings()``.
+
+    Every receiver is connected wrapped in a function that times its calls, so sending is left to Django. Wrappers
+    keep weak references to receivers connected with ``weak=True`` and are disconnected with them.
+    """
+
+    def __init__(self, name, providing_args=None):
+        super(TimedSignal, self).__init__(providing_args)
+        self.name = name
+
+    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None):
+        if dispatch_uid is None:
+            dispatch_uid = _receiver_key(receiver)
+        receiver_name = get_receiver_name(receiver)
+        if weak:
+            get_receiver = _reference(receiver, lambda ref: self.disconnect(sender=sender, dispatch_uid=dispatch_uid))
+        else:
+            get_receiver = lambda: receiver
+
+        def timed_receiver(**named):
+            receiver = get_receiver()
+            if receiver is None:
+                return None
+            stack = getattr(_sending, 'timings', None)
+            if not stack:
+                return receiver(**named)
+            start = time.time()
+            try:
+                return receiver(**named)
+            finally:
+                stack[-1].append((receiver_name, time.time() - start))
+
+        timed_receiver.get_receiver = get_receiver
+        super(TimedSignal, self).connect(timed_receiver, sender=sender, weak=False, dispatch_uid=dispatch_uid)
+
+    def disconnect(self, receiver=None, sender=None, weak=True, dispatch_uid=None):
+        if dispatch_uid is None:
+            dispatch_uid = _receiver_key(receiver)
+        return super(TimedSignal, self).disconnect(sender=sender, dispatch_uid=dispatch_uid)
+
+    def send(self, sender, **named):
+        return self._timed_send(super(TimedSignal, self).send, sender, named)
+
+    def send_robust(self, sender, **named):
+        return self._timed_send(super(TimedSignal, self).send_robust, sender, named)
+
+    def _timed_send(self, send, sender, named):
+        budget = get_budget()
+        if budget is None and not _collectors:
+            return _unwrap(send(sender, **named))
+
+        stack = getattr(_sending, 'timings', None)
+        if stack is None:
+            stack = _sending.timings = []
+        receiver_timings = []
+        stack.append(receiver_timings)
+        start = time.time()
+        try:
+            responses = send(sender, **named)
+        finally:
+            stack.pop()
+        elapsed = time.time() - start
+        if not receiver_timings:
+            # only signals with receivers are timed
+            return _unwrap(responses)
+
+        if budget is not None:
+            for receiver_name, receiver_elapsed in receiver_timings:
+                if receiver_elapsed > budget:
+                    logger.warning('Receiver %s of %s signal took %.3fs' % (receiver_name, self.name,
+                                                                          receiver_elapsed))
+                metrics.observe('getpaid_signal_receiver_seconds', receiver_elapsed, signal=self.name,
+                                receiver=receiver_name)
+            _timings.record(self.name, receiver_timings, elapsed, budget)
+        for timings in list(_collectors):
+            timings.record(self.name, receiver_timings, elapsed)
+        return _unwrap(responses)
@@ -0,0 +1,31 @@
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand
+from getpaid.backends.inbox import MAX_ATTEMPTS, process_inbox
+
+
+class Command(BaseCommand):
+    help = 'Process notifications deferred by backends with "deferred" setting enabled'
+    option_list = BaseCommand.option_list + (
+        make_option('--backend', default=None,
+                    help='Process only notifications of this backend, e.g. getpaid.backends.dotpay'),
+        make_option('--workers', type='int', default=4,
+                    help='Number of payments processed concurrently [default: %default]'),
+        make_option('--limit', type='int', default=1000,
+                    help='Maximal number of payments processed in one pass [default: %default]'),
+        make_option('--max-attempts', type='int', default=MAX_ATTEMPTS,
+                    help='Give up notifications that failed this many times [default: %default]'),
+        make_option('--interval', type='float', default=0,
+                    help='Keep running and look for new notifications every INTERVAL seconds'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            summary = process_inbox(options['backend'], workers=options['workers'], limit=options['limit'],
+                                    max_attempts=options['max_attempts'])
+            if summary['payments'] or not options['interval']:
+                self.stdout.write('Processed %(processed)d notifications of %(payments)d payments, '
+                                  '%(errors)d errors\n' % summary)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
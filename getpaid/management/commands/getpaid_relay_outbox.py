@@ -0,0 +1,23 @@
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand
+from getpaid.backends.outbox import relay_outbox
+
+
+class Command(BaseCommand):
+    help = 'Send celery task calls stored in the outbox (GETPAID_OUTBOX setting) to the broker'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100, dest='batch_size',
+                    help='Number of task calls read from the outbox at once [default: %default]'),
+        make_option('--interval', type='float', default=0,
+                    help='Keep running and look for new task calls every INTERVAL seconds'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            summary = relay_outbox(batch_size=options['batch_size'])
+            if summary['sent'] or summary['errors'] or not options['interval']:
+                self.stdout.write('Sent %(sent)d task calls, %(errors)d errors\n' % summary)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,50 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from getpaid.replay import load_notifications, replay
+
+
+class Command(BaseCommand):
+    args = 'FILE'
+    help = 'Replay notifications of payment brokers captured to FILE (one JSON object per line) against backend ' \
+           'views and report throughput, latency, response codes and database queries'
+    option_list = BaseCommand.option_list + (
+        make_option('--rate', type='float', default=0,
+                    help='Notifications sent per second [default: as fast as possible]'),
+        make_option('--concurrency', type='int', default=1,
+                    help='Notifications sent at a time [default: %default]'),
+        make_option('--url', default=None,
+                    help='Post notifications over HTTP to the shop at URL, e.g. http://127.0.0.1:8000, instead '
+                         'of calling views in this process'),
+        make_option('--repeat', type='int', default=1,
+                    help='Replay the file this many times [default: %default]'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give exactly one file of notifications')
+        if options['concurrency'] < 1 or options['repeat'] < 1:
+            raise CommandError('--concurrency and --repeat should be positive')
+        try:
+            with open(args[0]) as f:
+                notifications = load_notifications(f)
+        except (IOError, ValueError), e:
+            raise CommandError(str(e))
+        if not notifications:
+            raise CommandError('There are no notifications in %s' % args[0])
+
+        results = replay(notifications * options['repeat'], rate=options['rate'],
+                         concurrency=options['concurrency'], base_url=options['url'])
+
+        summary = results.as_dict()
+        self.stdout.write('Replayed %(notifications)d notifications in %(elapsed).2fs (%(throughput).1f/s)\n'
+                          % summary)
+        self.stdout.write('Latency: p50 %(p50).1fms, p90 %(p90).1fms, p99 %(p99).1fms, max %(max).1fms\n'
+                          % dict((key, value * 1000) for key, value in summary['latency'].items()))
+        if results.queries:
+            self.stdout.write('DB queries per notification: average %(average).1f, max %(max)d\n'
+                              % summary['queries'])
+        else:
+            self.stdout.write('DB queries per notification: n/a over HTTP\n')
+        self.stdout.write('Responses:\n')
+        for code, number in sorted(summary['codes'].items(), key=lambda item: (-item[1], item[0])):
+            self.stdout.write('%8d  %s\n' % (number, code))
@@ -0,0 +1,99 @@
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.loading import get_model
+from getpaid.replay import save_notification
+from getpaid.simulators import SIMULATORS, Behavior, SimulatorApp, get_simulators, start_server, storm
+
+
+def parse_latency(value):
+    if '-' in value:
+        return tuple(float(part) for part in value.split('-', 1))
+    return float(value)
+
+
+class Command(BaseCommand):
+    args = '[backend ...]'
+    help = 'Serve local simulators of payment gateways (of all simulated backends if none are given), or fire ' \
+           'a storm of notifications at the shop'
+    option_list = BaseCommand.option_list + (
+        make_option('--host', default='127.0.0.1',
+                    help='Address to serve simulators at [default: %default]'),
+        make_option('--port', type='int', default=8001,
+                    help='Port to serve simulators at [default: %default]'),
+        make_option('--shop-url', dest='shop_url', default=None,
+                    help='Address of the shop notifications are sent to [default: current Site domain]'),
+        make_option('--latency', default='0',
+                    help='Latency of gateway responses in seconds, e.g. 0.1 or 0.05-0.5 [default: %default]'),
+        make_option('--error-rate', type='float', default=0, dest='error_rate',
+                    help='Fraction of gateway requests answered with HTTP 500 [default: %default]'),
+        make_option('--retries', type='int', default=3,
+                    help='Retries of notifications not acknowledged by the shop [default: %default]'),
+        make_option('--retry-delay', type='float', default=1.0, dest='retry_delay',
+                    help='Seconds between retries of a notification [default: %default]'),
+        make_option('--callback-delay', type='float', default=0, dest='callback_delay',
+                    help='Seconds between payment and its notification [default: %default]'),
+        make_option('--duplicates', type='int', default=0,
+                    help='Copies of every notification sent again after it was acknowledged [default: %default]'),
+        make_option('--storm', type='int', default=0, metavar='NUMBER',
+                    help='Send NUMBER notifications about existing payments of given backend and exit'),
+        make_option('--rate', type='float', default=0,
+                    help='With --storm, notifications sent per second [default: as fast as possible]'),
+        make_option('--concurrency', type='int', default=4,
+                    help='With --storm, notifications sent at a time [default: %default]'),
+        make_option('--capture', metavar='FILE', default=None,
+                    help='With --storm, write notifications to FILE for getpaid_replay instead of sending them'),
+    )
+
+    def handle(self, *args, **options):
+        for backend in args:
+            if backend not in SIMULATORS:
+                raise CommandError('No simulator of %s, choose from: %s' % (backend, ', '.join(sorted(SIMULATORS))))
+        if options['storm'] and len(args) != 1:
+            raise CommandError('--storm needs exactly one backend')
+        if options['capture'] and not options['storm']:
+            raise CommandError('--capture requires --storm')
+        try:
+            latency = parse_latency(options['latency'])
+        except ValueError:
+            raise CommandError('--latency should be a number or a range, e.g. 0.05-0.5')
+        behavior = Behavior(latency=latency, error_rate=options['error_rate'], retries=options['retries'],
+                            retry_delay=options['retry_delay'], callback_delay=options['callback_delay'],
+                            duplicates=options['duplicates'])
+        simulators = get_simulators(args, shop_url=options['shop_url'], behavior=behavior)
+        server = start_server(SimulatorApp(simulators), options['host'], options['port'])
+        for simulator in simulators:
+            self.stdout.write('Simulating %s at %s/%s/\n' % (simulator.BACKEND, server.url, simulator.NAME))
+
+        try:
+            if options['storm']:
+                Payment = get_model('getpaid', 'Payment')
+                payments = list(Payment.objects.filter(backend=args[0]).values_list('pk', 'amount')[:1000])
+                if not payments:
+                    raise CommandError('There are no payments of %s' % args[0])
+                if options['capture']:
+                    self.capture(simulators[0], payments, options['storm'], options['capture'])
+                else:
+                    summary = storm(simulators[0], payments, options['storm'], rate=options['rate'],
+                                    concurrency=options['concurrency'])
+                    self.stdout.write('Sent %(sent)d notifications in %(elapsed).1fs (%(rate).1f/s), '
+                                      '%(acknowledged)d acknowledged\n' % summary)
+            else:
+                while True:
+                    time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            for simulator in simulators:
+                self.stdout.write('%s: %s\n' % (simulator.BACKEND, ', '.join(
+                    '%s=%d' % item for item in sorted(simulator.stats.as_dict().items()))))
+
+    def capture(self, simulator, payments, number, filename):
+        written = 0
+        with open(filename, 'w') as f:
+            for i in range(number):
+                for url, data in simulator.notification(*payments[i % len(payments)]):
+                    save_notification(f, url, data, remote_addr='127.0.0.1')
+                    written += 1
+        self.stdout.write('Wrote %d notifications to %s\n' % (written, filename))
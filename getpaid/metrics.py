@@ -0,0 +1,204 @@
+"""
+Latency histograms of payment hot paths, served in Prometheus text format.
+
+With ``GETPAID_METRICS`` setting enabled, timed code paths (payment creation, gateway calls, notification
+handling, signature verification, XML parsing, status updates) are recorded in histograms kept in process
+memory. Every process periodically saves its histograms to Django cache, and ``MetricsView`` merges histograms
+of all processes.
+"""
+from bisect import bisect_left
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test.signals import setting_changed
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DEFAULT_SETTINGS = {
+    'flush_interval': 10,
+    'allowed_ip': ('127.0.0.1', ),
+}
+
+HELP = {
+    'getpaid_new_payment_seconds': 'Time of creating payment and redirecting to gateway.',
+    'getpaid_gateway_url_seconds': 'Time of preparing gateway redirect by backend.',
+    'getpaid_online_seconds': 'Time of handling payment broker notification.',
+    'getpaid_signature_seconds': 'Time of verifying signature.',
+    'getpaid_xml_parse_seconds': 'Time of parsing XML message.',
+    'getpaid_gateway_request_seconds': 'Time of calling payment broker API.',
+    'getpaid_status_change_seconds': 'Time of writing payment status change.',
+    'getpaid_signal_receiver_seconds': 'Time of signal receiver call.',
+}
+
+_SNAPSHOT_KEY = 'getpaid.metrics:%s'
+_WORKERS_KEY = 'getpaid.metrics.workers'
+_WORKERS_LOCK_KEY = 'getpaid.metrics.workers.lock'
+SNAPSHOT_TIMEOUT = 24 * 3600
+WORKERS_LOCK_TIMEOUT = 10
+
+_histograms = {}
+_lock = threading.Lock()
+_config = None
+_next_flush = 0
+_worker = '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def get_config():
+    """
+    Returns dict of ``GETPAID_METRICS`` options (applied on top of ``DEFAULT_SETTINGS``) if the setting is
+    enabled, or ``None``.
+    """
+    global _config
+    if _config is None:
+        setting = getattr(settings, 'GETPAID_METRICS', False)
+        if setting:
+            _config = dict(DEFAULT_SETTINGS)
+            if isinstance(setting, dict):
+                _config.update(setting)
+        else:
+            _config = False
+    return _config or None
+
+
+def reset_config(**kwargs):
+    global _config, _next_flush
+    if kwargs.get('setting', 'GETPAID_METRICS') == 'GETPAID_METRICS':
+        _config = None
+        _next_flush = 0
+
+setting_changed.connect(reset_config)
+
+
+def observe(name, value, **labels):
+    """
+    Records ``value`` in seconds in histogram ``name`` with given ``labels``, if metrics are enabled.
+    """
+    config = get_config()
+    if config is None:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    index = bisect_left(BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # counts of buckets and of the +Inf bucket, sum
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[index] += 1
+        histogram[-1] += value
+    if time.time() >= _next_flush:
+        flush()
+
+
+class timed(object):
+    """
+    Context manager recording time of its block in histogram ``name``::
+
+        with timed('getpaid_online_seconds', backend=PaymentProcessor.BACKEND):
+            ...
+    """
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        if get_config() is not None:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is not None:
+            observe(self.name, time.time() - self.start, **self.labels)
+
+
+def snapshot():
+    """
+    Returns copy of histograms of this process.
+    """
+    with _lock:
+        return dict((key, list(histogram)) for key, histogram in _histograms.items())
+
+
+def flush():
+    """
+    Saves histograms of this process to cache, so they are served by all processes.
+    """
+    global _next_flush
+    config = get_config()
+    _next_flush = time.time() + (config['flush_interval'] if config else 0)
+    cache.set(_SNAPSHOT_KEY % _worker, snapshot(), SNAPSHOT_TIMEOUT)
+    if _worker not in (cache.get(_WORKERS_KEY) or []):
+        _register()
+
+
+def _register():
+    # Processes add themselves to the shared list of workers one at a time; if another one is doing it now,
+    # this one tries again on the next flush.
+    if not cache.add(_WORKERS_LOCK_KEY, 1, WORKERS_LOCK_TIMEOUT):
+        return
+    try:
+        workers = cache.get(_WORKERS_KEY) or []
+        if _worker not in workers:
+            cache.set(_WORKERS_KEY, workers + [_worker], SNAPSHOT_TIMEOUT)
+    finally:
+        cache.delete(_WORKERS_LOCK_KEY)
+
+
+def collect():
+    """
+    Returns histograms of all processes merged, as dict ``{(name, labels): bucket counts + [sum]}``.
+    """
+    flush()
+    workers = cache.get(_WORKERS_KEY) or []
+    snapshots = cache.get_many([_SNAPSHOT_KEY % worker for worker in workers])
+    # Fresh histograms of this process, also if cache is not shared
+    snapshots[_SNAPSHOT_KEY % _worker] = snapshot()
+    merged = {}
+    for histograms in snapshots.values():
+        for key, histogram in histograms.items():
+            total = merged.get(key)
+            if total is None:
+                merged[key] = list(histogram)
+            else:
+                for i, value in enumerate(histogram):
+                    total[i] += value
+    return merged
+
+
+def _format_labels(labels):
+    return ','.join(['%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+                                  .replace('\n', '\\n')) for name, value in labels])
+
+
+def render(histograms):
+    """
+    Returns ``histograms`` in Prometheus text exposition format.
+    """
+    lines = []
+    last_name = None
+    for (name, labels), histogram in sorted(histograms.items()):
+        if name != last_name:
+            lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+            lines.append('# TYPE %s histogram' % name)
+            last_name = name
+        label_text = _format_labels(labels)
+        prefix = label_text + ',' if label_text else ''
+        suffix = '{%s}' % label_text if label_text else ''
+        count = 0
+        for bound, bucket_count in zip(BUCKETS + ('+Inf', ), histogram):
+            count += bucket_count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, count))
+        lines.append('%s_sum%s %r' % (name, suffix, histogram[-1]))
+        lines.append('%s_count%s %d' % (name, suffix, count))
+    return u'\n'.join(lines) + u'\n'
+
+
+def clear():
+    with _lock:
+        _histograms.clear()
@@ -1,9 +1,12 @@
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models
 from django.utils.timezone import utc
 from django.utils.translation import ugettext_lazy as _
 from datetime import datetime
-import sys
 from abstract_mixin import AbstractMixin
+from dispatch import send_status_changed
+import metrics
+from registry import get_registry
 import signals
 from utils import import_backend_modules
 
@@ -15,6 +18,36 @@ PAYMENT_STATUS_CHOICES = (
         ('failed', _("failed")),
         )
 
+PAYMENT_STATUS_TRANSITIONS = {
+        'new': ('in_progress', 'partially_paid', 'paid', 'failed'),
+        'in_progress': ('partially_paid', 'paid', 'failed'),
+        'partially_paid': ('paid', 'failed'),
+        'paid': (),
+        'failed': ('in_progress', 'partially_paid', 'paid'),
+        }
+"""
+Statuses that payment in given status can be changed to. Backends can replace targets of some statuses
+with ``PaymentProcessorBase.BACKEND_STATUS_TRANSITIONS``.
+"""
+
+
+def compile_status_transitions(overrides=None):
+    """
+    Returns frozenset of allowed ``(old_status, new_status)`` pairs of ``PAYMENT_STATUS_TRANSITIONS``
+    updated with ``overrides``. Changes to the same status are never allowed.
+    """
+    table = dict(PAYMENT_STATUS_TRANSITIONS)
+    table.update(overrides or {})
+    statuses = frozenset(status for status, name in PAYMENT_STATUS_CHOICES)
+    for old_status, new_statuses in table.items():
+        unknown = set((old_status, ) + tuple(new_statuses)) - statuses
+        if unknown:
+            raise ImproperlyConfigured('Unknown payment status in transitions: %s' % ', '.join(sorted(unknown)))
+    return frozenset((old_status, new_status) for old_status, new_statuses in table.items()
+                     for new_status in new_statuses if new_status != old_status)
+
+DEFAULT_STATUS_TRANSITIONS = compile_status_transitions()
+
 class PaymentManager(models.Manager):
     def get_query_set(self):
         return super(PaymentManager, self).get_query_set().select_related('order')
@@ -45,38 +78,90 @@ class PaymentFactory(models.Model, AbstractMixin):
 
 
     @classmethod
-    def create(cls, order, backend):
+    def build(cls, order, backend):
         """
-            Builds Payment object based on given Order instance
+            Builds unsaved Payment object based on given Order instance
         """
         payment = Payment()
         payment.order = order
         payment.backend = backend
         signals.new_payment_query.send(sender=None, order=order, payment=payment)
+        return payment
+
+    @classmethod
+    def create(cls, order, backend, payment=None):
+        """
+            Builds Payment object based on given Order instance and saves it.
+            ``payment`` already returned by ``build()`` can be given.
+        """
+        if payment is None:
+            payment = cls.build(order, backend)
         payment.save()
         signals.new_payment.send(sender=None, order=order, payment=payment)
         return payment
 
     def get_processor(self):
+        return get_registry().get_processor(self.backend)
+
+    def get_status_transitions(self):
+        """
+        Returns allowed ``(old_status, new_status)`` pairs for backend of this payment.
+        """
         try:
-            __import__(self.backend)
-            module = sys.modules[self.backend]
-            return module.PaymentProcessor
-        except (ImportError, AttributeError):
-            raise ValueError("Backend '%s' is not available or provides no processor." % self.backend)
+            return self.get_processor().get_status_transitions()
+        except ValueError:
+            return DEFAULT_STATUS_TRANSITIONS
 
-    def change_status(self, new_status):
+    def change_status(self, new_status, **fields):
         """
         Always change payment status via this method. Otherwise the signal
         will not be emitted.
+
+        Status and given ``fields`` (e.g. ``amount_paid``) are written with a single
+        ``UPDATE`` that applies only if the payment is still in status this instance
+        has, so concurrent notifications cannot both change it. If another process
+        changed the status first, nothing is written, the signal is not emitted and
+        the instance status is refreshed. Only status and given ``fields`` are written:
+        pass values to store with the status change as ``fields`` instead of setting
+        them on the instance, and note that ``save()`` is not called, so ``pre_save``
+        and ``post_save`` are not sent for the update.
+
+        Changes that are not allowed by ``get_status_transitions()`` (including changes
+        to the same status, e.g. repeated notifications about a paid payment) are
+        ignored without writing anything. The exception is a further partial payment:
+        ``partially_paid`` payment stays ``partially_paid`` with a different
+        ``amount_paid``, guarded also by the ``amount_paid`` this instance has, and the
+        signal is not emitted as status does not change.
+
+        Returns boolean value if payment status (or ``amount_paid`` of a partially paid
+        payment) was changed
         """
         old_status = self.status
-        self.status = new_status
-        self.save()
-        signals.payment_status_changed.send(
-            sender=type(self), instance=self,
-            old_status=old_status, new_status=new_status
-            )
+        guard = {'status': old_status}
+        if old_status == new_status == 'partially_paid' and \
+                fields.get('amount_paid', self.amount_paid) != self.amount_paid:
+            guard['amount_paid'] = self.amount_paid
+        elif (old_status, new_status) not in self.get_status_transitions():
+            return False
+        values = dict(fields, status=new_status)
+        if self.pk is None:
+            for name, value in values.items():
+                setattr(self, name, value)
+            self.save()
+        else:
+            manager = type(self)._default_manager
+            with metrics.timed('getpaid_status_change_seconds', backend=self.backend):
+                updated = manager.filter(pk=self.pk, **guard).update(**values)
+            if not updated:
+                current = list(manager.filter(pk=self.pk).values_list('status', 'amount_paid'))
+                if current:
+                    self.status, self.amount_paid = current[0]
+                return False
+            for name, value in values.items():
+                setattr(self, name, value)
+        if old_status != new_status:
+            send_status_changed(self, old_status, new_status)
+        return True
 
     def on_success(self, amount=None):
         """
@@ -86,16 +171,16 @@ class PaymentFactory(models.Model, AbstractMixin):
 
         Returns boolean value if payment was fully paid
         """
-        self.paid_on = datetime.utcnow().replace(tzinfo=utc)
+        paid_on = datetime.utcnow().replace(tzinfo=utc)
         if amount:
-            self.amount_paid = amount
+            amount_paid = amount
         else:
-            self.amount_paid = self.amount
-        fully_paid = (self.amount_paid >= self.amount)
+            amount_paid = self.amount
+        fully_paid = (amount_paid >= self.amount)
         if fully_paid:
-            self.change_status('paid')
+            self.change_status('paid', amount_paid=amount_paid, paid_on=paid_on)
         else:
-            self.change_status('partially_paid')
+            self.change_status('partially_paid', amount_paid=amount_paid, paid_on=paid_on)
         return fully_paid
 
 
@@ -106,6 +191,59 @@ class PaymentFactory(models.Model, AbstractMixin):
         self.change_status('failed')
 
 
+class ProcessedNotification(models.Model):
+    """
+    Notification from payment broker that was already processed, see ``getpaid.backends.ledger``.
+    """
+    backend = models.CharField(_("backend"), max_length=50)
+    transaction_id = models.CharField(_("transaction id"), max_length=100)
+    payload_hash = models.CharField(_("payload hash"), max_length=32)
+    response = models.TextField(_("response"))
+    created_on = models.DateTimeField(_("created on"), auto_now_add=True)
+
+    class Meta:
+        unique_together = (('backend', 'transaction_id', 'payload_hash'), )
+        verbose_name = _("Processed notification")
+        verbose_name_plural = _("Processed notifications")
+
+
+class InboxNotification(models.Model):
+    """
+    Verified notification from payment broker waiting to be processed, see ``getpaid.backends.inbox``.
+    """
+    backend = models.CharField(_("backend"), max_length=50)
+    payment_id = models.IntegerField(_("payment id"), db_index=True)
+    payload = models.TextField(_("payload"))
+    received_on = models.DateTimeField(_("received on"), auto_now_add=True)
+    processed_on = models.DateTimeField(_("processed on"), blank=True, null=True, db_index=True)
+    response = models.TextField(_("response"), blank=True)
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    error = models.TextField(_("error"), blank=True)
+    failed_on = models.DateTimeField(_("failed on"), blank=True, null=True)
+
+    class Meta:
+        ordering = ('pk', )
+        verbose_name = _("Inbox notification")
+        verbose_name_plural = _("Inbox notifications")
+
+
+class OutboxMessage(models.Model):
+    """
+    Celery task call waiting to be sent to the broker, see ``getpaid.backends.outbox``.
+    """
+    task = models.CharField(_("task"), max_length=200)
+    payload = models.TextField(_("payload"))
+    eta = models.DateTimeField(_("eta"), blank=True, null=True)
+    created_on = models.DateTimeField(_("created on"), auto_now_add=True)
+    sent_on = models.DateTimeField(_("sent on"), blank=True, null=True, db_index=True)
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+
+    class Meta:
+        ordering = ('pk', )
+        verbose_name = _("Outbox message")
+        verbose_name_plural = _("Outbox messages")
+
+
 from django.db.models.loading import cache as app_cache, register_models
 #from utils import import_backend_modules
 
@@ -0,0 +1,121 @@
+"""
+Redirect plans: where and how a client is sent to the payment gateway.
+
+A plan is computed by backend ``get_gateway_url()`` once per payment. With ``GETPAID_REDIRECT_PLAN_TIMEOUT``
+setting given, it is kept in Django cache for that many seconds: when a client submits payment of the same order
+with the same backend again (e.g. refreshes the page or goes back and clicks again) while the previous payment is
+still in progress, the payment and its plan are reused, so no new ``Payment`` row is created and the gateway is
+not called again (e.g. Platron ``init_payment.php``). Plans a backend marks as not reusable (e.g. a redirect to the
+failure page after the gateway refused the payment) are never cached, and their payments are not put in progress.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.loading import get_model
+from django.test.signals import setting_changed
+from getpaid import metrics
+
+DEFAULT_TIMEOUT = 0
+
+_PLAN_KEY = 'getpaid.redirect_plan:%s'
+
+_timeout = None
+
+
+class RedirectPlan(object):
+    """
+    Gateway ``url`` the client is sent to with ``method`` (``GET`` or ``POST``), and ``params`` posted to it.
+    A plan which is not ``reusable`` is not cached.
+    """
+
+    def __init__(self, url, method, params=None, reusable=True):
+        method = method.upper()
+        if method not in ('GET', 'POST'):
+            raise ImproperlyConfigured('Gateway redirect method should be GET or POST, not %s' % method)
+        self.url = url
+        self.method = method
+        self.params = params
+        self.reusable = reusable
+
+    def __eq__(self, other):
+        return isinstance(other, RedirectPlan) and (self.url, self.method, self.params) == (other.url,
+                                                                                            other.method,
+                                                                                            other.params)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def get_timeout():
+    """
+    Returns seconds redirect plans are cached for, 0 if caching and reusing payments is disabled.
+    """
+    global _timeout
+    if _timeout is None:
+        _timeout = getattr(settings, 'GETPAID_REDIRECT_PLAN_TIMEOUT', DEFAULT_TIMEOUT) or 0
+    return _timeout
+
+
+def reset_timeout(**kwargs):
+    global _timeout
+    if kwargs.get('setting', 'GETPAID_REDIRECT_PLAN_TIMEOUT') == 'GETPAID_REDIRECT_PLAN_TIMEOUT':
+        _timeout = None
+
+setting_changed.connect(reset_timeout)
+
+
+def get_cached_plan(payment):
+    """
+    Returns cached ``RedirectPlan`` of ``payment`` or ``None``.
+    """
+    if not get_timeout():
+        return None
+    return cache.get(_PLAN_KEY % payment.pk)
+
+
+def compute_plan(payment, request):
+    """
+    Asks backend of ``payment`` where to redirect the client, caches and returns ``RedirectPlan``.
+    """
+    processor = payment.get_processor()(payment)
+    with metrics.timed('getpaid_gateway_url_seconds', backend=payment.backend):
+        url, method, params = processor.get_gateway_url(request)
+    plan = RedirectPlan(url, method, params, reusable=processor.gateway_url_reusable)
+    if get_timeout() and plan.reusable:
+        cache.set(_PLAN_KEY % payment.pk, plan, get_timeout())
+    return plan
+
+
+def get_reusable_payment(order, backend, amount, currency):
+    """
+    Returns the latest payment of ``order`` with ``backend``, ``amount`` and ``currency`` which is still in
+    progress and has a cached plan, as tuple of payment and its plan, or ``(None, None)``.
+    """
+    if not get_timeout():
+        return None, None
+    Payment = get_model('getpaid', 'Payment')
+    payments = Payment.objects.filter(order=order, backend=backend, amount=amount, currency=currency,
+                                      status='in_progress').order_by('-pk')[:1]
+    for payment in payments:
+        plan = get_cached_plan(payment)
+        if plan is not None:
+            return payment, plan
+    return None, None
+
+
+def plan_payment(order, backend, request):
+    """
+    Returns tuple of payment of ``order`` with ``backend`` and its ``RedirectPlan``. A payment in progress with the
+    same amount and currency and a cached plan is reused, otherwise a new one is created and put in progress (unless
+    its plan is not reusable, i.e. the gateway refused it).
+    """
+    Payment = get_model('getpaid', 'Payment')
+    payment = Payment.build(order, backend)
+    reused, plan = get_reusable_payment(order, backend, payment.amount, payment.currency)
+    if reused is not None:
+        return reused, plan
+    payment = Payment.create(order, backend, payment=payment)
+    plan = compute_plan(payment, request)
+    if plan.reusable:
+        payment.change_status('in_progress')
+    return payment, plan
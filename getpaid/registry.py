@@ -0,0 +1,104 @@
+from collections import namedtuple
+from django.conf import settings
+from django.test.signals import setting_changed
+import sys
+
+
+Backend = namedtuple('Backend', ('name', 'processor', 'accepted_currency', 'display_name', 'logo_url'))
+
+
+class BackendRegistry(object):
+    """
+    Immutable registry of enabled backends built from ``settings.GETPAID_BACKENDS``.
+
+    Every backend module is imported and its settings are validated only once, when the registry
+    is built. Backends keep the order they are defined in settings, also in per-currency index.
+    """
+
+    def __init__(self, backend_names):
+        backends = []
+        by_currency = {}
+        for backend_name in backend_names:
+            __import__(backend_name)
+            processor = sys.modules[backend_name].PaymentProcessor
+            processor.get_backend_config().validate()
+            processor.get_status_transitions()
+            backend = Backend(
+                name=backend_name,
+                processor=processor,
+                accepted_currency=frozenset(processor.BACKEND_ACCEPTED_CURRENCY),
+                display_name=processor.BACKEND_NAME,
+                logo_url=processor.get_logo_url(),
+            )
+            backends.append(backend)
+            for currency in processor.BACKEND_ACCEPTED_CURRENCY:
+                by_currency.setdefault(currency, []).append(backend)
+
+        self._backends = tuple(backends)
+        self._by_name = dict((backend.name, backend) for backend in backends)
+        self._choices = tuple((backend.name, backend.display_name) for backend in backends)
+        self._by_currency = dict((currency, tuple(currency_backends))
+                                 for currency, currency_backends in by_currency.items())
+        self._choices_by_currency = dict(
+            (currency, tuple((backend.name, backend.display_name) for backend in currency_backends))
+            for currency, currency_backends in self._by_currency.items()
+        )
+
+    def __iter__(self):
+        return iter(self._backends)
+
+    def __len__(self):
+        return len(self._backends)
+
+    def __contains__(self, backend_name):
+        return backend_name in self._by_name
+
+    def __getitem__(self, backend_name):
+        return self._by_name[backend_name]
+
+    @property
+    def names(self):
+        return tuple(backend.name for backend in self._backends)
+
+    def get_processor(self, backend_name):
+        try:
+            return self._by_name[backend_name].processor
+        except KeyError:
+            raise ValueError("Backend '%s' is not available or provides no processor." % backend_name)
+
+    def get_backends(self, currency=None):
+        """
+        Returns tuple of enabled backends, optionally only those supporting given currency.
+        """
+        if currency:
+            return self._by_currency.get(currency, ())
+        return self._backends
+
+    def get_choices(self, currency=None):
+        """
+        Returns list of ``(backend_name, display_name)`` choices, optionally only those supporting given currency.
+        """
+        if currency:
+            return list(self._choices_by_currency.get(currency, ()))
+        return list(self._choices)
+
+
+_registry = None
+
+
+def get_registry():
+    """
+    Returns backend registry, building it on first use.
+    """
+    global _registry
+    if _registry is None:
+        _registry = BackendRegistry(getattr(settings, 'GETPAID_BACKENDS', []))
+    return _registry
+
+
+def reset_registry(**kwargs):
+    global _registry
+    if kwargs.get('setting', 'GETPAID_BACKENDS') == 'GETPAID_BACKENDS':
+        _registry = None
+
+setting_changed.connect(reset_registry)
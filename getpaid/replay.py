@@ -0,0 +1,221 @@
+"""
+Replay of captured payment broker notifications, e.g. for tuning throughput or re-driving traffic after an
+incident.
+
+Notifications are read from a file with one JSON object per line::
+
+    {"url": "/getpaid.backends.payu/online/", "params": {"pos_id": "123456789", ...}, "remote_addr": "1.2.3.4"}
+
+``url`` is a path of backend ``OnlineView`` (or Platron check/result view) and ``params`` are the POST values;
+``remote_addr`` is optional. Such files are written e.g. by ``getpaid_simulator --capture``. Notifications are
+posted to the views in-process (through ``RequestFactory``, counting database queries) or over HTTP.
+"""
+import json
+import logging
+import Queue
+import re
+import threading
+import time
+import urlparse
+
+from django.core.urlresolvers import Resolver404, resolve
+from django.db import connection
+from django.test.client import RequestFactory
+from getpaid.backends.httpclient import HTTPClient, HTTPError
+from getpaid.instrumentation import Timings
+
+logger = logging.getLogger('getpaid.replay')
+
+_XML_STATUS = re.compile(r'<pg_status>([^<]*)</pg_status>')
+_XML_DESCRIPTION = re.compile(r'<pg_description>([^<]+)</pg_description>')
+
+
+def load_notifications(lines):
+    """
+    Returns list of notifications read from ``lines`` of JSON, e.g. an open file. Blank lines are skipped.
+    """
+    notifications = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            notification = json.loads(line)
+            notification['url'], notification['params']
+        except (ValueError, KeyError, TypeError):
+            raise ValueError('Line %d is not a notification: %s' % (number, line.strip()[:100]))
+        notifications.append(notification)
+    return notifications
+
+
+def save_notification(file, url, params, remote_addr=None):
+    """
+    Appends notification to ``file`` in the format read by ``load_notifications()``.
+    """
+    notification = {
+        'url': urlparse.urlsplit(url).path,
+        'params': dict((key, unicode(value)) for key, value in params.items()),
+    }
+    if remote_addr:
+        notification['remote_addr'] = remote_addr
+    file.write(json.dumps(notification, sort_keys=True) + '\n')
+
+
+def get_response_code(status, body):
+    """
+    Returns short name of a view response, e.g. ``OK`` or ``SIG ERR``, and status with description of Platron
+    XML responses, e.g. ``ok`` or ``error: Wrong signature``.
+    """
+    if status != 200:
+        return 'HTTP %s' % status
+    match = _XML_STATUS.search(body)
+    if match is not None:
+        description = _XML_DESCRIPTION.search(body)
+        return '%s: %s' % (match.group(1), description.group(1)) if description else match.group(1)
+    return body.strip()[:40]
+
+
+class ReplayResults(object):
+    """
+    Results of a replay: ``latency`` timings, ``codes`` dict with numbers of responses, ``queries`` list of numbers
+    of database queries made by notifications (empty if not counted) and ``elapsed`` seconds.
+    """
+
+    def __init__(self):
+        self.latency = Timings(samples=None)
+        self.codes = {}
+        self.queries = []
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed, code, queries=None):
+        with self._lock:
+            self.latency.record(elapsed)
+            self.codes[code] = self.codes.get(code, 0) + 1
+            if queries is not None:
+                self.queries.append(queries)
+
+    @property
+    def throughput(self):
+        return self.latency.count / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            'notifications': self.latency.count,
+            'elapsed': self.elapsed,
+            'throughput': self.throughput,
+            'latency': self.latency.as_dict(),
+            'codes': dict(self.codes),
+            'queries': {
+                'average': float(sum(self.queries)) / len(self.queries) if self.queries else None,
+                'max': max(self.queries) if self.queries else None,
+            },
+        }
+
+
+class InProcessSender(object):
+    """
+    Posts notifications to views resolved from their URLs in this process and counts their database queries.
+    """
+
+    def __init__(self):
+        self.factory = RequestFactory()
+
+    def __call__(self, notification):
+        path = urlparse.urlsplit(notification['url']).path
+        try:
+            view, args, kwargs = resolve(path)
+        except Resolver404:
+            return 'NO VIEW', None
+        request = self.factory.post(path, notification['params'],
+                                    REMOTE_ADDR=notification.get('remote_addr', '127.0.0.1'))
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        del connection.queries[:]
+        try:
+            response = view(request, *args, **kwargs)
+            return get_response_code(response.status_code, response.content), len(connection.queries)
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+            del connection.queries[:]
+
+    def close(self):
+        # Django opens a connection for every thread
+        connection.close()
+
+
+class HTTPSender(object):
+    """
+    Posts notifications over HTTP to the shop at ``base_url``.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.client = HTTPClient(retries=0)
+
+    def __call__(self, notification):
+        params = dict((key, unicode(value).encode('utf-8')) for key, value in notification['params'].items())
+        try:
+            response = self.client.post(self.base_url + urlparse.urlsplit(notification['url']).path, params)
+        except HTTPError:
+            return 'HTTP ERROR', None
+        return get_response_code(response.status, response.body), None
+
+    def close(self):
+        pass
+
+
+def replay(notifications, rate=0, concurrency=1, base_url=None):
+    """
+    Posts ``notifications`` at most ``rate`` per second (as fast as possible if 0), ``concurrency`` at a time (in
+    the calling thread if 1), to views in this process or, if ``base_url`` is given, over HTTP.
+
+    Returns ``ReplayResults``.
+    """
+    sender = HTTPSender(base_url) if base_url else InProcessSender()
+    results = ReplayResults()
+
+    def send(notification):
+        start = time.time()
+        try:
+            code, queries = sender(notification)
+        except Exception, e:
+            logger.exception('Replaying notification to %s failed' % notification['url'])
+            code, queries = 'EXC %s' % type(e).__name__, None
+        results.record(time.time() - start, code, queries)
+
+    def work():
+        try:
+            while True:
+                notification = queue.get()
+                if notification is None:
+                    break
+                send(notification)
+        finally:
+            sender.close()
+
+    if concurrency > 1:
+        queue = Queue.Queue(concurrency * 2)
+        workers = [threading.Thread(target=work) for i in range(concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+    start = time.time()
+    try:
+        for i, notification in enumerate(notifications):
+            if rate:
+                delay = start + float(i) / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if concurrency > 1:
+                queue.put(notification)
+            else:
+                send(notification)
+    finally:
+        if concurrency > 1:
+            for worker in workers:
+                queue.put(None)
+            for worker in workers:
+                worker.join()
+    results.elapsed = time.time() - start
+    return results
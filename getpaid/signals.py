@@ -1,6 +1,6 @@
-from django.dispatch import Signal
+from getpaid.instrumentation import TimedSignal
 
-new_payment_query = Signal(providing_args=['order', 'payment'])
+new_payment_query = TimedSignal('new_payment_query', providing_args=['order', 'payment'])
 new_payment_query.__doc__ = """
 Sent to ask for filling Payment object with additional data:
     payment.amount:			total amount of an order
@@ -10,7 +10,7 @@ This data cannot be filled by ``getpaid`` because it is Order structure
 agnostic. After filling values just do return.
 """
 
-user_data_query = Signal(providing_args=['order', 'user_data'])
+user_data_query = TimedSignal('user_data_query', providing_args=['order', 'user_data'])
 new_payment_query.__doc__ = """
 Sent to ask for filling user additional data:
     user_data['email']:		user email
@@ -20,9 +20,16 @@ This data cannot be filled by ``getpaid`` because it is Order structure
 agnostic. After filling values just do return.
 """
 
-new_payment = Signal(providing_args=['order', 'payment'])
+new_payment = TimedSignal('new_payment', providing_args=['order', 'payment'])
 new_payment.__doc__ = """Sent after creating new payment."""
 
 
-payment_status_changed = Signal(providing_args=['old_status', 'new_status'])
-payment_status_changed.__doc__ = """Sent when Payment status changes."""
\ No newline at end of file
+payment_status_changed = TimedSignal('payment_status_changed', providing_args=['old_status', 'new_status'])
+payment_status_changed.__doc__ = """Sent when Payment status changes."""
+payment_statuses_changed = TimedSignal('payment_statuses_changed', providing_args=['changes'])
+payment_statuses_changed.__doc__ = """
+Sent with list of ``(payment, old_status, new_status)`` changes, in order they were made:
+    after every ``payment_status_changed`` signal, with the single change
+    or, with ``GETPAID_DISPATCH_AFTER_COMMIT`` setting, once for all changes
+    committed by a notification handler
+"""
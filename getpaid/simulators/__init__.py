@@ -0,0 +1,335 @@
+"""
+Local simulators of payment gateways, for load testing without the network.
+
+Every simulator mimics the gateway side of one backend: it answers requests the backend sends to the gateway
+and, once a client "pays" on the simulated payment page, notifies the shop like the gateway would, with payloads
+signed by the backend's own algorithms and keys. Backends are pointed at a simulator with their ``gateway_url``
+setting (``init_payment_url`` for Platron). Simulators are served together by ``SimulatorApp``, a WSGI app which
+can run in a thread of the calling process (``start_server()``) or with ``getpaid_simulator`` command, and adds
+configurable latency and errors to gateway responses. ``storm()`` fires notifications at the shop at a given rate.
+"""
+from multiprocessing.pool import ThreadPool
+from itertools import count
+import httplib
+import logging
+import random
+import threading
+import time
+import urllib
+import urlparse
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+import SocketServer
+
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from django.utils.importlib import import_module
+from getpaid.backends.httpclient import HTTPClient, HTTPError
+
+logger = logging.getLogger('getpaid.simulators')
+
+SIMULATORS = {
+    'getpaid.backends.dotpay': 'getpaid.simulators.dotpay',
+    'getpaid.backends.payanyway': 'getpaid.simulators.payanyway',
+    'getpaid.backends.payu': 'getpaid.simulators.payu',
+    'getpaid.backends.platron': 'getpaid.simulators.platron',
+    'getpaid.backends.transferuj': 'getpaid.simulators.transferuj',
+}
+
+
+class Behavior(object):
+    """
+    How simulated gateways behave: ``latency`` of their responses in seconds (a number or ``(min, max)`` range),
+    ``error_rate`` (fraction of requests answered with HTTP 500), number of ``retries`` of a notification which
+    the shop did not acknowledge, ``retry_delay`` between them, ``callback_delay`` before the first attempt and
+    number of ``duplicates`` of every notification sent after it was acknowledged.
+    """
+
+    def __init__(self, latency=0, error_rate=0, retries=3, retry_delay=1.0, callback_delay=0, duplicates=0,
+                 seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.callback_delay = callback_delay
+        self.duplicates = duplicates
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def get_latency(self):
+        if isinstance(self.latency, (tuple, list)):
+            with self._lock:
+                return self._random.uniform(*self.latency)
+        return self.latency
+
+    def fails(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+class SimulatorStats(object):
+    """
+    Numbers of gateway ``requests`` and simulated ``errors``, and of ``notifications`` sent to the shop, their
+    ``retries``, ``acknowledged`` ones and ones ``failed`` after all retries.
+    """
+    FIELDS = ('requests', 'errors', 'notifications', 'retries', 'acknowledged', 'failed')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def add(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        with self._lock:
+            return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    def clear(self):
+        with self._lock:
+            for name in self.FIELDS:
+                setattr(self, name, 0)
+
+
+_http_client = HTTPClient(retries=0)
+
+
+def http_transport(url, data):
+    """
+    Posts ``data`` to ``url`` and returns tuple of HTTP status and response body.
+    """
+    data = dict((key, unicode(value).encode('utf-8')) for key, value in data.items())
+    try:
+        response = _http_client.post(url, data)
+    except HTTPError, e:
+        logger.warning('Notification to %s failed: %s' % (url, e))
+        return None, ''
+    return response.status, response.body
+
+
+class Request(object):
+    """
+    Request received by a simulator: ``path`` is relative to the simulator, ``params`` are query string and
+    form encoded body values (single ones), ``body`` is the raw body.
+    """
+
+    def __init__(self, method, path, params, body='', content_type=''):
+        self.method = method
+        self.path = path
+        self.params = params
+        self.body = body
+        self.content_type = content_type
+
+
+class GatewaySimulator(object):
+    """
+    Base of gateway simulators. ``ROUTES`` maps paths to names of methods taking ``Request`` and returning tuple
+    of HTTP status, headers and body. ``ACK`` is what the shop answers to acknowledge a notification.
+    """
+    BACKEND = None
+    NAME = None
+    ROUTES = {}
+    ACK = 'OK'
+
+    def __init__(self, shop_url=None, behavior=None, transport=http_transport, workers=4):
+        self.shop_url = (shop_url or 'http://%s' % Site.objects.get_current().domain).rstrip('/')
+        self.behavior = behavior or Behavior()
+        self.transport = transport
+        self.stats = SimulatorStats()
+        self._ids = count(1)
+        self._pool = ThreadPool(workers) if workers else None
+
+    @property
+    def processor(self):
+        return import_module(self.BACKEND).PaymentProcessor
+
+    def get_config(self):
+        return self.processor.get_backend_config()
+
+    def next_id(self):
+        return self._ids.next()
+
+    def shop(self, view, **kwargs):
+        """
+        Returns absolute URL of shop ``view``, e.g. ``shop('getpaid:payu:online')``.
+        """
+        return self.shop_url + reverse(view, kwargs=kwargs or None)
+
+    def handle(self, request):
+        method = self.ROUTES.get(request.path)
+        if method is None:
+            return 404, [], 'Not found'
+        return getattr(self, method)(request)
+
+    def acknowledged(self, body):
+        return body.strip() == self.ACK
+
+    def notification(self, payment_id, amount):
+        """
+        Returns list of ``(url, data)`` notifications sent to the shop when payment ``payment_id`` of ``amount``
+        is paid.
+        """
+        raise NotImplementedError
+
+    def notify(self, notifications):
+        """
+        Sends ``(url, data)`` notifications to the shop one after another, in background unless ``workers`` is 0.
+        """
+        if self._pool is None:
+            self.deliver(notifications)
+        else:
+            self._pool.apply_async(self.deliver, (notifications, ))
+
+    def deliver(self, notifications):
+        """
+        Sends ``(url, data)`` notifications to the shop, retrying every one until it is acknowledged. Stops if one
+        of them is not acknowledged after all retries. Returns ``True`` if all were acknowledged.
+        """
+        behavior = self.behavior
+        if behavior.callback_delay:
+            time.sleep(behavior.callback_delay)
+        for url, data in notifications:
+            for copy in range(1 + behavior.duplicates):
+                for attempt in range(1 + behavior.retries):
+                    if attempt:
+                        self.stats.add('retries')
+                        time.sleep(behavior.retry_delay)
+                    self.stats.add('notifications')
+                    status, body = self.transport(url, data)
+                    if status == 200 and self.acknowledged(body):
+                        self.stats.add('acknowledged')
+                        break
+                else:
+                    self.stats.add('failed')
+                    logger.warning('Notification to %s was not acknowledged: %s' % (url, data))
+                    return False
+        return True
+
+    @staticmethod
+    def redirect(url, params=None):
+        if params:
+            url += ('&' if '?' in url else '?') + urllib.urlencode(params)
+        return 302, [('Location', url)], ''
+
+    @staticmethod
+    def xml(body):
+        return 200, [('Content-Type', 'text/xml; charset=utf-8')], body
+
+
+class SimulatorApp(object):
+    """
+    WSGI app serving ``simulators`` under paths made of their names, e.g. ``/payu/UTF/NewPayment``, with latency
+    and errors of their ``behavior``.
+    """
+
+    def __init__(self, simulators):
+        self.simulators = dict((simulator.NAME, simulator) for simulator in simulators)
+
+    def request(self, method, url, data=None, content_type='application/x-www-form-urlencoded'):
+        """
+        Handles request without HTTP, e.g. in tests. ``data`` is dict of form values or raw body. Returns tuple
+        of HTTP status, headers and body.
+        """
+        parts = urlparse.urlsplit(url)
+        if isinstance(data, dict):
+            data = urllib.urlencode(data)
+        return self.dispatch(method, parts.path, parts.query, data or '', content_type)
+
+    def dispatch(self, method, path, query, body, content_type):
+        name, _, path = path.lstrip('/').partition('/')
+        simulator = self.simulators.get(name)
+        if simulator is None:
+            return 404, [], 'Not found'
+        simulator.stats.add('requests')
+        latency = simulator.behavior.get_latency()
+        if latency:
+            time.sleep(latency)
+        if simulator.behavior.fails():
+            simulator.stats.add('errors')
+            return 500, [], 'Simulated error'
+        params = dict(urlparse.parse_qsl(query))
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            params.update(urlparse.parse_qsl(body))
+        return simulator.handle(Request(method, path, params, body, content_type))
+
+    def __call__(self, environ, start_response):
+        length = environ.get('CONTENT_LENGTH')
+        body = environ['wsgi.input'].read(int(length)) if length else ''
+        status, headers, body = self.dispatch(environ['REQUEST_METHOD'], environ.get('PATH_INFO', '/'),
+                                              environ.get('QUERY_STRING', ''), body,
+                                              environ.get('CONTENT_TYPE', ''))
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        start_response('%d %s' % (status, httplib.responses.get(status, '')),
+                       headers + [('Content-Length', str(len(body)))])
+        return [body]
+
+
+def get_simulators(backends=None, **kwargs):
+    """
+    Returns simulators of given ``backends`` (all simulated ones by default), ``kwargs`` are passed to each.
+    """
+    behavior = kwargs.pop('behavior', None) or Behavior()
+    return [import_module(SIMULATORS[backend]).Simulator(behavior=behavior, **kwargs)
+            for backend in sorted(backends or SIMULATORS)]
+
+
+class _ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def start_server(app, host='127.0.0.1', port=0):
+    """
+    Serves ``app`` in a background thread and returns the server; its address is in ``server.url``. Stop it
+    with ``server.shutdown()``.
+    """
+    server = make_server(host, port, app, server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+    server.url = 'http://%s:%d' % (host, server.server_port)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05, ))
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def storm(simulator, payments, number, rate=0, concurrency=4):
+    """
+    Sends ``number`` notifications of ``simulator`` about ``payments`` (list of ``(payment_id, amount)``, used in
+    turn) at most ``rate`` per second (as fast as possible if 0), ``concurrency`` at a time (in the calling thread
+    if 1).
+
+    Returns dict with number of ``sent`` and ``acknowledged`` notifications, ``elapsed`` seconds and ``rate``.
+    """
+    pool = ThreadPool(concurrency) if concurrency > 1 else None
+    results = []
+    start = time.time()
+    try:
+        for i in range(number):
+            if rate:
+                wait = start + float(i) / rate - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            notifications = simulator.notification(*payments[i % len(payments)])
+            if pool is None:
+                results.append(simulator.deliver(notifications))
+            else:
+                results.append(pool.apply_async(simulator.deliver, (notifications, )))
+        if pool is not None:
+            results = [result.get() for result in results]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+    return {
+        'sent': number,
+        'acknowledged': sum(1 for result in results if result),
+        'elapsed': elapsed,
+        'rate': number / elapsed if elapsed else 0.0,
+    }
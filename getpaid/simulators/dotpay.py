@@ -0,0 +1,44 @@
+"""
+Simulator of Dotpay: payment page and URLC notifications.
+"""
+from getpaid.simulators import GatewaySimulator
+
+
+class Simulator(GatewaySimulator):
+    BACKEND = 'getpaid.backends.dotpay'
+    NAME = 'dotpay'
+    ROUTES = {'': 'payment'}
+
+    def online_notification(self, url, control, amount, currency, email=u''):
+        config = self.get_config()
+        data = {
+            'id': unicode(config.id),
+            'status': u'OK',
+            'control': unicode(control),
+            't_id': u'%s-SIM%d' % (config.id, self.next_id()),
+            'amount': unicode(amount),
+            'orginal_amount': u'%s %s' % (amount, currency),
+            'email': email,
+            't_status': u'2',
+            'service': u'',
+            'code': u'',
+            'username': u'',
+            'password': u'',
+        }
+        data['md5'] = self.processor._ONLINE_SIG.compute(data, config.PIN)
+        return url, data
+
+    def notification(self, payment_id, amount):
+        return [self.online_notification(self.shop('getpaid:dotpay:online'), payment_id, amount, 'PLN')]
+
+    def payment(self, request):
+        params = request.params
+        if unicode(params.get('id')) != unicode(self.get_config().id):
+            return 200, [], 'Wrong id'
+        if not all(params.get(name) for name in ('amount', 'control', 'URLC')):
+            return 200, [], 'Missing parameters'
+        self.notify([self.online_notification(params['URLC'], params['control'], params['amount'],
+                                              params.get('currency', 'PLN'), params.get('email', u''))])
+        if params.get('URL'):
+            return self.redirect(params['URL'])
+        return 200, [], 'Paid'
@@ -0,0 +1,51 @@
+"""
+Simulator of PayAnyWay: payment page and pay notifications.
+"""
+from getpaid.simulators import GatewaySimulator
+
+
+class Simulator(GatewaySimulator):
+    BACKEND = 'getpaid.backends.payanyway'
+    NAME = 'payanyway'
+    ROUTES = {'assistant.htm': 'payment'}
+    ACK = 'SUCCESS'
+
+    def get_account(self):
+        """
+        Returns account id and key the backend uses.
+        """
+        config = self.get_config()
+        if bool(config.demo):
+            return config.demo_id, config.demo_key
+        return config.id, config.key
+
+    def online_notification(self, transaction_id, amount, currency_code, test_mode):
+        id, key = self.get_account()
+        params = {
+            'command': u'',
+            'id': unicode(id),
+            'transaction_id': unicode(transaction_id),
+            'operation_id': unicode(self.next_id()),
+            'amount': unicode(amount),
+            'currency_code': currency_code,
+            'test_mode': test_mode,
+        }
+        data = dict(('MNT_%s' % name.upper(), value) for name, value in params.items() if name != 'command')
+        data['MNT_SIGNATURE'] = self.processor._CHECK_SIG.compute(params, key)
+        return self.shop('getpaid:payanyway:online'), data
+
+    def notification(self, payment_id, amount):
+        config = self.get_config()
+        return [self.online_notification(payment_id, '%.2f' % amount, config.currency,
+                                         u'1' if bool(config.testing) else u'0')]
+
+    def payment(self, request):
+        id, key = self.get_account()
+        params = request.params
+        if not self.processor._PAY_FORM_SIG.verify(params, key, params.get('MNT_SIGNATURE', '')):
+            return 200, [], 'Wrong signature'
+        if params.get('MNT_ID') != unicode(id):
+            return 200, [], 'Wrong MNT_ID'
+        self.notify([self.online_notification(params['MNT_TRANSACTION_ID'], params['MNT_AMOUNT'],
+                                              params['MNT_CURRENCY_CODE'], params['MNT_TEST_MODE'])])
+        return self.redirect(self.shop('getpaid:payanyway:success'))
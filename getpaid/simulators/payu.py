@@ -0,0 +1,74 @@
+"""
+Simulator of PayU: NewPayment redirects, Payment/get XML API and online notifications.
+"""
+import threading
+import time
+
+from getpaid.backends.xmlwriter import XMLTemplate, escape
+from getpaid.simulators import GatewaySimulator
+
+
+class Simulator(GatewaySimulator):
+    BACKEND = 'getpaid.backends.payu'
+    NAME = 'payu'
+    ROUTES = {
+        'UTF/NewPayment': 'new_payment',
+        'UTF/Payment/get/xml': 'payment_get',
+    }
+
+    _ERROR = XMLTemplate(u'<?xml version="1.0" encoding="UTF-8"?>\n<response>\n<status>ERROR</status>\n'
+                         u'<error>\n<nr>{nr}</nr>\n<message>{message}</message>\n</error>\n</response>\n')
+
+    def __init__(self, *args, **kwargs):
+        super(Simulator, self).__init__(*args, **kwargs)
+        # Transactions by session_id, for Payment/get
+        self.transactions = {}
+        self._lock = threading.Lock()
+
+    def add_transaction(self, session_id, order_id, amount, desc=u'', status='99'):
+        with self._lock:
+            self.transactions[session_id] = {
+                'pos_id': unicode(self.get_config().pos_id),
+                'session_id': session_id,
+                'order_id': unicode(order_id),
+                'amount': unicode(amount),
+                'desc': desc,
+                'status': status,
+            }
+
+    def online_notification(self, session_id):
+        config = self.get_config()
+        data = {'pos_id': unicode(config.pos_id), 'session_id': session_id, 'ts': unicode(int(time.time() * 1000))}
+        data['sig'] = self.processor._ONLINE_SIG.compute(data, config.key2)
+        return self.shop('getpaid:payu:online'), data
+
+    def notification(self, payment_id, amount):
+        session_id = '%d:%d' % (payment_id, self.next_id())
+        self.add_transaction(session_id, payment_id, int(amount * 100))
+        return [self.online_notification(session_id)]
+
+    def new_payment(self, request):
+        config, params = self.get_config(), request.params
+        if 'sig' in params and not self.processor._REQUEST_SIG.verify(params, config.key1, params['sig']):
+            return 200, [], 'ERROR 103: wrong sig'
+        try:
+            self.add_transaction(params['session_id'], int(params['order_id']), int(params['amount']),
+                                 params.get('desc', u''))
+        except (KeyError, ValueError):
+            return 200, [], 'ERROR 100: missing or wrong parameter'
+        self.notify([self.online_notification(params['session_id'])])
+        return self.redirect(self.shop('getpaid:payu:success', pk=params['order_id']))
+
+    def payment_get(self, request):
+        config, params = self.get_config(), request.params
+        if not self.processor._GET_SIG.verify(params, config.key1, params.get('sig', '')):
+            return self.xml(self._ERROR.render({'nr': 103, 'message': 'wrong sig'}))
+        with self._lock:
+            transaction = self.transactions.get(params.get('session_id'))
+        if transaction is None:
+            return self.xml(self._ERROR.render({'nr': 101, 'message': 'no such transaction'}))
+        transaction = dict(transaction, ts=unicode(int(time.time() * 1000)))
+        transaction['sig'] = self.processor._GET_RESPONSE_SIG.compute(transaction, config.key2)
+        elements = u''.join([u'<%s>%s</%s>\n' % (key, escape(value), key) for key, value in transaction.items()])
+        return self.xml((u'<?xml version="1.0" encoding="UTF-8"?>\n<response>\n<status>OK</status>\n'
+                         u'<trans>\n%s</trans>\n</response>\n' % elements).encode('utf-8'))
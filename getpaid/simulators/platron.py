@@ -0,0 +1,95 @@
+"""
+Simulator of Platron: init_payment.php XML API, payment page and check/result notifications.
+"""
+import threading
+import time
+import urlparse
+
+from getpaid.backends.platron.xml_parsing import XMLParseError, XMLParser
+from getpaid.simulators import GatewaySimulator
+
+
+class Simulator(GatewaySimulator):
+    BACKEND = 'getpaid.backends.platron'
+    NAME = 'platron'
+    ROUTES = {
+        'init_payment.php': 'init_payment',
+        'payment_params.php': 'payment_params',
+    }
+
+    def __init__(self, *args, **kwargs):
+        super(Simulator, self).__init__(*args, **kwargs)
+        # Initialized payments by pg_payment_id
+        self.payments = {}
+        self._lock = threading.Lock()
+
+    def acknowledged(self, body):
+        return '<pg_status>ok</pg_status>' in body
+
+    def get_currency(self):
+        currency = self.get_config().currency
+        # Special for Platron
+        return 'RUR' if currency == 'RUB' else currency
+
+    def sign(self, script_name, pg, type='response'):
+        pg = dict(pg, pg_salt=self.processor.generate_salt())
+        return self.processor.sign_and_serialize(script_name, pg, self.get_config().key, type)[1]
+
+    def callback(self, script_name, url, payment_id, order_id, amount):
+        pg = {
+            'pg_order_id': unicode(order_id),
+            'pg_payment_id': unicode(payment_id),
+            'pg_payment_system': u'TEST',
+            'pg_amount': unicode(amount),
+            'pg_currency': self.get_currency(),
+            'pg_net_amount': unicode(amount),
+            'pg_ps_amount': unicode(amount),
+            'pg_ps_full_amount': unicode(amount),
+            'pg_ps_currency': self.get_currency(),
+            'pg_payment_date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        if script_name == 'result':
+            pg.update({'pg_result': u'1', 'pg_can_reject': u'0'})
+        return url, {'pg_xml': self.sign(script_name, pg, 'request')}
+
+    def notification(self, payment_id, amount):
+        return [self.callback('result', self.shop('getpaid:platron:result'), self.next_id(), payment_id, amount)]
+
+    def init_payment(self, request):
+        config = self.get_config()
+        try:
+            pg = XMLParser.to_dict(request.body)
+        except XMLParseError:
+            return self.xml(self.sign('init_payment.php', {'pg_status': 'error', 'pg_error_code': '100',
+                                                           'pg_error_description': 'Malformed XML'}))
+        signature = pg.pop('pg_sig', '')
+        if signature != self.processor.compute_sig('init_payment.php', pg, config.key):
+            return self.xml(self.sign('init_payment.php', {'pg_status': 'error', 'pg_error_code': '1',
+                                                           'pg_error_description': 'Wrong signature'}))
+        payment_id = self.next_id()
+        with self._lock:
+            self.payments[payment_id] = pg
+        init_payment_url = config.get('init_payment_url') or self.processor._INIT_PAYMENT_URL
+        return self.xml(self.sign('init_payment.php', {
+            'pg_status': 'ok',
+            'pg_payment_id': payment_id,
+            'pg_redirect_url': urlparse.urljoin(init_payment_url, 'payment_params.php?customer=%d' % payment_id),
+            'pg_redirect_url_type': 'need data',
+        }))
+
+    def payment_params(self, request):
+        try:
+            payment_id = int(request.params.get('customer'))
+        except (TypeError, ValueError):
+            payment_id = None
+        with self._lock:
+            pg = self.payments.get(payment_id)
+        if pg is None:
+            return 404, [], 'No such payment'
+        check_url = pg.get('pg_check_url') or self.shop('getpaid:platron:check')
+        self.notify([
+            self.callback('check', check_url, payment_id, pg['pg_order_id'], pg['pg_amount']),
+            self.callback('result', self.shop('getpaid:platron:result'), payment_id, pg['pg_order_id'],
+                          pg['pg_amount']),
+        ])
+        return self.redirect(self.shop('getpaid:platron:success'), {'pg_order_id': pg['pg_order_id']})
@@ -0,0 +1,45 @@
+"""
+Simulator of Transferuj.pl: payment page and online notifications.
+"""
+import time
+
+from getpaid.simulators import GatewaySimulator
+
+
+class Simulator(GatewaySimulator):
+    BACKEND = 'getpaid.backends.transferuj'
+    NAME = 'transferuj'
+    ROUTES = {'': 'payment'}
+    ACK = 'TRUE'
+
+    def online_notification(self, url, crc, amount, email=u''):
+        config = self.get_config()
+        data = {
+            'id': unicode(config.id),
+            'tr_id': u'TR-SIM-%d' % self.next_id(),
+            'tr_date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'tr_crc': unicode(crc),
+            'tr_amount': unicode(amount),
+            'tr_paid': unicode(amount),
+            'tr_desc': u'',
+            'tr_status': u'TRUE',
+            'tr_error': u'none',
+            'tr_email': email,
+        }
+        data['md5sum'] = self.processor._ONLINE_SIG.compute(data, config.key)
+        return url, data
+
+    def notification(self, payment_id, amount):
+        return [self.online_notification(self.shop('getpaid:transferuj:online'), payment_id, amount)]
+
+    def payment(self, request):
+        config, params = self.get_config(), request.params
+        if 'md5sum' in params and not self.processor._REQUEST_SIG.verify(params, config.key, params['md5sum']):
+            return 200, [], 'Wrong md5sum'
+        if not all(params.get(name) for name in ('id', 'kwota', 'crc', 'wyn_url')):
+            return 200, [], 'Missing parameters'
+        self.notify([self.online_notification(params['wyn_url'], params['crc'], params['kwota'],
+                                              params.get('email', u''))])
+        if params.get('pow_url'):
+            return self.redirect(params['pow_url'])
+        return 200, [], 'Paid'
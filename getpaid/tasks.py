@@ -0,0 +1,27 @@
+import logging
+from celery.task.base import task
+
+
+logger = logging.getLogger('getpaid')
+
+
+@task
+def process_inbox_task(backend=None, **kwargs):
+    """
+    Processes notifications deferred by backends with ``deferred`` setting, see ``getpaid.backends.inbox``.
+    """
+    from getpaid.backends.inbox import process_inbox # Avoiding circular import
+    summary = process_inbox(backend, **kwargs)
+    if summary['payments']:
+        logger.info('Processed %(processed)d notifications of %(payments)d payments, %(errors)d errors' % summary)
+    return summary
+
+
+@task(ignore_result=True)
+def relay_outbox_task(**kwargs):
+    """
+    Sends task calls stored in the outbox to the broker, see ``getpaid.backends.outbox``. Schedule it with
+    celery beat, e.g. every second.
+    """
+    from getpaid.backends.outbox import relay_outbox # Avoiding circular import
+    return relay_outbox(**kwargs)
@@ -1,5 +1,5 @@
 from django.conf.urls import patterns, url, include
-from getpaid.views import NewPaymentView, FallbackView
+from getpaid.views import NewPaymentView, FallbackView, MetricsView
 from getpaid.utils import import_backend_modules
 
 includes_list = []
@@ -11,6 +11,7 @@ urlpatterns = patterns('',
     url(r'^new/payment/(?P<currency>[A-Z]{3})/$', NewPaymentView.as_view(), name='new-payment'),
     url(r'^payment/success/(?P<pk>\d+)/$', FallbackView.as_view(success=True), name='success-fallback'),
     url(r'^payment/failure/(?P<pk>\d+)$', FallbackView.as_view(success=False), name='failure-fallback'),
+    url(r'^metrics/$', MetricsView.as_view(), name='metrics'),
     *includes_list
 
 )
\ No newline at end of file
@@ -1,5 +1,7 @@
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 import sys
+from getpaid.registry import get_registry
 
 
 def import_name(name):
@@ -9,9 +11,8 @@ def import_name(name):
 
 
 def import_backend_modules(submodule=None):
-    backends = getattr(settings, 'GETPAID_BACKENDS', [])
     modules = {}
-    for backend_name in backends:
+    for backend_name in get_registry().names:
         fqmn = backend_name
         if submodule:
             fqmn = '%s.%s' % (fqmn, submodule)
@@ -25,17 +26,7 @@ def get_backend_choices(currency=None):
     """
     Get active backends modules. Backend list can be filtered by supporting given currency.
     """
-    choices = []
-    backends_names = getattr(settings, 'GETPAID_BACKENDS', [])
-
-    for backend_name in backends_names:
-        backend = import_name(backend_name)
-        if currency:
-            if currency in backend.PaymentProcessor.BACKEND_ACCEPTED_CURRENCY:
-                choices.append((backend_name, backend.PaymentProcessor.BACKEND_NAME, ))
-        else:
-            choices.append((backend_name, backend.PaymentProcessor.BACKEND_NAME, ))
-    return choices
+    return get_registry().get_choices(currency)
 
 
 def get_backend_settings(backend):
@@ -46,4 +37,55 @@ def get_backend_settings(backend):
     try:
         return backends_settings[backend]
     except KeyError:
-        return {}
\ No newline at end of file
+        return {}
+
+
+class BackendConfig(object):
+    """
+    Read-only view of a single backend settings. Values are available as attributes, missing
+    optional values are taken from ``defaults``.
+
+    Reading a setting that is neither provided nor has a default raises ``ImproperlyConfigured``.
+    """
+
+    def __init__(self, backend, values, required=(), defaults=None):
+        data = dict(defaults or {})
+        data.update(values)
+        object.__setattr__(self, '_backend', backend)
+        object.__setattr__(self, '_provided', frozenset(values))
+        object.__setattr__(self, '_required', tuple(required))
+        object.__setattr__(self, '_data', data)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self._data[name]
+        except KeyError:
+            raise ImproperlyConfigured("getpaid '%s' requires backend '%s' setting" % (self._backend, name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("getpaid '%s' backend configuration is read-only" % self._backend)
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def get(self, name, default=None):
+        return self._data.get(name, default)
+
+    def get_provided(self, name, default=None):
+        """
+        Returns ``name`` setting only if it was given in settings, ignoring backend defaults.
+        """
+        if name in self._provided:
+            return self._data[name]
+        return default
+
+    def validate(self):
+        """
+        Raises ``ImproperlyConfigured`` if any of required settings is missing.
+        """
+        for name in self._required:
+            if name not in self._data:
+                raise ImproperlyConfigured("getpaid '%s' requires backend '%s' setting" % (self._backend, name))
+        return self
@@ -1,13 +1,14 @@
 # Create your views here.
 from django.conf import settings
-from django.core.exceptions import PermissionDenied, ImproperlyConfigured
+from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.template.response import TemplateResponse
 from django.views.generic import DetailView
-from django.views.generic.base import RedirectView, TemplateView
+from django.views.generic.base import RedirectView, TemplateView, View
 from django.views.generic.edit import FormView
+from getpaid import metrics
 from getpaid.forms import PaymentMethodForm
 from getpaid.models import Payment
 
@@ -26,24 +27,25 @@ class NewPaymentView(FormView):
         raise Http404
 
     def form_valid(self, form):
-        from getpaid.models import Payment
-        payment = Payment.create(form.cleaned_data['order'], form.cleaned_data['backend'])
-        processor = payment.get_processor()(payment)
-        gateway_url_tuple = processor.get_gateway_url(self.request)
-        payment.change_status('in_progress')
+        backend = form.cleaned_data['backend']
+        with metrics.timed('getpaid_new_payment_seconds', backend=backend):
+            return self.create_payment(form.cleaned_data['order'], backend)
 
-        if gateway_url_tuple[1].upper() == 'GET':
-            return HttpResponseRedirect(gateway_url_tuple[0])
-        elif gateway_url_tuple[1].upper() == 'POST':
+    def create_payment(self, order, backend):
+        from getpaid.redirects import plan_payment
+        payment, plan = plan_payment(order, backend, self.request)
+
+        if plan.method == 'GET':
+            return HttpResponseRedirect(plan.url)
+        else:
+            processor = payment.get_processor()(payment)
             context = self.get_context_data()
-            context['gateway_url'] = processor.get_gateway_url(self.request)[0]
-            context['form'] = processor.get_form(gateway_url_tuple[2])
+            context['gateway_url'] = plan.url
+            context['form'] = processor.get_form(plan.params)
 
             return TemplateResponse(request = self.request,
                 template = self.get_template_names(),
                 context = context)
-        else:
-            raise ImproperlyConfigured()
 
     def form_invalid(self, form):
         raise PermissionDenied
@@ -63,3 +65,17 @@ class FallbackView(RedirectView):
             if url_name is not None:
                 return reverse(url_name, kwargs={'pk': self.payment.order_id})
         return self.payment.order.get_absolute_url()
+
+
+class MetricsView(View):
+    """
+    Serves latency histograms of all processes in Prometheus text format, see ``getpaid.metrics``.
+    """
+
+    def get(self, request, *args, **kwargs):
+        config = metrics.get_config()
+        if config is None:
+            raise Http404
+        if config['allowed_ip'] and request.META['REMOTE_ADDR'] not in config['allowed_ip']:
+            raise PermissionDenied
+        return HttpResponse(metrics.render(metrics.collect()), content_type='text/plain; version=0.0.4')
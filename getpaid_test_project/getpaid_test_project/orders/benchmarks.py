@@ -0,0 +1,770 @@
+"""
+Micro-benchmarks of getpaid hot paths. Run them with ``./manage.py benchmark``.
+
+Each benchmark is a function that prepares its data and returns a callable that is timed. When a hot path
+was rewritten, the previous implementation is kept here as ``<name>:legacy`` benchmark, so both versions
+can be compared on the same machine. Benchmarks registered with ``db=True`` run against a test database
+created by the command, and patches they ``enter()`` are undone by ``cleanup()`` after each of them.
+"""
+import gc
+import hashlib
+from itertools import count
+from StringIO import StringIO
+import timeit
+from xml.dom.minidom import Node, parseString
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from django.db.models.loading import get_model
+from django.forms.widgets import RadioFieldRenderer
+from django.template.base import Template
+from django.template.context import Context
+from django.test.utils import override_settings
+from django.test.client import Client, RequestFactory
+import mock
+# Order model has to be registered before getpaid models are imported
+from getpaid_test_project.orders.models import Order
+from getpaid.backends import build_absolute_url, dotpay, override_backend_config, payanyway, payu, platron, transferuj
+from getpaid.backends.dotpay.views import OnlineView as DotpayOnlineView
+from getpaid.backends.httpclient import HTTPClient, Response
+from getpaid.backends.payu.xml_parsing import TransParser
+from getpaid.backends.platron.xml_parsing import XMLParser
+from getpaid.forms import PaymentMethodForm
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BENCHMARKS = []
+
+_contexts = []
+
+
+def benchmark(name, db=False):
+    def register(setup):
+        BENCHMARKS.append((name, setup, db))
+        return setup
+    return register
+
+
+def enter(context):
+    """
+    Enters ``context`` (e.g. ``mock.patch()``) until ``cleanup()`` is called after the benchmark.
+    """
+    value = context.__enter__()
+    _contexts.append(context)
+    return value
+
+
+def cleanup():
+    while _contexts:
+        _contexts.pop().__exit__(None, None, None)
+
+
+def measure(func, min_time=0.2, repeat=3):
+    """
+    Returns best time of a single ``func`` call in seconds.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time / repeat:
+        number *= 10
+    return min(timer.repeat(repeat, number)) / number
+
+
+def allocations_unit():
+    """
+    Returns what ``measure_allocations()`` counts.
+    """
+    return 'KiB' if tracemalloc is not None else 'retained objs'
+
+
+def measure_allocations(func, number=100):
+    """
+    Returns memory allocated by a single ``func`` call: the smallest peak of traced memory of a call in KiB or,
+    on Pythons without tracemalloc, average number of objects tracked by garbage collector which are left after
+    a call (see ``allocations_unit()``). The first call is not measured, so lazily built caches are not counted.
+    """
+    func()
+    gc.collect()
+    if tracemalloc is not None:
+        peaks = []
+        for i in range(min(number, 10)):
+            tracemalloc.start()
+            try:
+                func()
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        return min(peaks) / 1024.0
+    before = len(gc.get_objects())
+    for i in xrange(number):
+        func()
+    gc.collect()
+    return float(len(gc.get_objects()) - before) / number
+
+
+#
+# Signing
+#
+
+def legacy_compute_sig(params, fields, key):
+    text = ''
+    for field in fields:
+        text += unicode(params.get(field, '')).encode('utf-8')
+    text += key
+    return hashlib.md5(text).hexdigest()
+
+
+def legacy_dotpay_compute_sig(params, fields, PIN):
+    text = PIN + ":" + (u":".join(map(lambda field: params.get(field, ''), fields)))
+    return hashlib.md5(text).hexdigest()
+
+
+PAYU_REQUEST = {
+    'pos_id': 123456789,
+    'pos_auth_key': 'xxx',
+    'desc': u'Order 1234 - Lock, Stock and Two Smoking Barrels',
+    'email': 'client@example.com',
+    'language': 'en',
+    'order_id': 1234,
+    'amount': 19999,
+    'session_id': '1234:1342616247.41',
+    'client_ip': '127.0.0.1',
+    'ts': 1342616247.41,
+}
+
+PAYU_ONLINE = {'pos_id': u'123456789', 'session_id': u'1234:1342616247.41', 'ts': u'1342616255805'}
+
+PAYU_GET_RESPONSE = {
+    'pos_id': u'123456789',
+    'session_id': u'1234:1342616247.41',
+    'order_id': u'1234',
+    'status': u'99',
+    'amount': u'19999',
+    'desc': u'Order 1234 - Lock, Stock and Two Smoking Barrels',
+    'ts': u'1342616255805',
+}
+
+TRANSFERUJ_ONLINE = {'id': u'1234', 'tr_id': u'TR-1234-ABCD', 'tr_amount': u'199.99', 'tr_crc': u'1234'}
+
+DOTPAY_ONLINE = {
+    'id': u'123456',
+    'control': u'1234',
+    't_id': u'123456-TST1',
+    'amount': u'199.99',
+    'email': u'client@example.com',
+    'service': u'',
+    'code': u'',
+    'username': u'',
+    'password': u'',
+    't_status': u'2',
+}
+
+PAYANYWAY_CHECK_ANSWER = {'result_code': 200, 'id': '1234', 'transaction_id': '1234'}
+
+
+@benchmark('signing.payu.request')
+def signing_payu_request():
+    return lambda: payu.PaymentProcessor._REQUEST_SIG.compute(PAYU_REQUEST, 'key1')
+
+
+@benchmark('signing.payu.request:legacy')
+def signing_payu_request_legacy():
+    return lambda: legacy_compute_sig(PAYU_REQUEST, payu.PaymentProcessor._REQUEST_SIG_FIELDS, 'key1')
+
+
+@benchmark('signing.payu.online')
+def signing_payu_online():
+    return lambda: payu.PaymentProcessor._ONLINE_SIG.verify(PAYU_ONLINE, 'key2', '2a78322c06522613cbd7447983570188')
+
+
+@benchmark('signing.payu.online:legacy')
+def signing_payu_online_legacy():
+    return lambda: '2a78322c06522613cbd7447983570188' == legacy_compute_sig(
+        PAYU_ONLINE, payu.PaymentProcessor._ONLINE_SIG_FIELDS, 'key2')
+
+
+@benchmark('signing.payu.get_response')
+def signing_payu_get_response():
+    return lambda: payu.PaymentProcessor._GET_RESPONSE_SIG.compute(PAYU_GET_RESPONSE, 'key2')
+
+
+@benchmark('signing.payu.get_response:legacy')
+def signing_payu_get_response_legacy():
+    return lambda: legacy_compute_sig(PAYU_GET_RESPONSE, payu.PaymentProcessor._GET_RESPONSE_SIG_FIELDS, 'key2')
+
+
+@benchmark('signing.transferuj.online')
+def signing_transferuj_online():
+    return lambda: transferuj.PaymentProcessor._ONLINE_SIG.compute(TRANSFERUJ_ONLINE, 'key')
+
+
+@benchmark('signing.transferuj.online:legacy')
+def signing_transferuj_online_legacy():
+    return lambda: legacy_compute_sig(TRANSFERUJ_ONLINE, transferuj.PaymentProcessor._ONLINE_SIG_FIELDS, 'key')
+
+
+@benchmark('signing.dotpay.online')
+def signing_dotpay_online():
+    return lambda: dotpay.PaymentProcessor._ONLINE_SIG.compute(DOTPAY_ONLINE, 'PIN')
+
+
+@benchmark('signing.dotpay.online:legacy')
+def signing_dotpay_online_legacy():
+    return lambda: legacy_dotpay_compute_sig(DOTPAY_ONLINE, dotpay.PaymentProcessor._ONLINE_SIG_FIELDS, 'PIN')
+
+
+@benchmark('signing.payanyway.check_answer')
+def signing_payanyway_check_answer():
+    return lambda: payanyway.PaymentProcessor._CHECK_ANSWER_SIG.compute(PAYANYWAY_CHECK_ANSWER, 'key')
+
+
+@benchmark('signing.payanyway.check_answer:legacy')
+def signing_payanyway_check_answer_legacy():
+    return lambda: legacy_compute_sig(PAYANYWAY_CHECK_ANSWER,
+                                      payanyway.PaymentProcessor._CHECK_ANSWER_SIG_FIELDS, 'key')
+
+
+#
+# PayAnyWay
+#
+
+LEGACY_PAYANYWAY_CHECK_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+            <MNT_RESPONSE>
+                    <MNT_ID>%(id)s</MNT_ID>
+                    <MNT_TRANSACTION_ID>%(transaction_id)s</MNT_TRANSACTION_ID>
+                    <MNT_RESULT_CODE>%(result_code)s</MNT_RESULT_CODE>
+                    <MNT_DESCRIPTION>%(description)s</MNT_DESCRIPTION>
+                    <MNT_AMOUNT>%(amount)s</MNT_AMOUNT>
+                    <MNT_SIGNATURE>%(signature)s</MNT_SIGNATURE>
+                    <MNT_ATTRIBUTES>
+                        <ATTRIBUTE>
+                            <KEY></KEY>
+                            <VALUE></VALUE>
+                        </ATTRIBUTE>
+                    </MNT_ATTRIBUTES>
+            </MNT_RESPONSE>
+        '''
+
+PAYANYWAY_CHECK_RESPONSE = dict(PAYANYWAY_CHECK_ANSWER, amount='123.00', description='paid',
+                                signature='102153d9e5b8e97e7f0d608448e3e18f')
+
+
+@benchmark('payanyway.check_response')
+def payanyway_check_response():
+    return lambda: payanyway.PaymentProcessor._CHECK_RESPONSE.render(PAYANYWAY_CHECK_RESPONSE)
+
+
+@benchmark('payanyway.check_response:legacy')
+def payanyway_check_response_legacy():
+    return lambda: LEGACY_PAYANYWAY_CHECK_RESPONSE % PAYANYWAY_CHECK_RESPONSE
+
+
+#
+# Platron
+#
+
+def legacy_platron_get_order(dic):
+    flat = {}
+    order = dic.keys()
+    order.sort()
+    for k, v in dic.items():
+        if isinstance(dic[k], dict):
+            deep_flat, deep_order = legacy_platron_get_order(v)
+            flat.update(deep_flat)
+            i = order.index(k)
+            del order[i]
+            order = order[:i] + deep_order + order[i:]
+        else:
+            flat[k] = v
+    return flat, order
+
+
+def legacy_platron_sign_and_serialize(script_name, pg, secret_key):
+    flat_pg, order = legacy_platron_get_order(pg)
+    text = u';'.join([script_name] + [unicode(flat_pg[key]) for key in order] + [secret_key])
+    pg = dict(pg, pg_sig=hashlib.md5(text.encode('utf-8')).hexdigest())
+    return pg['pg_sig'], legacy_platron_to_xml(pg)
+
+
+def legacy_platron_to_xml(elements, type='request'):
+    params = ''
+    for key, value in elements.items():
+        params += '  <%(key)s>%(value)s</%(key)s>\n' % {'key': key, 'value': value}
+    xml = '<?xml version="1.0" encoding="utf-8"?>' \
+          '<%(type)s>\n%(params)s</%(type)s>' % {'type': type, 'params': params}
+    return unicode(xml).encode('utf-8')
+
+
+def legacy_platron_send_response(script_name, description='', status='error'):
+    response = {
+        'pg_salt': platron.PaymentProcessor.generate_salt(),
+        'pg_status': 'ok' if not description else status,
+        'pg_description': description,
+        'pg_error_description': description}
+    response['pg_sig'] = legacy_platron_sign_and_serialize(script_name, response, 'key')[0]
+    return legacy_platron_to_xml(response, 'response')
+
+
+PLATRON_INIT_PAYMENT = {
+    'pg_merchant_id': '1234',
+    'pg_order_id': '99',
+    'pg_amount': '123.45',
+    'pg_currency': 'RUR',
+    'pg_check_url': 'http://example.com/getpaid.backends.platron/check/',
+    'pg_payment_system': 'TEST',
+    'pg_description': 'TEST',
+    'pg_user_ip': '123.123.123.123',
+    'pg_user_email': 'client@example.com',
+    'pg_language': 'en',
+    'pg_salt': '4b3c5b1f4ec1e4b1b1e0a0e6f0b1c2d3',
+}
+
+PLATRON_RECEIPT = dict(PLATRON_INIT_PAYMENT, pg_receipt=dict(
+    ('pg_item_%d' % i, {'pg_item_name': 'Item %d' % i, 'pg_item_amount': '10.00', 'pg_item_count': 1})
+    for i in range(50)))
+
+
+@benchmark('platron.sign_and_serialize')
+def platron_sign_and_serialize():
+    return lambda: platron.PaymentProcessor.sign_and_serialize('init_payment.php', PLATRON_INIT_PAYMENT, 'key')
+
+
+@benchmark('platron.sign_and_serialize:legacy')
+def platron_sign_and_serialize_legacy():
+    return lambda: legacy_platron_sign_and_serialize('init_payment.php', PLATRON_INIT_PAYMENT, 'key')
+
+
+@benchmark('platron.send_response')
+def platron_send_response():
+    return lambda: platron.PaymentProcessor.send_response('result', u'Payment rejected', 'rejected')
+
+
+@benchmark('platron.send_response:legacy')
+def platron_send_response_legacy():
+    return lambda: legacy_platron_send_response('result', u'Payment rejected', 'rejected')
+
+
+@benchmark('platron.get_order.nested')
+def platron_get_order_nested():
+    return lambda: platron.PaymentProcessor._get_order(PLATRON_RECEIPT)
+
+
+@benchmark('platron.get_order.nested:legacy')
+def platron_get_order_nested_legacy():
+    return lambda: legacy_platron_get_order(PLATRON_RECEIPT)
+
+
+class LegacyPlatronXMLParser(object):
+    def __init__(self, max_depth=2):
+        self.max_depth = max_depth
+        self.depth = 0
+
+    def parse(self, xml_node):
+        d = {}
+        self.depth += 1
+        for node in xml_node.childNodes:
+            if node.nodeType != node.TEXT_NODE:
+                d[node.tagName] = ''
+                if node.childNodes:
+                    textnode = node.childNodes[0]
+                    if textnode.nodeType == node.TEXT_NODE and len(node.childNodes) == 1:
+                        d[node.tagName] = textnode.nodeValue
+                    elif self.depth <= self.max_depth:
+                        d[node.tagName] = self.parse(node)
+        self.depth -= 1
+        return d
+
+    @classmethod
+    def to_dict(cls, xml, max_depth=2):
+        parser = cls(max_depth)
+        xml = parseString(unicode(xml).encode('utf-8'))
+        request = xml.getElementsByTagName('request')
+        response = xml.getElementsByTagName('response')
+        if response:
+            return parser.parse(response[0])
+        elif request:
+            return parser.parse(request[0])
+        else:
+            return {}
+
+
+PLATRON_RESULT_XML = u"""<?xml version="1.0" encoding="utf-8"?>
+<request>
+    <pg_salt>8765</pg_salt>
+    <pg_order_id>1234</pg_order_id>
+    <pg_payment_id>765432</pg_payment_id>
+    <pg_payment_system>WEBMONEYR</pg_payment_system>
+    <pg_amount>100.00</pg_amount>
+    <pg_net_amount>95.00</pg_net_amount>
+    <pg_currency>RUR</pg_currency>
+    <pg_ps_currency>RUR</pg_ps_currency>
+    <pg_ps_amount>100.00</pg_ps_amount>
+    <pg_ps_full_amount>100.00</pg_ps_full_amount>
+    <pg_result>1</pg_result>
+    <pg_payment_date>2013-01-01 12:00:00</pg_payment_date>
+    <pg_can_reject>0</pg_can_reject>
+    <pg_user_phone>79001234567</pg_user_phone>
+    <pg_user_contact_email>client@example.com</pg_user_contact_email>
+    <pg_sig>0c8a6e52e1c29de0b4be9ee8cfe38f7c</pg_sig>
+</request>"""
+
+
+@benchmark('platron.parse_result')
+def platron_parse_result():
+    return lambda: XMLParser.to_dict(PLATRON_RESULT_XML)
+
+
+@benchmark('platron.parse_result:legacy')
+def platron_parse_result_legacy():
+    return lambda: LegacyPlatronXMLParser.to_dict(PLATRON_RESULT_XML)
+
+
+#
+# PayU
+#
+
+def legacy_payu_parse_payment_get(response):
+    xml_dom = parseString(response.read())
+    tag_response = xml_dom.getElementsByTagName('trans')[0]
+    response_params = {}
+    for tag in tag_response.childNodes:
+        if tag.nodeType == Node.ELEMENT_NODE:
+            response_params[tag.nodeName] = reduce(lambda x, y: x + y.nodeValue, tag.childNodes, u"")
+    return response_params
+
+
+PAYU_TRANS = """<trans>
+    <id>23474806%(i)d</id>
+    <pos_id>123456789</pos_id>
+    <session_id>%(i)d:1342616247.41</session_id>
+    <order_id>%(i)d</order_id>
+    <amount>12345</amount>
+    <status>99</status>
+    <pay_type>t</pay_type>
+    <pay_gw_name>pt</pay_gw_name>
+    <desc>Order %(i)d - Lock, Stock and Two Smoking Barrels</desc>
+    <desc2></desc2>
+    <create>2012-07-18 14:57:28</create>
+    <init></init>
+    <sent></sent>
+    <recv></recv>
+    <cancel>2012-07-18 14:57:30</cancel>
+    <auth_fraud>0</auth_fraud>
+    <ts>1342616255805</ts>
+    <sig>4d4df5557b89a4e2d8c48436b1dd3fef</sig>
+</trans>
+"""
+
+PAYU_PAYMENT_GET_XML = '<?xml version="1.0" encoding="UTF-8"?>\n<response>\n<status>OK</status>\n%s</response>' % (
+    ''.join([PAYU_TRANS % {'i': i} for i in range(100)]))
+
+
+@benchmark('payu.parse_payment_get')
+def payu_parse_payment_get():
+    fields = payu.PaymentProcessor._GET_RESPONSE_FIELDS
+    return lambda: TransParser(fields).parse(StringIO(PAYU_PAYMENT_GET_XML))
+
+
+@benchmark('payu.parse_payment_get:legacy')
+def payu_parse_payment_get_legacy():
+    return lambda: legacy_payu_parse_payment_get(StringIO(PAYU_PAYMENT_GET_XML))
+
+
+#
+# Signing and XML of Platron and PayAnyWay notifications
+#
+
+PLATRON_RESULT = XMLParser.to_dict(PLATRON_RESULT_XML)
+del PLATRON_RESULT['pg_sig']
+
+PAYANYWAY_PAY = {
+    'command': '',
+    'id': '1234',
+    'transaction_id': '1234',
+    'operation_id': '98765',
+    'amount': '123.45',
+    'currency_code': 'RUB',
+    'test_mode': '1',
+}
+
+
+@benchmark('signing.platron.result')
+def signing_platron_result():
+    return lambda: platron.PaymentProcessor.compute_sig('result', PLATRON_RESULT, 'key')
+
+
+@benchmark('signing.payanyway.pay')
+def signing_payanyway_pay():
+    signature = payanyway.PaymentProcessor._CHECK_SIG.compute(PAYANYWAY_PAY, 'key')
+    return lambda: payanyway.PaymentProcessor._CHECK_SIG.verify(PAYANYWAY_PAY, 'key', signature)
+
+
+@benchmark('platron.get_order')
+def platron_get_order():
+    return lambda: platron.PaymentProcessor._get_order(PLATRON_INIT_PAYMENT)
+
+
+@benchmark('platron.get_order:legacy')
+def platron_get_order_legacy():
+    return lambda: legacy_platron_get_order(PLATRON_INIT_PAYMENT)
+
+
+@benchmark('platron.xml_round_trip')
+def platron_xml_round_trip():
+    def round_trip():
+        signature, xml = platron.PaymentProcessor.sign_and_serialize('result', PLATRON_RESULT, 'key')
+        return XMLParser.to_dict(xml)
+    return round_trip
+
+
+@benchmark('platron.xml_round_trip:legacy')
+def platron_xml_round_trip_legacy():
+    def round_trip():
+        signature, xml = legacy_platron_sign_and_serialize('result', PLATRON_RESULT, 'key')
+        return LegacyPlatronXMLParser.to_dict(xml)
+    return round_trip
+
+
+#
+# Order description
+#
+
+ORDER_DESCRIPTION = 'Order {{ order.id }} - {{ order.name }}'
+
+
+def order_description(template, **settings):
+    enter(override_settings(GETPAID_ORDER_DESCRIPTION=template, **settings))
+    order = Order(pk=1234, name='Lock, Stock and Two Smoking Barrels', total='199.99', currency='PLN')
+    Payment = get_model('getpaid', 'Payment')
+    payment = Payment(pk=1, order=order, amount=order.total, currency=order.currency,
+                      backend=payu.PaymentProcessor.BACKEND)
+    return payu.PaymentProcessor(payment), payment, order
+
+
+def legacy_order_description(template):
+    payment_processor, payment, order = order_description(template)
+    return lambda: Template(template).render(Context({"payment": payment, "order": order}))
+
+
+@benchmark('order_description.template')
+def order_description_template():
+    payment_processor, payment, order = order_description(ORDER_DESCRIPTION)
+    return lambda: payment_processor.get_order_description(payment, order)
+
+
+@benchmark('order_description.template:legacy')
+def order_description_template_legacy():
+    return legacy_order_description(ORDER_DESCRIPTION)
+
+
+@benchmark('order_description.plain')
+def order_description_plain():
+    payment_processor, payment, order = order_description('Order at example.com')
+    return lambda: payment_processor.get_order_description(payment, order)
+
+
+@benchmark('order_description.plain:legacy')
+def order_description_plain_legacy():
+    return legacy_order_description('Order at example.com')
+
+
+@benchmark('order_description.cached')
+def order_description_cached():
+    payment_processor, payment, order = order_description(ORDER_DESCRIPTION, GETPAID_ORDER_DESCRIPTION_CACHE=60)
+    return lambda: payment_processor.get_order_description(payment, order)
+
+
+#
+# Absolute URLs of backend views
+#
+
+@benchmark('absolute_url', db=True)
+def absolute_url():
+    return lambda: build_absolute_url('getpaid:transferuj:success', True, 1234)
+
+
+@benchmark('absolute_url:legacy', db=True)
+def absolute_url_legacy():
+    return lambda: 'https://' + Site.objects.get_current().domain + reverse('getpaid:transferuj:success',
+                                                                           kwargs={'pk': 1234})
+
+
+#
+# Gateway redirects (dotpay is left out, as its return URLs are not routed in this project)
+#
+
+def create_payment(backend, currency, total='123.45'):
+    Payment = get_model('getpaid', 'Payment')
+    order = Order.objects.create(name='Benchmark order', total=total, currency=currency)
+    payment = Payment.objects.create(order=order, amount=order.total, currency=order.currency, backend=backend)
+    # Fetched again, so amount is Decimal
+    return Payment.objects.get(pk=payment.pk)
+
+
+def gateway_url(processor, currency, method):
+    enter(override_backend_config(processor, method=method))
+    request = RequestFactory().get('/', REMOTE_ADDR='123.123.123.123')
+    payment_processor = processor(create_payment(processor.BACKEND, currency))
+    return lambda: payment_processor.get_gateway_url(request)
+
+
+def unique_payu_sessions():
+    # Session ids are made of time, which does not change between two calls in a tight loop
+    enter(mock.patch('getpaid.backends.payu.time', mock.Mock(time=count(1342616247).next)))
+
+
+@benchmark('gateway_url.payu.get', db=True)
+def gateway_url_payu_get():
+    unique_payu_sessions()
+    return gateway_url(payu.PaymentProcessor, 'PLN', 'get')
+
+
+@benchmark('gateway_url.payu.post', db=True)
+def gateway_url_payu_post():
+    unique_payu_sessions()
+    return gateway_url(payu.PaymentProcessor, 'PLN', 'post')
+
+
+@benchmark('gateway_url.transferuj.get', db=True)
+def gateway_url_transferuj_get():
+    return gateway_url(transferuj.PaymentProcessor, 'PLN', 'get')
+
+
+@benchmark('gateway_url.transferuj.post', db=True)
+def gateway_url_transferuj_post():
+    return gateway_url(transferuj.PaymentProcessor, 'PLN', 'post')
+
+
+@benchmark('gateway_url.payanyway.get', db=True)
+def gateway_url_payanyway_get():
+    return gateway_url(payanyway.PaymentProcessor, 'RUB', 'get')
+
+
+@benchmark('gateway_url.payanyway.post', db=True)
+def gateway_url_payanyway_post():
+    return gateway_url(payanyway.PaymentProcessor, 'RUB', 'post')
+
+
+PLATRON_INIT_PAYMENT_RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<response>
+    <pg_salt>ijoi894j4ik39lo9</pg_salt>
+    <pg_status>ok</pg_status>
+    <pg_payment_id>15826</pg_payment_id>
+    <pg_redirect_url>https://www.platron.ru/payment_params.php?customer=ccaa41a4f425d124a23c3a53a3140bdc15826</pg_redirect_url>
+    <pg_redirect_url_type>need data</pg_redirect_url_type>
+    <pg_sig>af8e41a4f425d124a23c3a53a3140bdc17ea0</pg_sig>
+</response>"""
+
+
+@benchmark('gateway_url.platron.get', db=True)
+def gateway_url_platron_get():
+    enter(mock.patch.object(HTTPClient, 'request', lambda self, method, url, body=None, headers=None:
+                            Response(200, 'OK', {}, PLATRON_INIT_PAYMENT_RESPONSE)))
+    return gateway_url(platron.PaymentProcessor, 'RUB', 'get')
+
+
+#
+# Notifications, posted through the whole Django stack. Every call is a new transaction of the same payment.
+#
+
+@benchmark('online.payu', db=True)
+def online_payu():
+    enter(mock.patch('getpaid.backends.payu.enqueue'))
+    client, url, key2 = Client(), reverse('getpaid:payu:online'), payu.PaymentProcessor.get_backend_config().key2
+    payment = create_payment(payu.PaymentProcessor.BACKEND, 'PLN')
+    numbers = count()
+
+    def post():
+        params = {'pos_id': '123456789', 'session_id': '%d:%d' % (payment.pk, numbers.next()), 'ts': '1111'}
+        params['sig'] = payu.PaymentProcessor._ONLINE_SIG.compute(params, key2)
+        return client.post(url, params)
+    return post
+
+
+@benchmark('online.transferuj', db=True)
+def online_transferuj():
+    config = transferuj.PaymentProcessor.get_backend_config()
+    client, url = Client(REMOTE_ADDR=config.allowed_ip[0]), reverse('getpaid:transferuj:online')
+    payment = create_payment(transferuj.PaymentProcessor.BACKEND, 'PLN')
+    numbers = count()
+
+    def post():
+        params = {'id': str(config.id), 'tr_id': 'TR-%d' % numbers.next(), 'tr_date': '', 'tr_crc': str(payment.pk),
+                  'tr_amount': '123.45', 'tr_paid': '123.45', 'tr_desc': '', 'tr_status': 'TRUE', 'tr_error': 'none',
+                  'tr_email': 'client@example.com'}
+        params['md5sum'] = transferuj.PaymentProcessor._ONLINE_SIG.compute(params, config.key)
+        return client.post(url, params)
+    return post
+
+
+@benchmark('online.payanyway', db=True)
+def online_payanyway():
+    config = payanyway.PaymentProcessor.get_backend_config()
+    id, key = (config.demo_id, config.demo_key) if bool(config.demo) else (config.id, config.key)
+    client, url = Client(), reverse('getpaid:payanyway:online')
+    payment = create_payment(payanyway.PaymentProcessor.BACKEND, 'RUB')
+    numbers = count()
+
+    def post():
+        params = dict(PAYANYWAY_PAY, id=id, transaction_id=str(payment.pk), operation_id=str(numbers.next()))
+        data = dict(('MNT_%s' % name.upper(), value) for name, value in params.items())
+        data['MNT_SIGNATURE'] = payanyway.PaymentProcessor._CHECK_SIG.compute(params, key)
+        return client.post(url, data)
+    return post
+
+
+@benchmark('online.platron', db=True)
+def online_platron():
+    key = platron.PaymentProcessor.get_backend_config().key
+    client, url = Client(), reverse('getpaid:platron:result')
+    payment = create_payment(platron.PaymentProcessor.BACKEND, 'RUB', total='100.00')
+    numbers = count()
+
+    def post():
+        pg = dict(PLATRON_RESULT, pg_order_id=str(payment.pk), pg_payment_id=str(numbers.next()))
+        return client.post(url, {'pg_xml': platron.PaymentProcessor.sign_and_serialize('result', pg, key)[1]})
+    return post
+
+
+@benchmark('online.dotpay', db=True)
+def online_dotpay():
+    config = enter(override_backend_config(dotpay.PaymentProcessor, id=DOTPAY_ONLINE['id'], PIN='PIN'))
+    # Dotpay URLs are not routed in this project, so the view is called directly
+    factory, view = RequestFactory(), DotpayOnlineView.as_view()
+    payment = create_payment(dotpay.PaymentProcessor.BACKEND, 'PLN', total='199.99')
+    numbers = count()
+
+    def post():
+        params = dict(DOTPAY_ONLINE, control=str(payment.pk), t_id='123456-TST%d' % numbers.next(),
+                      status='OK', orginal_amount='199.99 PLN')
+        params['md5'] = dotpay.PaymentProcessor._ONLINE_SIG.compute(params, config.PIN)
+        return view(factory.post('/', params, REMOTE_ADDR=config.allowed_ip[0]))
+    return post
+
+
+#
+# Forms
+#
+
+@benchmark('forms.payment_method')
+def forms_payment_method():
+    return lambda: PaymentMethodForm('PLN').as_p()
+
+
+@benchmark('forms.payment_method.backend')
+def forms_payment_method_backend():
+    form = PaymentMethodForm('PLN', initial={'backend': 'getpaid.backends.payu'})
+    return lambda: unicode(form['backend'])
+
+
+@benchmark('forms.payment_method.backend:legacy')
+def forms_payment_method_backend_legacy():
+    form = PaymentMethodForm('PLN', initial={'backend': 'getpaid.backends.payu'})
+    field = form['backend']
+
+    def render():
+        renderer = field.field.widget.get_renderer(field.html_name, field.value(), {'id': field.auto_id})
+        return RadioFieldRenderer.render(renderer)
+    return render
@@ -0,0 +1,83 @@
+from optparse import make_option
+import json
+import logging
+import platform
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from getpaid_test_project.orders.benchmarks import BENCHMARKS, allocations_unit, cleanup, measure, \
+    measure_allocations
+
+
+class Command(BaseCommand):
+    args = '[name_prefix ...]'
+    help = 'Run getpaid micro-benchmarks (optionally only those which names start with given prefixes)'
+    option_list = BaseCommand.option_list + (
+        make_option('--save', metavar='FILE',
+                    help='Save results to FILE, to compare other runs with them'),
+        make_option('--compare', metavar='FILE',
+                    help='Compare results with ones saved to FILE by --save'),
+        make_option('--threshold', type='float', metavar='PERCENT',
+                    help='With --compare, fail if any benchmark got slower by more than PERCENT'),
+    )
+
+    def handle(self, *args, **options):
+        if options['threshold'] is not None and not options['compare']:
+            raise CommandError('--threshold requires --compare')
+        baseline = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['results']
+
+        selected = [(name, setup, db) for name, setup, db in BENCHMARKS if not args or name.startswith(args)]
+        old_name = None
+        if any(db for name, setup, db in selected):
+            setup_test_environment()
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0)
+
+        unit = allocations_unit()
+        results = {}
+        # Writing log records of every notification to console would be timed instead of getpaid
+        logging.disable(logging.CRITICAL)
+        try:
+            for name, setup, db in selected:
+                try:
+                    func = setup()
+                    seconds = measure(func)
+                    allocations = measure_allocations(func)
+                finally:
+                    cleanup()
+                results[name] = {'ops': 1.0 / seconds, 'allocations': allocations}
+                line = '%-40s %12.0f ops/sec %10.2f us/op %10.2f %s/op' % (name, 1.0 / seconds, seconds * 1e6,
+                                                                          allocations, unit)
+                if name.endswith(':legacy') and name[:-len(':legacy')] in results:
+                    line += '   x%.2f faster' % (results[name[:-len(':legacy')]]['ops'] / results[name]['ops'])
+                elif name in baseline:
+                    line += '   %+.1f%%' % self.change(baseline[name], results[name])
+                self.stdout.write(line + '\n')
+        finally:
+            logging.disable(logging.NOTSET)
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump({'python': platform.python_version(), 'allocations_unit': unit, 'results': results}, f,
+                          indent=2, sort_keys=True)
+
+        if options['threshold'] is not None:
+            regressions = sorted(name for name in results if name in baseline and not name.endswith(':legacy')
+                                 and self.change(baseline[name], results[name]) < -options['threshold'])
+            if regressions:
+                raise CommandError('Slower by more than %g%% than %s: %s' % (options['threshold'],
+                                                                             options['compare'],
+                                                                             ', '.join(regressions)))
+
+    @staticmethod
+    def change(old, new):
+        """
+        Returns change of speed in percent, negative if ``new`` result is slower.
+        """
+        return (new['ops'] / old['ops'] - 1) * 100
@@ -4,16 +4,36 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import BaseHTTPServer
+from datetime import datetime
 from decimal import Decimal
+import hashlib
+import socket
+import SocketServer
+import struct
+from StringIO import StringIO
+import threading
+import time
+import urlparse
+from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.db.models.loading import get_model
 from django.test.client import RequestFactory
+from django.utils.timezone import utc
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 from django.test.client import Client
 import mock
 import getpaid.backends.payu
 import getpaid.backends.transferuj
+from getpaid.backends import override_backend_config
+from getpaid.backends.httpclient import HTTPClient, Response
+from getpaid.backends.ledger import ledger
+from getpaid.backends.platron.xml_parsing import XMLParser
+from getpaid.backends.signing import Signature, compute_md5
+from getpaid.registry import BackendRegistry, get_registry
+from getpaid.utils import get_backend_choices
 
 from getpaid_test_project.orders.models import Order
 
@@ -61,6 +81,18 @@ class OrderTest(TestCase):
         self.assertEqual(payment.status, 'in_progress')
         self.assertEqual(payment.paid_on, None)
         self.assertEqual(payment.amount_paid, 0)
+        # sessions are stored only for polling
+        self.assertEqual(payment.payu_sessions.count(), 0)
+        order = Order(name='Test polled PLN order', total=100, currency='PLN')
+        order.save()
+        with override_backend_config(getpaid.backends.payu.PaymentProcessor, polling=True):
+            response = self.client.post(reverse('getpaid:new-payment', kwargs={'currency' : 'PLN'}),
+                    {'order': order.pk,
+                     'backend': 'getpaid.backends.payu'}
+            )
+        self.assertEqual(response.status_code, 302)
+        payment = Payment.objects.get(order=order.pk)
+        self.assertEqual(payment.payu_sessions.count(), 1)
 
 
     def test_failure_create_payment_eur(self):
@@ -77,10 +109,633 @@ class OrderTest(TestCase):
         self.assertEqual(response.status_code, 404)
 
 
-def fake_payment_get_response_success(request):
-    class fake_response:
-        def read(self):
-            return """<?xml version="1.0" encoding="UTF-8"?>
+class PaymentStatusTest(TestCase):
+    def setUp(self):
+        from getpaid import signals
+        self.changes = []
+        self.receiver = lambda sender, instance, old_status, new_status, **kwargs: self.changes.append(
+            (instance.pk, old_status, new_status))
+        signals.payment_status_changed.connect(self.receiver)
+        Payment = get_model('getpaid', 'Payment')
+        order = Order(name='Test EUR order', total='100.00', currency='EUR')
+        order.save()
+        self.payment = Payment(order=order, amount=order.total, currency=order.currency, backend='getpaid.backends.dummy')
+        self.payment.save()
+
+    def tearDown(self):
+        from getpaid import signals
+        signals.payment_status_changed.disconnect(self.receiver)
+
+    def test_concurrent_change(self):
+        Payment = get_model('getpaid', 'Payment')
+        first = Payment.objects.get(pk=self.payment.pk)
+        second = Payment.objects.get(pk=self.payment.pk)
+        second.amount = Decimal('1.00')
+
+        self.assertTrue(first.change_status('paid', amount_paid=Decimal('100.00')))
+        self.assertEqual(first.status, 'paid')
+        self.assertEqual(first.amount_paid, Decimal('100.00'))
+        # second notification handled with a stale instance does not overwrite the first one
+        self.assertFalse(second.change_status('partially_paid', amount_paid=Decimal('50.00')))
+        self.assertEqual(second.status, 'paid')
+        self.assertEqual(self.changes, [(self.payment.pk, 'new', 'paid')])
+
+        payment = Payment.objects.get(pk=self.payment.pk)
+        self.assertEqual((payment.status, payment.amount_paid, payment.amount), ('paid', Decimal('100.00'), Decimal('100.00')))
+        self.assertEqual(payment.order.status, 'P')
+
+    def test_fields_set_before_change(self):
+        Payment = get_model('getpaid', 'Payment')
+        # another process changes a column this instance does not know about
+        Payment.objects.filter(pk=self.payment.pk).update(amount=Decimal('90.00'))
+        self.payment.amount_paid = Decimal('1.00')
+        self.assertTrue(self.payment.change_status('paid', paid_on=datetime(2013, 1, 1, tzinfo=utc)))
+        payment = Payment.objects.get(pk=self.payment.pk)
+        # only status and given fields are written
+        self.assertEqual((payment.status, payment.amount, payment.amount_paid, payment.paid_on),
+                         ('paid', Decimal('90.00'), Decimal('0'), datetime(2013, 1, 1, tzinfo=utc)))
+
+    def test_noop_transitions(self):
+        self.assertTrue(self.payment.change_status('paid'))
+        with self.assertNumQueries(0):
+            self.assertFalse(self.payment.change_status('paid'))
+            self.assertFalse(self.payment.change_status('partially_paid'))
+            self.assertFalse(self.payment.change_status('failed'))
+        self.payment.on_failure()
+        self.assertEqual(self.payment.status, 'paid')
+        self.assertEqual(self.changes, [(self.payment.pk, 'new', 'paid')])
+
+    def test_backend_transitions(self):
+        from getpaid.backends.dotpay import PaymentProcessor
+        from getpaid.models import DEFAULT_STATUS_TRANSITIONS, compile_status_transitions
+        self.assertFalse(('paid', 'failed') in DEFAULT_STATUS_TRANSITIONS)
+        self.assertTrue(('paid', 'failed') in PaymentProcessor.get_status_transitions())
+        self.assertFalse(('failed', 'failed') in compile_status_transitions({'failed': ('failed', 'paid')}))
+        self.assertRaises(ImproperlyConfigured, compile_status_transitions, {'paid': ('refunded', )})
+
+    def test_on_success(self):
+        Payment = get_model('getpaid', 'Payment')
+        self.assertFalse(self.payment.on_success(Decimal('40.00')))
+        payment = Payment.objects.get(pk=self.payment.pk)
+        self.assertEqual((payment.status, payment.amount_paid), ('partially_paid', Decimal('40.00')))
+        self.assertNotEqual(payment.paid_on, None)
+
+    def test_partial_payments(self):
+        Payment = get_model('getpaid', 'Payment')
+        self.assertFalse(self.payment.on_success(Decimal('40.00')))
+        stale = Payment.objects.get(pk=self.payment.pk)
+        self.assertFalse(self.payment.on_success(Decimal('70.00')))
+        payment = Payment.objects.get(pk=self.payment.pk)
+        self.assertEqual((payment.status, payment.amount_paid), ('partially_paid', Decimal('70.00')))
+        # repeated notification changes nothing, and a stale instance does not overwrite the amount
+        with self.assertNumQueries(0):
+            self.assertFalse(self.payment.change_status('partially_paid', amount_paid=Decimal('70.00')))
+        self.assertFalse(stale.change_status('partially_paid', amount_paid=Decimal('50.00')))
+        self.assertEqual(stale.amount_paid, Decimal('70.00'))
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).amount_paid, Decimal('70.00'))
+        self.assertTrue(payment.on_success(Decimal('100.00')))
+        self.assertEqual(self.changes, [(self.payment.pk, 'new', 'partially_paid'),
+                                        (self.payment.pk, 'partially_paid', 'paid')])
+
+    def test_dispatch_after_commit(self):
+        from getpaid import signals
+        from getpaid.dispatch import notification_transaction
+        batches = []
+        receiver = lambda sender, changes, **kwargs: batches.append(
+            [(payment.pk, old_status, new_status) for payment, old_status, new_status in changes])
+        signals.payment_statuses_changed.connect(receiver)
+        try:
+            # signals are sent right away by default
+            with notification_transaction():
+                self.payment.change_status('in_progress')
+                self.assertEqual(self.changes, [(self.payment.pk, 'new', 'in_progress')])
+
+            with self.settings(GETPAID_DISPATCH_AFTER_COMMIT=True):
+                with notification_transaction():
+                    self.payment.change_status('partially_paid')
+                    self.payment.change_status('paid')
+                    self.assertEqual(len(self.changes), 1)
+        finally:
+            signals.payment_statuses_changed.disconnect(receiver)
+        self.assertEqual(self.changes, [(self.payment.pk, 'new', 'in_progress'),
+                                        (self.payment.pk, 'in_progress', 'partially_paid'),
+                                        (self.payment.pk, 'partially_paid', 'paid')])
+        self.assertEqual(batches, [[(self.payment.pk, 'new', 'in_progress')],
+                                   [(self.payment.pk, 'in_progress', 'partially_paid'),
+                                    (self.payment.pk, 'partially_paid', 'paid')]])
+        self.assertEqual(Order.objects.get(pk=self.payment.order_id).status, 'P')
+
+    def test_dispatch_dropped_on_failure(self):
+        from getpaid.dispatch import notification_transaction
+        with self.settings(GETPAID_DISPATCH_AFTER_COMMIT=True):
+            try:
+                with notification_transaction():
+                    self.payment.change_status('paid')
+                    raise IOError
+            except IOError:
+                pass
+        self.assertEqual(self.changes, [])
+
+
+def slow_new_payment_listener(sender, **kwargs):
+    time.sleep(0.02)
+
+
+class SignalTimingTest(TestCase):
+    def create_payment(self):
+        order = Order(name='Test EUR order', total=100, currency='EUR')
+        order.save()
+        response = self.client.post(reverse('getpaid:new-payment', kwargs={'currency': 'EUR'}),
+                                    {'order': order.pk, 'backend': 'getpaid.backends.dummy'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_signal_timings(self):
+        from getpaid import signals
+        from getpaid.instrumentation import signal_timings
+        signals.new_payment.connect(slow_new_payment_listener)
+        try:
+            with signal_timings() as timings:
+                self.create_payment()
+        finally:
+            signals.new_payment.disconnect(slow_new_payment_listener)
+        stats = timings.as_dict()
+        # only signals with receivers are timed
+        self.assertEqual(sorted(stats['signals']), ['new_payment', 'new_payment_query', 'payment_status_changed'])
+        listener = ('new_payment_query', 'getpaid_test_project.orders.listeners.new_payment_query_listener')
+        self.assertEqual(stats['receivers'][listener]['count'], 1)
+        slow = ('new_payment', 'getpaid_test_project.orders.tests.slow_new_payment_listener')
+        self.assertTrue(stats['receivers'][slow]['p50'] >= 0.02)
+        self.assertEqual(timings.over_budget(0.015), [slow])
+
+    def test_receivers(self):
+        import gc
+        from getpaid.instrumentation import TimedSignal, signal_timings
+        signal = TimedSignal('test')
+        receiver = lambda sender, **kwargs: sender
+        signal.connect(receiver)
+        signal.connect(self.bound_receiver, sender='a')
+        self.assertEqual(signal.send('a'), [(receiver, 'a'), (self.bound_receiver, 'bound')])
+        with signal_timings() as timings:
+            self.assertEqual(signal.send_robust('b'), [(receiver, 'b')])
+        self.assertEqual(timings.signals['test'].count, 1)
+        signal.disconnect(self.bound_receiver, sender='a')
+        self.assertEqual(signal.send('a'), [(receiver, 'a')])
+        # weak receivers are disconnected when collected
+        del receiver
+        gc.collect()
+        self.assertEqual(signal.receivers, [])
+
+    def bound_receiver(self, sender, **kwargs):
+        return 'bound'
+
+    def test_setting(self):
+        from getpaid.instrumentation import get_signal_timings
+        get_signal_timings().clear()
+        self.create_payment()
+        self.assertEqual(get_signal_timings().signals, {})
+        with self.settings(GETPAID_SIGNAL_TIMING={'budget': 0.5}):
+            self.create_payment()
+            self.create_payment()
+        self.assertEqual(get_signal_timings().signals['new_payment_query'].count, 2)
+        self.assertEqual(get_signal_timings().over_budget(0.5), [])
+        get_signal_timings().clear()
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from getpaid import metrics
+        cache.clear()
+        metrics.clear()
+
+    def tearDown(self):
+        from getpaid import metrics
+        metrics.clear()
+
+    def test_disabled(self):
+        self.assertEqual(self.client.get(reverse('getpaid:metrics')).status_code, 404)
+
+    def test_endpoint(self):
+        with self.settings(GETPAID_METRICS=True):
+            order = Order(name='Test EUR order', total=100, currency='EUR')
+            order.save()
+            self.client.post(reverse('getpaid:new-payment', kwargs={'currency': 'EUR'}),
+                             {'order': order.pk, 'backend': 'getpaid.backends.dummy'})
+            getpaid.backends.transferuj.PaymentProcessor.online('195.149.229.109', '1234', '1', '', '1', '123.45', None, None, None, None, None, 'xxx')
+            response = self.client.get(reverse('getpaid:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4')
+        self.assertIn('# TYPE getpaid_new_payment_seconds histogram\n', response.content)
+        self.assertIn('getpaid_new_payment_seconds_bucket{backend="getpaid.backends.dummy",le="+Inf"} 1\n', response.content)
+        self.assertIn('getpaid_gateway_url_seconds_count{backend="getpaid.backends.dummy"} 1\n', response.content)
+        self.assertIn('getpaid_status_change_seconds_count{backend="getpaid.backends.dummy"} 1\n', response.content)
+        self.assertIn('getpaid_signature_seconds_count{signature="transferuj.online"} 1\n', response.content)
+
+        with self.settings(GETPAID_METRICS={'allowed_ip': ('10.0.0.1', )}):
+            self.assertEqual(self.client.get(reverse('getpaid:metrics')).status_code, 403)
+        with self.settings(GETPAID_METRICS=True):
+            self.assertEqual(self.client.get(reverse('getpaid:metrics'), REMOTE_ADDR='10.0.0.1').status_code, 403)
+        with self.settings(GETPAID_METRICS={'allowed_ip': ()}):
+            self.assertEqual(self.client.get(reverse('getpaid:metrics'), REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+    def test_worker_registration_locked(self):
+        from django.core.cache import cache
+        from getpaid import metrics
+        with self.settings(GETPAID_METRICS=True):
+            cache.add('getpaid.metrics.workers.lock', 1)
+            metrics.flush()
+            self.assertEqual(cache.get('getpaid.metrics.workers'), None)
+            cache.delete('getpaid.metrics.workers.lock')
+            metrics.flush()
+            self.assertEqual(cache.get('getpaid.metrics.workers'), [metrics._worker])
+
+    def test_workers_merged(self):
+        from django.core.cache import cache
+        from getpaid import metrics
+        with self.settings(GETPAID_METRICS=True):
+            metrics.observe('getpaid_online_seconds', 0.003, backend='x')
+            metrics.observe('getpaid_online_seconds', 20, backend='x')
+            other = [0] * (len(metrics.BUCKETS) + 2)
+            other[0], other[-1] = 2, 0.001
+            cache.set('getpaid.metrics:other:1', {('getpaid_online_seconds', (('backend', 'x'), )): other})
+            cache.set('getpaid.metrics.workers', cache.get('getpaid.metrics.workers') + ['other:1'])
+            text = metrics.render(metrics.collect())
+        self.assertIn('getpaid_online_seconds_bucket{backend="x",le="0.001"} 2\n'
+                      'getpaid_online_seconds_bucket{backend="x",le="0.0025"} 2\n'
+                      'getpaid_online_seconds_bucket{backend="x",le="0.005"} 3\n', text)
+        self.assertIn('getpaid_online_seconds_bucket{backend="x",le="10.0"} 3\n'
+                      'getpaid_online_seconds_bucket{backend="x",le="+Inf"} 4\n'
+                      'getpaid_online_seconds_sum{backend="x"} 20.004\n'
+                      'getpaid_online_seconds_count{backend="x"} 4\n', text)
+
+
+
+class BenchmarkTest(TestCase):
+    def setUp(self):
+        ledger.clear()
+
+    def run_benchmark(self, name):
+        from getpaid_test_project.orders.benchmarks import BENCHMARKS, cleanup
+        setup = dict((benchmark[0], benchmark[1]) for benchmark in BENCHMARKS)[name]
+        try:
+            func = setup()
+            return [func(), func()]
+        finally:
+            cleanup()
+
+    def test_all_benchmarks_run(self):
+        from getpaid_test_project.orders.benchmarks import BENCHMARKS
+        for name, setup, db in BENCHMARKS:
+            self.run_benchmark(name)
+
+    def test_notifications_accepted(self):
+        for name, content in (('online.payu', 'OK'), ('online.transferuj', 'TRUE'),
+                              ('online.payanyway', 'SUCCESS'), ('online.dotpay', 'OK')):
+            self.assertEqual([response.content for response in self.run_benchmark(name)], [content, content])
+        for response in self.run_benchmark('online.platron'):
+            self.assertContains(response, '<pg_status>ok</pg_status>')
+
+    def test_compare(self):
+        import json
+        import os
+        import tempfile
+        from django.core.management import call_command
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            stdout = StringIO()
+            call_command('benchmark', 'signing.payu.request', save=path, stdout=stdout)
+            self.assertIn('signing.payu.request:legacy', stdout.getvalue())
+            with open(path) as f:
+                saved = json.load(f)
+            self.assertEqual(sorted(saved['results']), ['signing.payu.request', 'signing.payu.request:legacy'])
+
+            saved['results']['signing.payu.request']['ops'] *= 100
+            with open(path, 'w') as f:
+                json.dump(saved, f)
+            stderr = StringIO()
+            self.assertRaises(SystemExit, call_command, 'benchmark', 'signing.payu.request', compare=path,
+                              threshold=50, stdout=StringIO(), stderr=stderr)
+            self.assertIn('Slower by more than 50%% than %s: signing.payu.request\n' % path, stderr.getvalue())
+        finally:
+            os.remove(path)
+
+class BackendRegistryTest(TestCase):
+    def test_choices_by_currency(self):
+        self.assertEqual([name for name, label in get_backend_choices('PLN')],
+                         ['getpaid.backends.dummy', 'getpaid.backends.payu', 'getpaid.backends.transferuj'])
+        self.assertEqual([name for name, label in get_backend_choices('RUB')],
+                         ['getpaid.backends.payanyway', 'getpaid.backends.platron'])
+        self.assertEqual(get_backend_choices('XXX'), [])
+        self.assertEqual(len(get_backend_choices()), 5)
+
+    def test_get_processor(self):
+        Payment = get_model('getpaid', 'Payment')
+        payment = Payment(backend='getpaid.backends.payu')
+        self.assertIs(payment.get_processor(), getpaid.backends.payu.PaymentProcessor)
+        payment.backend = 'getpaid.backends.dotpay'
+        self.assertRaises(ValueError, payment.get_processor)
+
+    def test_rebuilt_on_settings_change(self):
+        registry = get_registry()
+        with self.settings(GETPAID_BACKENDS=('getpaid.backends.dummy', )):
+            self.assertEqual(get_registry().names, ('getpaid.backends.dummy', ))
+            self.assertEqual(get_backend_choices('RUB'), [])
+        self.assertIsNot(get_registry(), registry)
+        self.assertEqual(len(get_registry()), 5)
+
+
+class BackendConfigTest(TestCase):
+    def test_config_values_and_defaults(self):
+        config = getpaid.backends.payu.PaymentProcessor.get_backend_config()
+        self.assertEqual(config.pos_id, 123456789)
+        self.assertEqual(config.method, 'get')
+        self.assertEqual(config.lang, None)
+        self.assertRaises(AttributeError, setattr, config, 'pos_id', 1)
+        self.assertIs(getpaid.backends.payu.PaymentProcessor.get_backend_config(), config)
+
+    def test_missing_required_setting_fails_fast(self):
+        with self.settings(GETPAID_BACKENDS_SETTINGS={'getpaid.backends.payu': {'pos_id': 1}}):
+            self.assertRaises(ImproperlyConfigured, BackendRegistry, ('getpaid.backends.payu', ))
+            self.assertRaises(ImproperlyConfigured, getattr,
+                              getpaid.backends.payu.PaymentProcessor.get_backend_config(), 'key1')
+        BackendRegistry(('getpaid.backends.payu', ))
+
+    def test_get_backend_setting_default(self):
+        processor = getpaid.backends.payu.PaymentProcessor
+        # explicit default wins over BACKEND_DEFAULT_SETTINGS when the setting is not provided
+        self.assertEqual(processor.get_backend_setting('testing', 'no'), 'no')
+        self.assertEqual(processor.get_backend_setting('signing', 'no'), True)
+        with override_backend_config(processor, testing=True):
+            self.assertEqual(processor.get_backend_setting('testing', 'no'), True)
+
+    def test_override_backend_config(self):
+        processor = getpaid.backends.transferuj.PaymentProcessor
+        with override_backend_config(processor, allowed_ip=('1.1.1.1', )):
+            self.assertEqual(processor.get_backend_config().allowed_ip, ('1.1.1.1', ))
+            self.assertEqual(processor.get_backend_config().id, 1234)
+        self.assertEqual(processor.get_backend_config().allowed_ip, processor._ALLOWED_IP)
+
+
+class OrderDescriptionTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.order = Order(name='Test order', total='123.45', currency='PLN')
+        self.order.save()
+        Payment = get_model('getpaid', 'Payment')
+        self.payment = Payment(order=self.order, amount=self.order.total, currency=self.order.currency,
+                               backend='getpaid.backends.payu')
+        self.processor = getpaid.backends.payu.PaymentProcessor(self.payment)
+
+    def test_template(self):
+        self.assertEqual(self.processor.get_order_description(self.payment, self.order), unicode(self.order))
+        with self.settings(GETPAID_ORDER_DESCRIPTION='Order {{ order.id }} - {{ order.name }}'):
+            with mock.patch('getpaid.backends.Template', wraps=getpaid.backends.Template) as template:
+                self.assertEqual(self.processor.get_order_description(self.payment, self.order),
+                                 'Order %s - Test order' % self.order.pk)
+                self.assertEqual(self.processor.get_order_description(self.payment, self.order),
+                                 'Order %s - Test order' % self.order.pk)
+            self.assertEqual(template.call_count, 1)
+        with self.settings(GETPAID_ORDER_DESCRIPTION='Order at example.com'):
+            with mock.patch('getpaid.backends.Template') as template:
+                self.assertEqual(self.processor.get_order_description(self.payment, self.order), 'Order at example.com')
+            self.assertFalse(template.called)
+
+    def test_non_ascii(self):
+        with self.settings(GETPAID_ORDER_DESCRIPTION='Zam\xc3\xb3wienie w sklepie'):
+            description = self.processor.get_order_description(self.payment, self.order)
+            self.assertEqual(description, u'Zam\xf3wienie w sklepie')
+            self.assertTrue(isinstance(description, unicode))
+        with self.settings(GETPAID_ORDER_DESCRIPTION='Zam\xc3\xb3wienie {{ order.name }}',
+                           GETPAID_ORDER_DESCRIPTION_CACHE=60):
+            self.assertEqual(self.processor.get_order_description(self.payment, self.order),
+                             u'Zam\xf3wienie Test order')
+
+    def test_cache(self):
+        with self.settings(GETPAID_ORDER_DESCRIPTION='{{ order.name }}', GETPAID_ORDER_DESCRIPTION_CACHE=60):
+            self.assertEqual(self.processor.get_order_description(self.payment, self.order), 'Test order')
+            self.order.name = 'Renamed order'
+            self.assertEqual(self.processor.get_order_description(self.payment, self.order), 'Test order')
+        with self.settings(GETPAID_ORDER_DESCRIPTION='{{ order.name }}!', GETPAID_ORDER_DESCRIPTION_CACHE=60):
+            self.assertEqual(self.processor.get_order_description(self.payment, self.order), 'Renamed order!')
+
+
+class AbsoluteURLTest(TestCase):
+    def setUp(self):
+        from getpaid.backends import reset_routes, reset_site_urls
+        reset_site_urls()
+        reset_routes()
+
+    def tearDown(self):
+        from django.contrib.sites.models import Site
+        from getpaid.backends import reset_site_urls
+        # changes of Site are rolled back without signals
+        Site.objects.clear_cache()
+        reset_site_urls()
+
+    def test_build_absolute_url(self):
+        from django.contrib.sites.models import Site
+        from getpaid.backends import build_absolute_url
+        self.assertEqual(build_absolute_url('getpaid:transferuj:online'),
+                         'http://example.com' + reverse('getpaid:transferuj:online'))
+        self.assertEqual(build_absolute_url('getpaid:transferuj:success', True, 12),
+                         'https://example.com' + reverse('getpaid:transferuj:success', kwargs={'pk': 12}))
+        with self.assertNumQueries(0):
+            self.assertEqual(build_absolute_url('getpaid:transferuj:failure', True, 34),
+                             'https://example.com' + reverse('getpaid:transferuj:failure', kwargs={'pk': 34}))
+            self.assertEqual(build_absolute_url('getpaid:transferuj:failure', True, 5),
+                             'https://example.com' + reverse('getpaid:transferuj:failure', kwargs={'pk': 5}))
+
+        site = Site.objects.get_current()
+        site.domain = 'shop.example.com'
+        site.save()
+        self.assertEqual(build_absolute_url('getpaid:transferuj:online'),
+                         'http://shop.example.com' + reverse('getpaid:transferuj:online'))
+
+    def test_transferuj(self):
+        Payment = get_model('getpaid', 'Payment')
+        order = Order(name='Test order', total='123.45', currency='PLN')
+        order.save()
+        payment = Payment.objects.create(order=order, amount=order.total, currency=order.currency,
+                                         backend='getpaid.backends.transferuj')
+        processor = getpaid.backends.transferuj.PaymentProcessor
+        request = RequestFactory().get('/', REMOTE_ADDR='123.123.123.123')
+        with override_backend_config(processor, method='post', force_ssl_return=True):
+            url, method, params = processor(payment).get_gateway_url(request)
+        self.assertEqual(params['wyn_url'], 'http://example.com/getpaid.backends.transferuj/online/')
+        self.assertEqual(params['pow_url'],
+                         'https://example.com/getpaid.backends.transferuj/success/%d/' % payment.pk)
+        self.assertEqual(params['pow_url_blad'],
+                         'https://example.com/getpaid.backends.transferuj/failure/%d/' % payment.pk)
+
+
+class SigningTest(TestCase):
+    def test_signature_text(self):
+        params = {'a': u'za\u017c\xf3\u0142\u0107', 'b': 12, 'c': '3'}
+        self.assertEqual(Signature(('a', 'b', 'x', 'c')).compute(params, 'key'),
+                         hashlib.md5(u'za\u017c\xf3\u0142\u0107123key'.encode('utf-8')).hexdigest())
+        self.assertEqual(Signature(('a', 'b', 'x', 'c'), separator=':', key_first=True).compute(params, 'PIN'),
+                         hashlib.md5(u'PIN:za\u017c\xf3\u0142\u0107:12::3'.encode('utf-8')).hexdigest())
+        self.assertEqual(compute_md5(['check', 1, u'2'], 'key', separator=';'), hashlib.md5('check;1;2;key').hexdigest())
+
+    def test_verify(self):
+        signature = Signature(('a', ))
+        self.assertTrue(signature.verify({'a': '1'}, 'key', unicode(hashlib.md5('1key').hexdigest())))
+        self.assertFalse(signature.verify({'a': '1'}, 'key', hashlib.md5('2key').hexdigest()))
+        self.assertFalse(signature.verify({'a': '1'}, 'key', None))
+        self.assertFalse(signature.verify({'a': '1'}, 'key', u'\u017c'))
+
+
+class StubGateway(object):
+    """
+    Local HTTP/1.1 server standing in for a payment gateway; answers every POST with ``body``, which can be
+    also a function of request path and data.
+    """
+
+    def __init__(self, body='', status=200, delay=0, keep_alive=True):
+        self.body = body
+        self.status = status
+        self.delay = delay
+        self.keep_alive = keep_alive
+        self.reset = False
+        self.requests = []
+        self.connections = 0
+        self.active = self.max_active = 0
+        self.sockets = []
+        self.lock = threading.Lock()
+        gateway = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                with gateway.lock:
+                    gateway.connections += 1
+                    gateway.sockets.append(self.request)
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+                with gateway.lock:
+                    gateway.requests.append((self.path, self.headers.getheader('Content-Type'), data))
+                    if gateway.reset:
+                        # reset the connection after the request was received
+                        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                        self.request.close()
+                        self.close_connection = 1
+                        return
+                    gateway.active += 1
+                    gateway.max_active = max(gateway.max_active, gateway.active)
+                time.sleep(gateway.delay)
+                body = gateway.body(self.path, data) if callable(gateway.body) else gateway.body
+                with gateway.lock:
+                    gateway.active -= 1
+                self.send_response(gateway.status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                if not gateway.keep_alive:
+                    # close without telling the client, like a gateway dropping idle connections
+                    self.close_connection = 1
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        # end keep-alive connections, so handler threads finish
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class HTTPClientTest(TestCase):
+    def setUp(self):
+        self.gateway = StubGateway('<response/>')
+
+    def tearDown(self):
+        self.gateway.close()
+
+    def test_keep_alive(self):
+        client = HTTPClient()
+        for i in range(3):
+            response = client.post(self.gateway.url + '/get?x=1', {'id': i})
+            self.assertEqual((response.status, response.body, response.read()), (200, '<response/>', '<response/>'))
+        self.assertEqual(self.gateway.connections, 1)
+        self.assertEqual(self.gateway.requests[2], ('/get?x=1', 'application/x-www-form-urlencoded', 'id=2'))
+        self.assertEqual(client.stats['127.0.0.1'].calls, 3)
+        self.assertEqual(client.stats['127.0.0.1'].errors, 0)
+        client.close()
+
+    def test_retry_closed_connection(self):
+        self.gateway.keep_alive = False
+        client = HTTPClient()
+        for i in range(3):
+            self.assertEqual(client.post(self.gateway.url, 'data').body, '<response/>')
+        self.assertEqual(len(self.gateway.requests), 3)
+        self.assertEqual(self.gateway.connections, 3)
+
+    def test_no_retry_after_post_was_sent(self):
+        from getpaid.backends.httpclient import HTTPError
+        client = HTTPClient()
+        client.post(self.gateway.url, 'data')
+        self.gateway.reset = True
+        self.assertRaises(HTTPError, client.post, self.gateway.url, 'data')
+        # the request reached the gateway on a reused connection, so it is not repeated
+        self.assertEqual(len(self.gateway.requests), 2)
+        client.close()
+
+    def test_errors(self):
+        from getpaid.backends.httpclient import HTTPError
+        self.gateway.delay = 0.5
+        client = HTTPClient(read_timeout=0.1)
+        self.assertRaises(HTTPError, client.post, self.gateway.url, 'data')
+        # request that could have reached the gateway is never repeated
+        self.assertEqual(len(self.gateway.requests), 1)
+        self.assertEqual(client.stats['127.0.0.1'].errors, 1)
+
+        self.gateway.delay = 0
+        self.gateway.status = 500
+        self.assertRaises(HTTPError, client.post, self.gateway.url, 'data')
+
+        self.gateway.close()
+        self.assertRaises(HTTPError, HTTPClient(connect_timeout=0.1).post, self.gateway.url, 'data')
+
+    def test_platron_init_payment(self):
+        from getpaid.backends.platron import PaymentProcessor
+        self.gateway.body = platron_fake_success_init_payment(None, 'POST', None).body
+        Payment = get_model('getpaid', 'Payment')
+        order = Order(name='Test RUB order', total='123.45', currency='RUB')
+        order.save()
+        payment = Payment(pk=99, order=order, amount=order.total, currency=order.currency, backend='getpaid.backends.platron')
+        payment.save(force_insert=True)
+        fake_request = RequestFactory()
+        setattr(fake_request, 'META', {'REMOTE_ADDR': '123.123.123.123'})
+
+        with self.settings(GETPAID_HTTP_CLIENT={'read_timeout': 1}):
+            with mock.patch.object(PaymentProcessor, '_INIT_PAYMENT_URL', self.gateway.url + '/init_payment.php'):
+                url, method, params = PaymentProcessor(payment).get_gateway_url(fake_request)
+        self.assertEqual(url, 'https://www.platron.ru/payment_params.php?customer=ccaa41a4f425d124a23c3a53a3140bdc15826')
+        path, content_type, data = self.gateway.requests[0]
+        self.assertEqual((path, content_type), ('/init_payment.php', 'text/xml'))
+        self.assertEqual(XMLParser.to_dict(data)['pg_order_id'], u'99')
+
+
+def fake_payment_get_response_success(self, method, url, body=None, headers=None):
+    return Response(200, 'OK', {}, """<?xml version="1.0" encoding="UTF-8"?>
     <response>
     <status>OK</status>
     <trans>
@@ -102,14 +757,11 @@ def fake_payment_get_response_success(request):
     <auth_fraud>0</auth_fraud>
     <ts>1342616255805</ts>
     <sig>4d4df5557b89a4e2d8c48436b1dd3fef</sig>	</trans>
-</response>"""
-    return fake_response()
+</response>""")
 
 
-def fake_payment_get_response_failure(request):
-    class fake_response:
-        def read(self):
-            return """<?xml version="1.0" encoding="UTF-8"?>
+def fake_payment_get_response_failure(self, method, url, body=None, headers=None):
+    return Response(200, 'OK', {}, """<?xml version="1.0" encoding="UTF-8"?>
     <response>
     <status>OK</status>
     <trans>
@@ -131,8 +783,7 @@ def fake_payment_get_response_failure(request):
     <auth_fraud>0</auth_fraud>
     <ts>1342616255805</ts>
     <sig>ee77e9515599e3fd2b3721dff50111dd</sig>	</trans>
-</response>"""
-    return fake_response()
+</response>""")
 
 class PayUBackendTest(TestCase):
     def setUp(self):
@@ -178,7 +829,7 @@ class PayUBackendTest(TestCase):
             })
         self.assertEqual(response.content, 'OK')
 
-    @mock.patch("urllib2.urlopen", fake_payment_get_response_success)
+    @mock.patch.object(HTTPClient, 'request', fake_payment_get_response_success)
     def test_payment_get_paid(self):
         Payment = get_model('getpaid', 'Payment')
         order = Order(name='Test EUR order', total='123.45', currency='PLN')
@@ -192,7 +843,7 @@ class PayUBackendTest(TestCase):
         self.assertNotEqual(payment.paid_on, None)
         self.assertNotEqual(payment.amount_paid, Decimal('0'))
 
-    @mock.patch("urllib2.urlopen", fake_payment_get_response_failure)
+    @mock.patch.object(HTTPClient, 'request', fake_payment_get_response_failure)
     def test_payment_get_failed(self):
         Payment = get_model('getpaid', 'Payment')
         order = Order(name='Test EUR order', total='123.45', currency='PLN')
@@ -206,9 +857,230 @@ class PayUBackendTest(TestCase):
         self.assertEqual(payment.paid_on, None)
         self.assertEqual(payment.amount_paid, Decimal('0'))
 
-class TransferujBackendTest(TestCase):
+    def test_payment_get_parser(self):
+        from getpaid.backends.payu.xml_parsing import TransParser
+        fields = getpaid.backends.payu.PaymentProcessor._GET_RESPONSE_FIELDS
+        trans = '<trans><id>1</id><pos_id>123</pos_id><session_id>%d:1</session_id><order_id>%d</order_id>' \
+                '<status>99</status><amount>100</amount><desc>Test &amp; test</desc><ts>1</ts><sig>x</sig></trans>'
+        # parsing stops after first transaction, so the rest of response is never read
+        response = StringIO('<response><status>OK</status>%s%s<trans><broken' % (trans % (1, 1), trans % (2, 2)))
+        self.assertEqual(TransParser(fields).parse(response, chunk_size=64), {
+            'pos_id': u'123', 'session_id': u'1:1', 'order_id': u'1', 'status': u'99', 'amount': u'100',
+            'desc': u'Test & test', 'ts': u'1', 'sig': u'x',
+        })
+        self.assertNotEqual(response.read(), '')
+
+        response = StringIO('<response><status>OK</status><trans><status>2</status></trans></response>')
+        self.assertEqual(TransParser(fields).parse(response), {'status': u'2'})
+        response = StringIO('<response><status>ERROR</status></response>')
+        self.assertEqual(TransParser(fields).parse(response), None)
+
+
+class PayUCoalescingTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def notify(self, session_id):
+        params = {'pos_id': '123456789', 'session_id': session_id, 'ts': '1111'}
+        params['sig'] = getpaid.backends.payu.PaymentProcessor._ONLINE_SIG.compute(params, 'xxx')
+        return getpaid.backends.payu.PaymentProcessor.online(**params)
+
+    @mock.patch('getpaid.backends.payu.get_payment_status_task')
+    def test_coalescing(self, task):
+        from django.core.cache import cache
+        from getpaid.backends.payu.coalescing import release_poll, saved_polls, SAVED_POLLS_TIMEOUT
+        with override_backend_config(getpaid.backends.payu.PaymentProcessor, poll_window=5):
+            with mock.patch.object(cache, 'add', wraps=cache.add) as add:
+                for i in range(3):
+                    self.assertEqual(self.notify('1:11111'), 'OK')
+            self.assertEqual(self.notify('2:22222'), 'OK')
+        self.assertEqual(task.apply_async.call_args_list, [
+            mock.call(('1', '1:11111'), {}, countdown=5),
+            mock.call(('2', '2:22222'), {}, countdown=5)])
+        self.assertEqual(saved_polls(), 2)
+        self.assertIn(mock.call('getpaid.payu.saved_polls', 0, SAVED_POLLS_TIMEOUT), add.call_args_list)
+
+        release_poll('1:11111')
+        with override_backend_config(getpaid.backends.payu.PaymentProcessor, poll_window=5):
+            self.notify('1:11111')
+        self.assertEqual(task.apply_async.call_count, 3)
+        self.assertEqual(saved_polls(), 2)
+
+    @mock.patch('getpaid.backends.payu.get_payment_status_task')
+    def test_no_window(self, task):
+        self.notify('1:11111')
+        self.notify('1:11111')
+        self.assertEqual(task.delay.call_count, 2)
+        self.assertFalse(task.apply_async.called)
+
+
+class OutboxTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def notify(self, session_id):
+        params = {'pos_id': '123456789', 'session_id': session_id, 'ts': '1111'}
+        params['sig'] = getpaid.backends.payu.PaymentProcessor._ONLINE_SIG.compute(params, 'xxx')
+        return getpaid.backends.payu.PaymentProcessor.online(**params)
+
+    def test_enqueue_and_relay(self):
+        from getpaid.backends.outbox import relay_outbox
+        from getpaid.backends.payu.tasks import get_payment_status_task
+        OutboxMessage = get_model('getpaid', 'OutboxMessage')
+        with mock.patch.object(get_payment_status_task, 'apply_async') as apply_async:
+            with self.settings(GETPAID_OUTBOX=True):
+                with override_backend_config(getpaid.backends.payu.PaymentProcessor, poll_window=5):
+                    self.assertEqual(self.notify('1:11111'), 'OK')
+                    self.assertEqual(self.notify('2:22222'), 'OK')
+            self.assertFalse(apply_async.called)
+            self.assertEqual(OutboxMessage.objects.filter(sent_on=None).count(), 2)
+
+            self.assertEqual(relay_outbox(), {'sent': 2, 'errors': 0})
+            first, second = OutboxMessage.objects.all()
+            self.assertEqual(apply_async.call_args_list, [
+                mock.call([u'1', u'1:11111'], {}, eta=first.eta),
+                mock.call([u'2', u'2:22222'], {}, eta=second.eta)])
+            self.assertNotEqual(first.eta, None)
+            self.assertEqual(relay_outbox(), {'sent': 0, 'errors': 0})
+            self.assertEqual(apply_async.call_count, 2)
+
+    def test_unregistered_task(self):
+        from celery import current_app
+        from getpaid.backends.outbox import relay_outbox
+        OutboxMessage = get_model('getpaid', 'OutboxMessage')
+        OutboxMessage.objects.create(task='shop.tasks.unknown', payload='{"args": [1], "kwargs": {"a": 2}}')
+        with mock.patch.object(current_app, 'send_task') as send_task:
+            self.assertEqual(relay_outbox(), {'sent': 1, 'errors': 0})
+        send_task.assert_called_once_with('shop.tasks.unknown', [1], {'a': 2}, eta=None)
+
+    def test_broker_failure(self):
+        from getpaid.backends.outbox import relay_outbox
+        from getpaid.backends.payu.tasks import get_payment_status_task
+        OutboxMessage = get_model('getpaid', 'OutboxMessage')
+        with self.settings(GETPAID_OUTBOX=True):
+            self.notify('1:11111')
+        with mock.patch.object(get_payment_status_task, 'apply_async', side_effect=IOError):
+            self.assertEqual(relay_outbox(), {'sent': 0, 'errors': 1})
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.sent_on, message.attempts), (None, 1))
+        with mock.patch.object(get_payment_status_task, 'apply_async'):
+            self.assertEqual(relay_outbox(), {'sent': 1, 'errors': 0})
+
+
+class OutboxTransactionTest(TransactionTestCase):
+    def test_rolled_back(self):
+        from django.core.cache import cache
+        from django.db import transaction
+        cache.clear()
+        params = {'pos_id': '123456789', 'session_id': '1:11111', 'ts': '1111'}
+        params['sig'] = getpaid.backends.payu.PaymentProcessor._ONLINE_SIG.compute(params, 'xxx')
+        with self.settings(GETPAID_OUTBOX=True):
+            try:
+                with transaction.commit_on_success():
+                    self.assertEqual(getpaid.backends.payu.PaymentProcessor.online(**params), 'OK')
+                    raise IOError
+            except IOError:
+                pass
+        self.assertFalse(get_model('getpaid', 'OutboxMessage').objects.exists())
+
+    def test_rolled_back_claim(self):
+        from django.core.cache import cache
+        from getpaid.backends.payu.coalescing import claim_poll
+        from getpaid.dispatch import notification_transaction
+        cache.clear()
+        params = {'pos_id': '123456789', 'session_id': '1:11111', 'ts': '1111'}
+        params['sig'] = getpaid.backends.payu.PaymentProcessor._ONLINE_SIG.compute(params, 'xxx')
+        with self.settings(GETPAID_OUTBOX=True):
+            with override_backend_config(getpaid.backends.payu.PaymentProcessor, poll_window=5):
+                try:
+                    with notification_transaction(atomic=True):
+                        self.assertEqual(getpaid.backends.payu.PaymentProcessor.online(**params), 'OK')
+                        raise IOError
+                except IOError:
+                    pass
+        self.assertFalse(get_model('getpaid', 'OutboxMessage').objects.exists())
+        # the next notification schedules the poll
+        self.assertTrue(claim_poll('1:11111', 5))
+
+
+class PayUPollingTest(TestCase):
+    def setUp(self):
+        self.gateway = StubGateway(self.payment_get, delay=0.05)
+        self.patch = mock.patch.object(getpaid.backends.payu.PaymentProcessor, '_GATEWAY_URL', self.gateway.url + '/paygw/')
+        self.patch.start()
+        Payment = get_model('getpaid', 'Payment')
+        PaymentSession = get_model('payu', 'PaymentSession')
+        order = Order(name='Test PLN order', total='123.45', currency='PLN')
+        order.save()
+        for pk in (201, 202, 203):
+            payment = Payment(pk=pk, order=order, amount=order.total, currency=order.currency,
+                              backend='getpaid.backends.payu', status='in_progress')
+            payment.save(force_insert=True)
+            PaymentSession.objects.create(payment=payment, session_id='%d:1' % pk)
+            PaymentSession.objects.create(payment=payment, session_id='%d:2' % pk)
+
+    def tearDown(self):
+        self.patch.stop()
+        self.gateway.close()
+
+    def payment_get(self, path, data):
+        session_id = urlparse.parse_qs(data)['session_id'][0]
+        if session_id == '203:3':
+            return '<response><status>ERROR</status></response>'
+        params = {'pos_id': '123456789', 'session_id': session_id, 'order_id': session_id.split(':')[0],
+                  'status': '99' if session_id.endswith(':2') else '1', 'amount': '12345', 'desc': 'Test', 'ts': '1'}
+        if session_id == '202:4':
+            params['status'] = 'xxx'
+        elif session_id == '203:4':
+            params['pos_id'] = 'xxx'
+        params['sig'] = getpaid.backends.payu.PaymentProcessor._GET_RESPONSE_SIG.compute(params, 'xxx')
+        return '<response><status>OK</status><trans>%s</trans></response>' % ''.join(
+            ['<%s>%s</%s>' % (key, value, key) for key, value in params.items()])
+
+    def test_poll_queryset(self):
+        from getpaid.backends.payu.polling import poll_payment_statuses
+        Payment = get_model('getpaid', 'Payment')
+        summary = poll_payment_statuses(Payment.objects.filter(status='in_progress'), workers=3, per_host=2,
+                                        batch_size=2)
+        self.assertEqual(summary, {'polled': 3, 'changed': 3, 'errors': 0})
+        # only latest session of each payment is polled
+        self.assertEqual(sorted([urlparse.parse_qs(data)['session_id'][0] for path, content_type, data in self.gateway.requests]),
+                         ['201:2', '202:2', '203:2'])
+        self.assertEqual(self.gateway.requests[0][0], '/paygw/UTF/Payment/get/xml')
+        self.assertTrue(self.gateway.max_active <= 2)
+        self.assertEqual(Payment.objects.filter(status='paid').count(), 3)
+
+    def test_poll_session_ids(self):
+        from getpaid.backends.payu.polling import poll_payment_statuses
+        Payment = get_model('getpaid', 'Payment')
+        summary = poll_payment_statuses(['201:2', '202:1', '203:3', '999:1', 'xxx'])
+        self.assertEqual(summary, {'polled': 3, 'changed': 1, 'errors': 1})
+        self.assertEqual(Payment.objects.get(pk=201).status, 'paid')
+        self.assertEqual(Payment.objects.get(pk=202).status, 'in_progress')
+
+    def test_malformed_responses_are_counted(self):
+        from getpaid.backends.payu.polling import poll_payment_statuses
+        Payment = get_model('getpaid', 'Payment')
+        summary = poll_payment_statuses(['202:4', '203:4', '201:2'], workers=1, batch_size=3)
+        self.assertEqual(summary, {'polled': 3, 'changed': 1, 'errors': 2})
+        self.assertEqual(Payment.objects.get(pk=201).status, 'paid')
+        self.assertEqual(Payment.objects.get(pk=202).status, 'in_progress')
+
+    def test_command(self):
+        from django.core.management import call_command
+        Payment = get_model('getpaid', 'Payment')
+        stdout = StringIO()
+        call_command('payu_poll_statuses', workers=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Polled 3 sessions: 3 payments changed, 0 errors\n')
+        self.assertEqual(Payment.objects.filter(status='paid').count(), 3)
 
 
+class TransferujBackendTest(TestCase):
+    def setUp(self):
+        ledger.clear()
+
     def test_online_not_allowed_ip(self):
         self.assertEqual('IP ERR', getpaid.backends.transferuj.PaymentProcessor.online('0.0.0.0', None,  None, None, None, None, None, None, None, None, None, None))
 
@@ -288,11 +1160,137 @@ class TransferujBackendTest(TestCase):
         payment = Payment.objects.get(pk=payment.pk)
         self.assertEqual(payment.status, 'failed')
 
+    def test_online_duplicate(self):
+        Payment = get_model('getpaid', 'Payment')
+        order = Order(name='Test EUR order', total='123.45', currency='PLN')
+        order.save()
+        payment = Payment(order=order, amount=order.total, currency=order.currency, backend='getpaid.backends.payu')
+        payment.save(force_insert=True)
+        params = ('195.149.229.109', '1234', '1', '', payment.pk, '123.45', '23.45', '', 'TRUE', 0, '', '21b028c2dbdcb9ca272d1cc67ed0574e')
+        self.assertEqual('TRUE', getpaid.backends.transferuj.PaymentProcessor.online(*params))
+        Payment.objects.filter(pk=payment.pk).update(status='in_progress')
+
+        # Repeated delivery is answered from memory and does not touch the payment
+        with self.assertNumQueries(0):
+            self.assertEqual('TRUE', getpaid.backends.transferuj.PaymentProcessor.online(*params))
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, 'in_progress')
+
+        # ...or from the database in other processes
+        ledger.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual('TRUE', getpaid.backends.transferuj.PaymentProcessor.online(*params))
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, 'in_progress')
+
+    def test_online_changed_notification(self):
+        Payment = get_model('getpaid', 'Payment')
+        order = Order(name='Test EUR order', total='123.45', currency='PLN')
+        order.save()
+        payment = Payment(order=order, amount=order.total, currency=order.currency, backend='getpaid.backends.payu')
+        payment.save(force_insert=True)
+        self.assertEqual('TRUE', getpaid.backends.transferuj.PaymentProcessor.online('195.149.229.109', '1234', '1', '', payment.pk, '123.45', '23.45', '', 'TRUE', 0, '', '21b028c2dbdcb9ca272d1cc67ed0574e'))
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, 'partially_paid')
 
-def platron_fake_success_init_payment(request):
-    class fake_response:
-        def read(self):
-            return """<?xml version="1.0" encoding="utf-8"?>
+        # Same transaction with other payload is processed again
+        self.assertEqual('TRUE', getpaid.backends.transferuj.PaymentProcessor.online('195.149.229.109', '1234', '1', '', payment.pk, '123.45', '123.45', '', 'TRUE', 0, '', '21b028c2dbdcb9ca272d1cc67ed0574e'))
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, 'paid')
+        self.assertEqual(get_model('getpaid', 'ProcessedNotification').objects.filter(transaction_id='1').count(), 2)
+
+
+
+class InboxTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        ledger.clear()
+        Payment = get_model('getpaid', 'Payment')
+        order = Order(name='Test EUR order', total='123.45', currency='PLN')
+        order.save()
+        self.payment = Payment(order=order, amount=order.total, currency=order.currency,
+                               backend='getpaid.backends.transferuj')
+        self.payment.save(force_insert=True)
+
+    def notify(self, tr_paid, md5sum='21b028c2dbdcb9ca272d1cc67ed0574e'):
+        return getpaid.backends.transferuj.PaymentProcessor.online('195.149.229.109', '1234', '1', '', self.payment.pk,
+                                                                   '123.45', tr_paid, '', 'TRUE', 0, '', md5sum)
+
+    def test_deferred(self):
+        from getpaid.backends.inbox import process_inbox
+        InboxNotification = get_model('getpaid', 'InboxNotification')
+        Payment = get_model('getpaid', 'Payment')
+        with override_backend_config(getpaid.backends.transferuj.PaymentProcessor, deferred=True):
+            self.assertEqual(self.notify('23.45'), 'TRUE')
+            self.assertEqual(self.notify('123.45'), 'TRUE')
+            # Invalid notifications are still rejected at once
+            self.assertEqual(self.notify('123.45', md5sum='xxx'), 'SIG ERR')
+            self.assertEqual(Payment.objects.get(pk=self.payment.pk).status, 'new')
+            self.assertEqual(InboxNotification.objects.filter(processed_on=None).count(), 2)
+
+            self.assertEqual(process_inbox(workers=1), {'payments': 1, 'processed': 2, 'errors': 0})
+        payment = Payment.objects.get(pk=self.payment.pk)
+        self.assertEqual(payment.status, 'paid')
+        self.assertEqual(payment.amount_paid, Decimal('123.45'))
+        self.assertEqual(list(InboxNotification.objects.values_list('response', 'attempts')),
+                         [(u'TRUE', 1), (u'TRUE', 1)])
+        self.assertEqual(process_inbox(workers=1), {'payments': 0, 'processed': 0, 'errors': 0})
+
+    def test_not_deferred(self):
+        self.assertEqual(self.notify('123.45'), 'TRUE')
+        self.assertEqual(get_model('getpaid', 'Payment').objects.get(pk=self.payment.pk).status, 'paid')
+        self.assertFalse(get_model('getpaid', 'InboxNotification').objects.exists())
+
+    def test_failure_keeps_order(self):
+        from getpaid.backends.inbox import process_inbox
+        InboxNotification = get_model('getpaid', 'InboxNotification')
+        with override_backend_config(getpaid.backends.transferuj.PaymentProcessor, deferred=True):
+            self.notify('23.45')
+            self.notify('123.45')
+        with mock.patch.object(getpaid.backends.transferuj.PaymentProcessor, 'online', side_effect=IOError):
+            self.assertEqual(process_inbox(workers=1), {'payments': 1, 'processed': 0, 'errors': 1})
+        first, second = InboxNotification.objects.all()
+        self.assertEqual((first.attempts, second.attempts), (1, 0))
+        self.assertIn('IOError', first.error)
+        self.assertEqual(InboxNotification.objects.filter(processed_on=None).count(), 2)
+
+        self.assertEqual(process_inbox(workers=1), {'payments': 1, 'processed': 2, 'errors': 0})
+        self.assertEqual(get_model('getpaid', 'Payment').objects.get(pk=self.payment.pk).status, 'paid')
+
+    def test_give_up(self):
+        from getpaid.backends.inbox import process_inbox
+        InboxNotification = get_model('getpaid', 'InboxNotification')
+        online = getpaid.backends.transferuj.PaymentProcessor.online
+        with override_backend_config(getpaid.backends.transferuj.PaymentProcessor, deferred=True):
+            self.notify('23.45')
+            self.notify('123.45')
+
+        def fail_partial(*args):
+            if '23.45' in args:
+                raise IOError
+            return online(*args)
+
+        with mock.patch.object(getpaid.backends.transferuj.PaymentProcessor, 'online', side_effect=fail_partial):
+            self.assertEqual(process_inbox(workers=1, max_attempts=2), {'payments': 1, 'processed': 0, 'errors': 1})
+            self.assertEqual(process_inbox(workers=1, max_attempts=2), {'payments': 1, 'processed': 1, 'errors': 1})
+        first, second = InboxNotification.objects.all()
+        self.assertEqual(first.attempts, 2)
+        self.assertNotEqual(first.failed_on, None)
+        self.assertEqual(second.failed_on, None)
+        self.assertFalse(InboxNotification.objects.filter(processed_on=None).exists())
+        self.assertEqual(get_model('getpaid', 'Payment').objects.get(pk=self.payment.pk).status, 'paid')
+
+    @mock.patch('getpaid.management.commands.getpaid_process_inbox.time.sleep', side_effect=[None, KeyboardInterrupt])
+    @mock.patch('getpaid.management.commands.getpaid_process_inbox.process_inbox',
+                return_value={'payments': 2, 'processed': 2, 'errors': 0})
+    def test_command_interval(self, process_inbox, sleep):
+        from django.core.management import call_command
+        # a full pass is followed by a pause too
+        self.assertRaises(KeyboardInterrupt, call_command, 'getpaid_process_inbox', limit=2, interval=1,
+                          stdout=StringIO())
+        self.assertEqual(process_inbox.call_count, 2)
+        self.assertEqual(sleep.call_args_list, [mock.call(1), mock.call(1)])
+
+
+def platron_fake_success_init_payment(self, method, url, body=None, headers=None):
+    return Response(200, 'OK', {}, """<?xml version="1.0" encoding="utf-8"?>
                         <response>
                             <pg_salt>ijoi894j4ik39lo9</pg_salt>
                             <pg_status>ok</pg_status>
@@ -300,20 +1298,156 @@ def platron_fake_success_init_payment(request):
                             <pg_redirect_url>https://www.platron.ru/payment_params.php?customer=ccaa41a4f425d124a23c3a53a3140bdc15826</pg_redirect_url>
                             <pg_redirect_url_type>need data</pg_redirect_url_type>
                             <pg_sig>af8e41a4f425d124a23c3a53a3140bdc17ea0</pg_sig>
-                        </response>"""
-    return fake_response()
+                        </response>""")
 
 
-def platron_fake_fail_init_payment(request):
-    class fake_response:
-        def read(self):
-            return """<?xml version="1.0" encoding="utf-8"?>
+def platron_fake_fail_init_payment(self, method, url, body=None, headers=None):
+    return Response(200, 'OK', {}, """<?xml version="1.0" encoding="utf-8"?>
                         <response>
                             <pg_status>error</pg_status>
                             <pg_error_code>101</pg_error_code>
                             <pg_error_description>Empty merchant</pg_error_description>
-                        </response>"""
-    return fake_response()
+                        </response>""")
+
+
+class PlatronSignatureTest(TestCase):
+    # (script name, params, key, signature, signing order) recorded with the original quadratic implementation
+    CORPUS = (
+        ('init_payment.php', {'pg_merchant_id': '1234', 'pg_order_id': '99', 'pg_amount': '123.45',
+                              'pg_currency': 'RUR', 'pg_check_url': '', 'pg_payment_system': 'TEST',
+                              'pg_description': 'TEST', 'pg_user_ip': '123.123.123.123',
+                              'pg_salt': '4b3c5b1f4ec1e4b1b1e0a0e6f0b1c2d3', 'pg_language': 'en'},
+         'AAAAAAAA', 'fb0456d23ec3a6f1c5152092f6a5fa50',
+         ['pg_amount', 'pg_check_url', 'pg_currency', 'pg_description', 'pg_language', 'pg_merchant_id',
+          'pg_order_id', 'pg_payment_system', 'pg_salt', 'pg_user_ip']),
+        ('check', {'pg_salt': 'qwertyuiop', 'pg_order_id': '1234', 'pg_payment_id': '567890',
+                   'pg_payment_system': 'WEBMONEYR', 'pg_amount': '100.00', 'pg_currency': 'RUR',
+                   'pg_ps_currency': 'RUR', 'pg_ps_amount': '100.00', 'pg_ps_full_amount': '100.00',
+                   'uservar1': '121212'},
+         'AAAAAAAA', 'ed57bad3c1b30649033bb7b3e3d33b86',
+         ['pg_amount', 'pg_currency', 'pg_order_id', 'pg_payment_id', 'pg_payment_system', 'pg_ps_amount',
+          'pg_ps_currency', 'pg_ps_full_amount', 'pg_salt', 'uservar1']),
+        ('result', {'pg_salt': 'f0e1', 'pg_status': 'ok', 'pg_description': '', 'pg_error_description': ''},
+         'AAAAAAAA', '42e01e8ac22854ded5448360adeac999',
+         ['pg_description', 'pg_error_description', 'pg_salt', 'pg_status']),
+        ('result', {'pg_salt': 'f0e1', 'pg_status': 'rejected', 'pg_description': u'Payment rejected',
+                    'pg_error_description': u'Payment rejected'},
+         'AAAAAAAA', 'd094c561019a3a12cd54dcb2ce4d2d83',
+         ['pg_description', 'pg_error_description', 'pg_salt', 'pg_status']),
+        ('result.php', {'pg_order_id': '7', 'pg_amount': 100, 'pg_user_phone': 79001234567,
+                        'pg_description': u'\u0417\u0430\u043a\u0430\u0437 \u21167 \u2013 \u0451\u043b\u043a\u0430'},
+         'secret', 'df5ea3994ed7b48ce56c05035d75b2ac',
+         ['pg_amount', 'pg_description', 'pg_order_id', 'pg_user_phone']),
+        ('init_payment.php', {'pg_merchant_id': '1', 'pg_amount': '20.00', 'z_last': 'z',
+                              'pg_receipt': {'pg_item_name': u'\u041a\u043d\u0438\u0433\u0430',
+                                             'pg_item_amount': '10.00', 'pg_item_count': 2}},
+         'key', 'ef8301578ceed13f499a653f0bd20e78',
+         ['pg_amount', 'pg_merchant_id', 'pg_item_amount', 'pg_item_count', 'pg_item_name', 'z_last']),
+        ('init_payment.php', {'a': {'c': {'f': '6', 'e': '5'}, 'b': '2'}, 'd': '4', 'g': {'h': '8'}, 'aa': '1'},
+         'key', '66a0e88739dd2e690c61cb48e69f140f',
+         ['b', 'e', 'f', 'aa', 'd', 'h']),
+    )
+
+    def test_signing_order(self):
+        from getpaid.backends.platron import PaymentProcessor
+        for script_name, pg, key, signature, order in self.CORPUS:
+            flat, actual_order = PaymentProcessor._get_order(pg)
+            self.assertEqual(actual_order, order)
+            self.assertEqual(sorted(flat), sorted(order))
+
+    def test_compute_sig(self):
+        from getpaid.backends.platron import PaymentProcessor
+        for script_name, pg, key, signature, order in self.CORPUS:
+            self.assertEqual(PaymentProcessor.compute_sig(script_name, pg, key), signature)
+
+    def test_sign_and_serialize(self):
+        from getpaid.backends.platron import PaymentProcessor
+        from getpaid.backends.platron.xml_parsing import XMLParser
+        for script_name, pg, key, signature, order in self.CORPUS:
+            actual, xml = PaymentProcessor.sign_and_serialize(script_name, pg, key, 'response')
+            self.assertEqual(actual, signature)
+            self.assertTrue(xml.startswith('<?xml version="1.0" encoding="utf-8"?><response>'))
+            parsed = XMLParser.to_dict(xml)
+            self.assertEqual(parsed.pop('pg_sig'), signature)
+            self.assertEqual(PaymentProcessor.compute_sig(script_name, parsed, key), signature)
+
+
+class XMLWriterTest(TestCase):
+    def test_escape(self):
+        from getpaid.backends.xmlwriter import escape
+        self.assertEqual(escape(u'<a href="x">Tom & Jerry</a>'), u'&lt;a href=&quot;x&quot;&gt;Tom &amp; Jerry&lt;/a&gt;')
+        self.assertEqual(escape(100), u'100')
+
+    def test_template(self):
+        from getpaid.backends.xmlwriter import XMLTemplate
+        template = XMLTemplate(u'<r a="100%"><x>{x}</x><y>{y}</y><x>{x}</x></r>')
+        self.assertEqual(template.fields, ('x', 'y', 'x'))
+        self.assertEqual(template.render({'x': u'\u0451 & <'}), '<r a="100%"><x>\xd1\x91 &amp; &lt;</x><y></y><x>\xd1\x91 &amp; &lt;</x></r>')
+
+    def test_platron_send_response(self):
+        from getpaid.backends.platron import PaymentProcessor
+        from getpaid.backends.platron.xml_parsing import XMLParser
+        with mock.patch.object(PaymentProcessor, 'generate_salt', staticmethod(lambda: 'f0e1')):
+            for description, status in (('', 'error'), (u'Payment rejected', 'rejected'), (u'<Tom> & Jerry', 'error')):
+                response = PaymentProcessor.send_response('result', description, status)
+                expected = PaymentProcessor.sign_and_serialize('result', {
+                    'pg_salt': 'f0e1',
+                    'pg_status': 'ok' if not description else status,
+                    'pg_description': description,
+                    'pg_error_description': description}, 'AAAAAAAA', 'response')[1]
+                self.assertEqual(response, expected)
+                self.assertEqual(XMLParser.to_dict(response)['pg_description'], description)
+
+
+class PlatronXMLParserTest(TestCase):
+    def test_flat(self):
+        from getpaid.backends.platron.xml_parsing import XMLParser
+        xml = """<?xml version="1.0" encoding="utf-8"?>
+                 <response>
+                     <pg_status>ok</pg_status>
+                     <pg_payment_id>15826</pg_payment_id>
+                     <pg_redirect_url>https://www.platron.ru/payment_params.php?a=1&amp;b=2</pg_redirect_url>
+                     <pg_description></pg_description>
+                 </response>"""
+        self.assertEqual(XMLParser.to_dict(xml), {
+            'pg_status': u'ok',
+            'pg_payment_id': u'15826',
+            'pg_redirect_url': u'https://www.platron.ru/payment_params.php?a=1&b=2',
+            'pg_description': u'',
+        })
+
+    def test_nested_and_encoded(self):
+        from getpaid.backends.platron.xml_parsing import XMLParser
+        xml = u"""<?xml version="1.0" encoding="utf-8"?><request><pg_order_id>1</pg_order_id>
+                  <pg_receipt><pg_item><pg_item_name>\u041a\u043d\u0438\u0433\u0430</pg_item_name></pg_item>
+                  </pg_receipt></request>"""
+        expected = {'pg_order_id': u'1', 'pg_receipt': {'pg_item': {'pg_item_name': u'\u041a\u043d\u0438\u0433\u0430'}}}
+        self.assertEqual(XMLParser.to_dict(xml), expected)
+        self.assertEqual(XMLParser.to_dict(xml.encode('utf-8')), expected)
+
+    def test_no_root(self):
+        from getpaid.backends.platron.xml_parsing import XMLParser
+        self.assertEqual(XMLParser.to_dict('<other><pg_status>ok</pg_status></other>'), {})
+
+    def test_limits(self):
+        from getpaid.backends.platron.xml_parsing import XMLParseError, XMLParser
+        deep = '<request><a><b><c><d>1</d></c></b></a></request>'
+        self.assertEqual(XMLParser.to_dict(deep, max_depth=3), {'a': {'b': {'c': {'d': u'1'}}}})
+        self.assertRaises(XMLParseError, XMLParser.to_dict, deep)
+        self.assertRaises(XMLParseError, XMLParser.to_dict, '<request><a>%s</a></request>' % ('x' * 100),
+                          max_size=100)
+        self.assertRaises(XMLParseError, XMLParser.to_dict, '<request><a>1</b></request>')
+
+    def test_entities_rejected(self):
+        from getpaid.backends.platron.xml_parsing import XMLParseError, XMLParser
+        xml = """<?xml version="1.0"?>
+                 <!DOCTYPE request [<!ENTITY a "aaaaaaaaaa"><!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]>
+                 <request><pg_description>&b;</pg_description></request>"""
+        self.assertRaises(XMLParseError, XMLParser.to_dict, xml)
+
+    def test_malformed_online(self):
+        from getpaid.backends.platron import PaymentProcessor
+        self.assertEqual(PaymentProcessor.online('<request><pg_salt>', 'check'), 'MALFORMED')
 
 
 class PlatronBackendTest(TestCase):
@@ -356,8 +1490,9 @@ class PlatronBackendTest(TestCase):
 
     def setUp(self):
         self.client = Client()
+        ledger.clear()
 
-    @mock.patch("urllib2.urlopen", platron_fake_success_init_payment)
+    @mock.patch.object(HTTPClient, 'request', platron_fake_success_init_payment)
     def test_success_init_payment(self):
         Payment = get_model('getpaid', 'Payment')
         order = Order(name='Test EUR order', total='123.45', currency='RUB')
@@ -374,7 +1509,7 @@ class PlatronBackendTest(TestCase):
 
         self.assertEqual(url, 'https://www.platron.ru/payment_params.php?customer=ccaa41a4f425d124a23c3a53a3140bdc15826')
 
-    @mock.patch("urllib2.urlopen", platron_fake_fail_init_payment)
+    @mock.patch.object(HTTPClient, 'request', platron_fake_fail_init_payment)
     def test_fail_init_payment(self):
         Payment = get_model('getpaid', 'Payment')
         order = Order(name='Test EUR order', total='123.45', currency='RUB')
@@ -391,6 +1526,7 @@ class PlatronBackendTest(TestCase):
         url, method, params = processor.get_gateway_url(fake_request)
 
         self.assertEqual(url, '/getpaid.backends.platron/failure/?pg_error_code=101&pg_order_id=99&pg_error_description=Empty+merchant')
+        self.assertFalse(processor.gateway_url_reusable)
 
     def test_online_wrong_sig(self):
         self.assertEqual('SIG ERR', getpaid.backends.platron.PaymentProcessor.online(self.xml_check % ('1234', 'RUR', 'xxxx'), 'check'))
@@ -472,6 +1608,9 @@ class PlatronBackendTest(TestCase):
 
 
 class PayAnyWayBackendTest(TestCase):
+    def setUp(self):
+        ledger.clear()
+
     """
     def test_online_not_allowed_ip(self):
         self.assertEqual('IP ERR', getpaid.backends.transferuj.PaymentProcessor.online('0.0.0.0', None,  None, None, None, None, None, None, None, None, None, None))
@@ -547,7 +1686,21 @@ class PayAnyWayBackendTest(TestCase):
         params['signature'] = '102153d9e5b8e97e7f0d608448e3e18f'
         self.assertNotEqual('FAIL CRC ERR', getpaid.backends.payanyway.PaymentProcessor.online(**params))
 
-    #def test_check_request
+    def test_check_response(self):
+        from xml.dom.minidom import parseString
+        Payment = get_model('getpaid', 'Payment')
+        order = Order(name='Test check', total='123.00', currency='RUB')
+        order.save()
+        payment = Payment(pk=1234, order=order, amount=order.total, currency=order.currency, backend='getpaid.backends.payanyway')
+        payment.save(force_insert=True)
+        response = getpaid.backends.payanyway.PaymentProcessor.check(payment, id='1234', transaction_id='12<34>&',
+                                                                     amount='123.00')
+        xml = parseString(response)
+        text = lambda tag: xml.getElementsByTagName(tag)[0].firstChild.nodeValue
+        self.assertEqual(text('MNT_TRANSACTION_ID'), u'12<34>&')
+        self.assertEqual(text('MNT_RESULT_CODE'), u'402')
+        self.assertEqual(text('MNT_DESCRIPTION'), u'new')
+        self.assertEqual(text('MNT_SIGNATURE'), hashlib.md5('402123412<34>&AAAAAAAA').hexdigest())
 
     def test_online_payment_ok(self):
         params = {
@@ -605,4 +1758,297 @@ class PayAnyWayBackendTest(TestCase):
         self.assertEqual('TRUE', getpaid.backends.transferuj.PaymentProcessor.online('195.149.229.109', '1234', '1', '', payment.pk, '123.45', '23.45', '', False, 0, '', '21b028c2dbdcb9ca272d1cc67ed0574e'))
         payment = Payment.objects.get(pk=payment.pk)
         self.assertEqual(payment.status, 'failed')
-    """
\ No newline at end of file
+    """
+
+class SimulatorTest(TestCase):
+    def setUp(self):
+        from getpaid.simulators import Behavior, SimulatorApp, get_simulators
+        ledger.clear()
+        self.behavior = Behavior(retry_delay=0)
+        self.simulators = dict((simulator.BACKEND, simulator) for simulator in get_simulators(
+            shop_url='http://shop.example.com', behavior=self.behavior, transport=self.post_to_shop, workers=0))
+        self.app = SimulatorApp(self.simulators.values())
+        self.shop_responses = []
+
+    def post_to_shop(self, url, data):
+        response = Client(REMOTE_ADDR='127.0.0.1').post(urlparse.urlsplit(url).path, data)
+        self.shop_responses.append(response.content)
+        return response.status_code, response.content
+
+    def request_simulator(self, method, url, body=None, headers=None):
+        status, response_headers, body = self.app.request(method, url, body, (headers or {}).get('Content-Type', ''))
+        return Response(status, '', dict(response_headers), body)
+
+    def create_payment(self, backend, currency):
+        Payment = get_model('getpaid', 'Payment')
+        order = Order(name='Test order', total='123.45', currency=currency)
+        order.save()
+        payment = Payment(order=order, amount=order.total, currency=order.currency, backend=backend)
+        payment.save(force_insert=True)
+        return Payment.objects.get(pk=payment.pk)
+
+    def test_payu(self):
+        from getpaid.backends.payu import PaymentProcessor
+        payment = self.create_payment('getpaid.backends.payu', 'PLN')
+        request = RequestFactory().get('/', REMOTE_ADDR='123.123.123.123')
+        with override_backend_config(PaymentProcessor, gateway_url='http://simulator/payu/'):
+            url, method, params = PaymentProcessor(payment).get_gateway_url(request)
+            with mock.patch('getpaid.backends.payu.enqueue') as enqueue:
+                status, headers, body = self.app.request('GET', url)
+            self.assertEqual((status, headers), (302, [('Location', 'http://shop.example.com' + reverse(
+                'getpaid:payu:success', kwargs={'pk': payment.pk}))]))
+            self.assertEqual(self.shop_responses, ['OK'])
+            payment_id, session_id = enqueue.call_args[0][1]
+
+            with mock.patch.object(HTTPClient, 'request', self.request_simulator):
+                PaymentProcessor(payment).get_payment_status(session_id)
+        self.assertEqual(get_model('getpaid', 'Payment').objects.get(pk=payment.pk).status, 'paid')
+
+    @mock.patch.object(HTTPClient, 'request')
+    def test_platron(self, request_mock):
+        from getpaid.backends.platron import PaymentProcessor
+        request_mock.side_effect = self.request_simulator
+        payment = self.create_payment('getpaid.backends.platron', 'RUB')
+        request = RequestFactory().get('/', REMOTE_ADDR='123.123.123.123')
+        with override_backend_config(PaymentProcessor, init_payment_url='http://simulator/platron/init_payment.php'):
+            url, method, params = PaymentProcessor(payment).get_gateway_url(request)
+        self.assertEqual(url, 'http://simulator/platron/payment_params.php?customer=1')
+        status, headers, body = self.app.request('GET', url)
+        self.assertEqual(status, 302)
+        self.assertEqual(len(self.shop_responses), 2)
+        for response in self.shop_responses:
+            self.assertIn('<pg_status>ok</pg_status>', response)
+        self.assertEqual(get_model('getpaid', 'Payment').objects.get(pk=payment.pk).status, 'paid')
+
+    def test_transferuj_storm(self):
+        from getpaid.simulators import storm
+        payment = self.create_payment('getpaid.backends.transferuj', 'PLN')
+        simulator = self.simulators['getpaid.backends.transferuj']
+        with override_backend_config(getpaid.backends.transferuj.PaymentProcessor, allowed_ip=()):
+            summary = storm(simulator, [(payment.pk, payment.amount)], 3, concurrency=1)
+        self.assertEqual((summary['sent'], summary['acknowledged']), (3, 3))
+        self.assertEqual(self.shop_responses, ['TRUE'] * 3)
+        self.assertEqual(get_model('getpaid', 'Payment').objects.get(pk=payment.pk).status, 'paid')
+
+    def test_retries(self):
+        simulator = self.simulators['getpaid.backends.payanyway']
+        simulator.transport = mock.Mock(side_effect=[(500, ''), (200, 'FAIL'), (200, 'SUCCESS')])
+        self.assertTrue(simulator.deliver([('http://shop.example.com/', {})]))
+        self.assertEqual(simulator.stats.as_dict(), {'requests': 0, 'errors': 0, 'notifications': 3, 'retries': 2,
+                                                     'acknowledged': 1, 'failed': 0})
+
+        self.behavior.retries = 1
+        simulator.transport = mock.Mock(return_value=(None, ''))
+        self.assertFalse(simulator.deliver([('http://shop.example.com/', {})] * 2))
+        self.assertEqual(simulator.transport.call_count, 2)
+        self.assertEqual(simulator.stats.failed, 1)
+
+    def test_errors_and_server(self):
+        import urllib2
+        from getpaid.simulators import start_server
+        self.behavior.error_rate = 1
+        self.assertEqual(self.app.request('GET', '/payanyway/assistant.htm')[0], 500)
+        self.behavior.error_rate = 0
+        server = start_server(self.app)
+        try:
+            response = urllib2.urlopen(server.url + '/payanyway/assistant.htm?MNT_ID=1')
+            self.assertEqual(response.read(), 'Wrong signature')
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, server.url + '/unknown/')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(self.simulators['getpaid.backends.payanyway'].stats.requests, 2)
+
+
+class ReplayTest(TestCase):
+    def setUp(self):
+        from getpaid.simulators import get_simulators
+        ledger.clear()
+        Payment = get_model('getpaid', 'Payment')
+        order = Order(name='Test order', total='123.45', currency='PLN')
+        order.save()
+        self.payment = Payment(order=order, amount=order.total, currency=order.currency,
+                               backend='getpaid.backends.transferuj')
+        self.payment.save(force_insert=True)
+        self.simulator, = get_simulators(['getpaid.backends.transferuj'], shop_url='http://shop.example.com',
+                                         workers=0)
+
+    def capture(self):
+        from getpaid.replay import save_notification
+        f = StringIO()
+        (url, data), = self.simulator.notification(self.payment.pk, Decimal('123.45'))
+        save_notification(f, url, data, remote_addr='127.0.0.1')
+        save_notification(f, url, dict(data, md5sum='0' * 32), remote_addr='127.0.0.1')
+        save_notification(f, '/unknown/', {})
+        return f.getvalue()
+
+    def test_replay(self):
+        from getpaid.replay import load_notifications, replay
+        notifications = load_notifications(StringIO(self.capture()))
+        self.assertEqual(len(notifications), 3)
+        with override_backend_config(getpaid.backends.transferuj.PaymentProcessor, allowed_ip=()):
+            results = replay(notifications, concurrency=1)
+        self.assertEqual(results.codes, {'TRUE': 1, 'SIG ERR': 1, 'NO VIEW': 1})
+        self.assertEqual(len(results.queries), 2)
+        self.assertTrue(results.queries[0] > 0)
+        self.assertEqual(results.latency.count, 3)
+        self.assertEqual(get_model('getpaid', 'Payment').objects.get(pk=self.payment.pk).status, 'paid')
+
+    def test_view_exceptions(self):
+        from getpaid.replay import InProcessSender, replay
+
+        def send(sender, notification):
+            if notification['url'] == '/broken/':
+                raise ValueError
+            return 'OK', 1
+
+        notifications = [{'url': '/broken/' if i % 2 else '/ok/', 'params': {}} for i in range(10)]
+        with mock.patch.object(InProcessSender, '__call__', send):
+            for concurrency in (1, 2):
+                results = replay(notifications, concurrency=concurrency)
+                self.assertEqual(results.codes, {'OK': 5, 'EXC ValueError': 5})
+                self.assertEqual(results.queries, [1] * 5)
+
+    def test_load_errors(self):
+        from getpaid.replay import load_notifications
+        self.assertEqual(load_notifications(['\n']), [])
+        self.assertRaises(ValueError, load_notifications, ['{"url": "/"}\n'])
+        self.assertRaises(ValueError, load_notifications, ['not json\n'])
+
+    def test_response_code(self):
+        from getpaid.replay import get_response_code
+        self.assertEqual(get_response_code(403, ''), 'HTTP 403')
+        self.assertEqual(get_response_code(200, ' OK\n'), 'OK')
+        self.assertEqual(get_response_code(200, '<response><pg_status>error</pg_status>'
+                                                '<pg_description>Wrong signature</pg_description></response>'),
+                         'error: Wrong signature')
+
+    def test_command(self):
+        import os
+        import tempfile
+        from django.core.management import call_command
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.capture())
+            stdout = StringIO()
+            with override_backend_config(getpaid.backends.transferuj.PaymentProcessor, allowed_ip=()):
+                with mock.patch('sys.stdout', stdout):
+                    call_command('getpaid_replay', filename, repeat=2)
+        finally:
+            os.remove(filename)
+        output = stdout.getvalue()
+        self.assertIn('Replayed 6 notifications', output)
+        self.assertIn('       2  TRUE\n', output)
+
+
+@override_settings(GETPAID_REDIRECT_PLAN_TIMEOUT=600)
+class RedirectPlanTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.order = Order(name='Test RUB order', total='123.45', currency='RUB')
+        self.order.save()
+        self.get_gateway_url = getpaid.backends.payanyway.PaymentProcessor.get_gateway_url
+
+    def pay(self):
+        response = self.client.post(reverse('getpaid:new-payment', kwargs={'currency': 'RUB'}),
+                                    {'order': self.order.pk, 'backend': 'getpaid.backends.payanyway'})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_reuse(self):
+        Payment = get_model('getpaid', 'Payment')
+        with mock.patch.object(getpaid.backends.payanyway.PaymentProcessor, 'get_gateway_url', autospec=True,
+                               side_effect=self.get_gateway_url) as get_gateway_url:
+            first = self.pay()
+            second = self.pay()
+        self.assertEqual(get_gateway_url.call_count, 1)
+        self.assertEqual(first.context_data['gateway_url'], second.context_data['gateway_url'])
+        self.assertEqual(first.content, second.content)
+        payment = Payment.objects.get(order=self.order)
+        self.assertEqual(payment.status, 'in_progress')
+
+    def test_no_reuse(self):
+        Payment = get_model('getpaid', 'Payment')
+        self.pay()
+        # order total changed
+        self.order.total = '100.00'
+        self.order.save()
+        self.pay()
+        self.assertEqual(Payment.objects.filter(order=self.order).count(), 2)
+        # payment is not in progress any more
+        Payment.objects.filter(order=self.order).update(status='failed')
+        self.pay()
+        self.assertEqual(Payment.objects.filter(order=self.order).count(), 3)
+        # plan expired
+        from django.core.cache import cache
+        cache.clear()
+        self.pay()
+        self.assertEqual(Payment.objects.filter(order=self.order).count(), 4)
+
+    def test_disabled(self):
+        Payment = get_model('getpaid', 'Payment')
+        with self.settings(GETPAID_REDIRECT_PLAN_TIMEOUT=0):
+            self.pay()
+            self.pay()
+        self.assertEqual(Payment.objects.filter(order=self.order, status='in_progress').count(), 2)
+
+    def test_refused_not_reused(self):
+        Payment = get_model('getpaid', 'Payment')
+        def refuse(processor, request):
+            processor.gateway_url_reusable = False
+            return '/failure/?error=101', 'GET', {}
+
+        with mock.patch.object(getpaid.backends.payanyway.PaymentProcessor, 'get_gateway_url', refuse):
+            response = self.client.post(reverse('getpaid:new-payment', kwargs={'currency': 'RUB'}),
+                                        {'order': self.order.pk, 'backend': 'getpaid.backends.payanyway'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('/failure/?error=101'))
+        self.assertEqual(Payment.objects.get(order=self.order).status, 'new')
+        # the gateway is asked again, for a new payment
+        self.pay()
+        self.assertEqual([payment.status for payment in Payment.objects.filter(order=self.order).order_by('pk')],
+                         ['new', 'in_progress'])
+
+
+class PaymentMethodFormTest(TestCase):
+    def setUp(self):
+        from getpaid.forms import reset_rendered
+        reset_rendered()
+
+    def render(self, value):
+        from getpaid.forms import PaymentMethodForm
+        form = PaymentMethodForm('PLN', initial={'backend': value})
+        return unicode(form['backend'])
+
+    def render_uncached(self, value):
+        from getpaid.forms import PaymentMethodForm
+        form = PaymentMethodForm('PLN')
+        field = form.fields['backend']
+        return field.widget.get_renderer(form.add_prefix('backend'), value, {'id': 'id_backend'})
+
+    def test_render(self):
+        from django.forms.widgets import RadioFieldRenderer
+        for value in ('getpaid.backends.payu', 'getpaid.backends.transferuj', ''):
+            expected = RadioFieldRenderer.render(self.render_uncached(value))
+            self.assertEqual(self.render(value), expected)
+        self.assertEqual(self.render('getpaid.backends.payu').count('checked="checked"'), 1)
+        self.assertNotIn('checked', self.render(''))
+
+    def test_cached(self):
+        from getpaid import forms
+        self.render('getpaid.backends.payu')
+        with mock.patch.object(forms, 'PaymentRadioInput') as radio_input:
+            self.render('getpaid.backends.transferuj')
+        self.assertFalse(radio_input.called)
+
+    def test_language(self):
+        from django.utils import translation
+        from getpaid.backends.dummy import PaymentProcessor
+        with mock.patch.object(PaymentProcessor, 'BACKEND_NAME', translation.ugettext_lazy('Payment method')):
+            with self.settings(GETPAID_BACKENDS=('getpaid.backends.dummy', )):
+                with translation.override('pl'):
+                    self.assertIn(u'Metoda p\u0142atno\u015bci', self.render(''))
+                with translation.override('en'):
+                    self.assertIn(u'Payment method', self.render(''))